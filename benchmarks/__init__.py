@@ -0,0 +1,5 @@
+"""
+Package: benchmarks
+Microbenchmarks of the Supplier model (pytest-benchmark) and the HTTP
+load-test harness; see the Benchmarks section of the README
+"""
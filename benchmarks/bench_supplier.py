@@ -0,0 +1,206 @@
+"""
+Microbenchmarks of the Supplier model hot paths
+
+Run them, save a baseline and compare later runs against it with:
+    python -m pytest benchmarks --benchmark-save=baseline
+    python -m pytest benchmarks --benchmark-compare="*_baseline" --benchmark-compare-fail=median:20%
+"""
+import json
+import random
+import cbor2
+import msgpack
+import orjson
+import pytest
+from flask_restx import marshal
+from service import app, validation
+from service.fast_json import dumps
+from service.routes import binary_suppliers, marshal_suppliers, supplier_model
+from service.supplier import Supplier, db, PRODUCTS_STORAGE_MODES
+
+PRODUCT_COUNTS = (10, 10000, 1000000)
+PAGE_ROWS = 10000
+CATALOGUE_SIZE = 100000
+
+
+######################################################################
+#  V A L I D A T I O N   A N D   S E R I A L I Z A T I O N
+######################################################################
+def bench_init(benchmark, supplier_data):
+    """Supplier(**fields) with its validation"""
+    benchmark(lambda: Supplier(**supplier_data))
+
+
+def bench_deserialize_from_dict(benchmark, supplier_data):
+    """Supplier.deserialize_from_dict"""
+    benchmark(Supplier.deserialize_from_dict, supplier_data)
+
+
+def bench_deserialize_from_json(benchmark, supplier_data):
+    """Supplier.deserialize_from_json"""
+    benchmark(Supplier.deserialize_from_json, json.dumps(supplier_data))
+
+
+def bench_serialize_to_dict(benchmark, supplier_data):
+    """Supplier.serialize_to_dict"""
+    benchmark(Supplier(**supplier_data).serialize_to_dict)
+
+
+def bench_serialize_to_json(benchmark, supplier_data):
+    """Supplier.serialize_to_json"""
+    benchmark(Supplier(**supplier_data).serialize_to_json)
+
+
+def _marshal_page(rows):
+    return json.dumps(marshal(rows, supplier_model)).encode()
+
+
+def _fast_page(rows):
+    return dumps(marshal_suppliers(rows))
+
+
+def _msgpack_page(rows):
+    return msgpack.packb(binary_suppliers(rows))
+
+
+def _cbor_page(rows):
+    return cbor2.dumps(binary_suppliers(rows))
+
+
+def _json_rows(loads):
+    """Parses a JSON page and the products string of each of its rows"""
+    def decode(body):
+        rows = loads(body)
+        for row in rows:
+            row['products'] = loads(row['products'])
+        return rows
+    return decode
+
+
+PAGE_FORMATS = {
+    "marshal": (_marshal_page, _json_rows(json.loads)),
+    "fast": (_fast_page, _json_rows(orjson.loads)),
+    "msgpack": (_msgpack_page, msgpack.unpackb),
+    "cbor": (_cbor_page, cbor2.loads),
+}
+
+
+@pytest.fixture
+def page_rows(supplier_data):
+    """A page of PAGE_ROWS Suppliers as serialize_to_dict returns them"""
+    return [dict(supplier_data, id=index) for index in range(1, PAGE_ROWS + 1)]
+
+
+@pytest.mark.parametrize("page_format", PAGE_FORMATS)
+def bench_encode_page(benchmark, page_rows, page_format):
+    """The body of a page of PAGE_ROWS Suppliers; divide by rows for the cost of one"""
+    encode, decode = PAGE_FORMATS[page_format]
+    with app.app_context():
+        body = benchmark(encode, page_rows)
+    benchmark.extra_info.update(rows=PAGE_ROWS, bytes=len(body))
+    assert len(decode(body)) == PAGE_ROWS
+
+
+@pytest.mark.parametrize("page_format", PAGE_FORMATS)
+def bench_decode_page(benchmark, page_rows, page_format):
+    """What a client spends parsing a page of PAGE_ROWS Suppliers down to their products"""
+    encode, decode = PAGE_FORMATS[page_format]
+    with app.app_context():
+        body = encode(page_rows)
+    benchmark.extra_info.update(rows=PAGE_ROWS, bytes=len(body))
+    assert len(benchmark(decode, body)) == PAGE_ROWS
+
+
+@pytest.mark.parametrize("count", PRODUCT_COUNTS)
+def bench_check_product_ids(benchmark, count):
+    """The product id check of the Supplier validation on count product ids"""
+    products = list(range(1, count + 1))
+    benchmark(validation.parse_product_ids, products)
+
+
+######################################################################
+#  Q U E R I E S
+######################################################################
+def bench_add_products(benchmark, database, supplier_data):
+    """Supplier.add_products of 10 new products, as one UPDATE"""
+    supplier = Supplier(**supplier_data)
+    supplier.create()
+    original = list(supplier.products)
+
+    def reset():
+        database.session.execute(
+            "UPDATE supplier SET products = :products, products_packed = :products_packed "
+            "WHERE id = :id", dict(Supplier.products_values(original), id=supplier.id))
+        database.session.commit()
+        return (list(range(11, 21)),), {}
+
+    benchmark.pedantic(supplier.add_products, setup=reset, rounds=200)
+    supplier.delete()
+
+
+def bench_find_all(benchmark, large_table):
+    """Supplier.find_all of every row of the large table"""
+    result = benchmark.pedantic(Supplier.find_all, args=({},),
+                                setup=db.session.remove, rounds=5)
+    assert len(result) == large_table
+
+
+def bench_find_all_by_product(benchmark, large_table):
+    """Supplier.find_all of the Suppliers carrying a product"""
+    # pylint: disable=unused-argument
+    result = benchmark.pedantic(Supplier.find_all, args=({'products_any': [500]},),
+                                setup=db.session.remove, rounds=20)
+    assert result
+
+
+######################################################################
+#  P R O D U C T   S T O R A G E
+######################################################################
+@pytest.fixture(params=PRODUCTS_STORAGE_MODES)
+def large_catalogue(request, database):
+    """A Supplier carrying CATALOGUE_SIZE products, stored each way"""
+    storage = Supplier.products_storage
+    Supplier.products_storage = request.param
+    products = sorted(random.Random(0).sample(range(1, 10 * CATALOGUE_SIZE), CATALOGUE_SIZE))
+    supplier = Supplier(name="Ken", email="ken@example.com", products=products)
+    supplier.create()
+    yield supplier
+    Supplier.delete_where({'id': supplier.id})
+    Supplier.products_storage = storage
+
+
+def _stored_bytes(supplier_id):
+    return db.session.execute(
+        "SELECT coalesce(pg_column_size(products), 0) + coalesce(pg_column_size(products_packed), 0) "
+        "+ (SELECT coalesce(sum(pg_column_size(linked.*)), 0) FROM supplier_product AS linked "
+        "   WHERE supplier_id = :id) "
+        "FROM supplier WHERE id = :id", {'id': supplier_id}).scalar()
+
+
+def bench_read_catalogue(benchmark, large_catalogue):
+    """Loading a Supplier with a large catalogue, stored bytes in extra_info"""
+    supplier_id = large_catalogue.id
+    benchmark.extra_info['stored_bytes'] = _stored_bytes(supplier_id)
+    result = benchmark.pedantic(Supplier.find_first, args=({'id': supplier_id},),
+                                setup=db.session.remove, rounds=20)
+    assert len(result.products) == CATALOGUE_SIZE
+
+
+def bench_add_to_catalogue(benchmark, database, large_catalogue):
+    """Supplier.add_products_by_id of one product to a large catalogue,
+    the WAL it writes in extra_info"""
+    supplier_id = large_catalogue.id
+    original = list(large_catalogue.products)
+
+    def reset():
+        Supplier.update_where({'id': supplier_id}, {'products': original})
+        return (supplier_id, [10 * CATALOGUE_SIZE]), {}
+
+    wal_bytes = 0
+    for _ in range(5):
+        args, _ = reset()
+        lsn = database.session.execute("SELECT pg_current_wal_insert_lsn()").scalar()
+        Supplier.add_products_by_id(*args)
+        wal_bytes += database.session.execute(
+            "SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), :lsn)", {'lsn': lsn}).scalar()
+    benchmark.extra_info['wal_bytes'] = int(wal_bytes / 5)
+    benchmark.pedantic(Supplier.add_products_by_id, setup=reset, rounds=20)
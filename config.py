@@ -14,6 +14,61 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool of each worker; size the pools of all the workers
+# together against the Postgres max_connections
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    # seconds to wait for a free connection before failing the request
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    # seconds after which a connection is replaced, -1 for never
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "-1")),
+    # test each connection with a round trip before handing it out
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes"),
+    "connect_args": {"connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "10"))},
+}
+
+# Connection pool of each worker of the ASGI app (service.asgi); its
+# requests wait on Postgres concurrently, up to ASYNC_POOL_MAX_SIZE
+ASYNC_POOL_MIN_SIZE = int(os.getenv("ASYNC_POOL_MIN_SIZE", "2"))
+ASYNC_POOL_MAX_SIZE = int(os.getenv("ASYNC_POOL_MAX_SIZE", "20"))
+
+# Keyset pagination of the supplier collection
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Trigram search (q=) on name and address: minimum word similarity
+# and number of results returned by default
+SEARCH_THRESHOLD = float(os.getenv("SEARCH_THRESHOLD", "0.5"))
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "20"))
+
+# Rows fetched per server-side cursor round trip when streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# Rows per multi-row INSERT of the bulk create endpoint
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
+# Per-worker cache of GET /suppliers/{id}; writes are broadcast to the
+# other workers with NOTIFY on CACHE_CHANNEL
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_CHANNEL = os.getenv("CACHE_CHANNEL", "supplier_cache")
+
+# SQL statements slower than this many seconds are logged, and requests
+# issuing more than QUERY_BUDGET statements are warned about (0: never)
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "20"))
+
+# How product ids are stored: "array" as a bigint[] per Supplier,
+# "packed" as delta-encoded varints, several times smaller for large
+# catalogues but decoded on every read, or "table" as one supplier_product
+# row per product, larger but written a row at a time. Array and packed
+# rows stored the other way stay readable; flask suppliers
+# convert-products rewrites them. Switching to or from "table" moves
+# the rows when the service starts
+PRODUCTS_STORAGE = os.getenv("PRODUCTS_STORAGE", "array")
+
 # Secret for session management
 # SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
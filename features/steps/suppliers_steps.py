@@ -16,16 +16,10 @@ from compare import expect
 def step_impl(context):
     """ Delete all suppliers and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the suppliers and delete them one by one
-    context.resp = requests.get(context.base_url + '/api/suppliers',
-                                headers=headers)
+    # delete all of the suppliers in one request
+    context.resp = requests.delete(context.base_url + '/api/suppliers?all=true',
+                                   headers=headers)
     expect(context.resp.status_code).to_equal(200)
-    for supplier in context.resp.json():
-        context.resp = requests.delete(context.base_url +
-                                       '/api/suppliers/' +
-                                       str(supplier["id"]),
-                                       headers=headers)
-        expect(context.resp.status_code).to_equal(204)
     # load the database with new supplierss
     create_url = context.base_url + '/api/suppliers'
     for row in context.table:
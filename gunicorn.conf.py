@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration
+
+Points prometheus_client at a directory shared by the workers, so that
+GET /metrics aggregates all of them, and drops the live gauges of
+workers that exit.
+"""
+import os
+import shutil
+import tempfile
+
+# set before prometheus_client is imported: it picks how metric values
+# are stored, per process or in the directory, at import
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                      os.path.join(tempfile.gettempdir(), "supplier-metrics"))
+
+from prometheus_client import multiprocess  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Clears the metrics left by a previous run of the server"""
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live gauges of a worker that exited"""
+    multiprocess.mark_process_dead(worker.pid)
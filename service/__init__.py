@@ -8,13 +8,19 @@ import sys
 import logging
 from flask import Flask
 from . import supplier
+from .metrics import init_metrics
+from .query_stats import init_query_stats
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object("config")
+init_metrics(app)
+init_query_stats(app)
 
 # Import the routes After the Flask app is created
 from service import routes
+from service.commands import suppliers_cli
+app.cli.add_command(suppliers_cli)
 
 # Set up logging for production
 print("Setting up logging for {}...".format(__name__))
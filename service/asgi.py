@@ -0,0 +1,329 @@
+"""
+Supplier Store Service, ASGI entry point
+
+Serves the /api/suppliers routes of service.routes with async handlers
+on an asyncpg pool (see service.async_supplier), so that one worker
+keeps as many requests waiting on Postgres as its pool has connections
+instead of one per gunicorn sync worker:
+
+    uvicorn service.asgi:app --workers 2
+
+Paths:
+------
+GET /suppliers - Returns a page of the Suppliers (see limit/after)
+GET /suppliers/{id} - Returns the Supplier with a given id number
+POST /suppliers - creates a new Supplier record in the database
+PUT /suppliers/{id} - updates a Supplier record in the database
+DELETE /suppliers/{id} - deletes a Supplier record in the database
+POST /suppliers/{id}/products - adds products to a Supplier
+DELETE /suppliers/{id}/products - removes products from a Supplier
+
+Requests, responses, validation and errors are those of the Flask app,
+in JSON, MessagePack or CBOR. Search (q), NDJSON streaming, the bulk,
+export, products and stats routes and the Swagger docs are only served
+by service:app.
+"""
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Optional
+import orjson
+from starlette.applications import Starlette
+from starlette.endpoints import HTTPEndpoint
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import abort, HTTPException, BadRequest, NotFound
+from werkzeug.http import parse_accept_header, parse_etags, unquote_etag
+from service import status, app as flask_app
+from service.async_supplier import AsyncSuppliers
+from service.fast_json import dumps
+from service.media_types import MSGPACK, CBOR, BINARY_MEDIA_TYPES, ENCODERS, decode_body
+from service.routes import BASE_URL, convert_id_to_int, parse_supplier_filters, \
+    parse_page_args, encode_cursor, supplier_validators, page_validators, etag_version, \
+    marshal_suppliers, marshal_removed_products, binary_suppliers, binary_removed_products
+from service.supplier_exception import SupplierException, DuplicateProduct, VersionConflict
+
+JSON = "application/json"
+MEDIA_TYPES = [JSON, MSGPACK, CBOR]
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+# Request and response helpers
+######################################################################
+def negotiate(request: Request) -> str:
+    """Picks the media type of the response from Accept, JSON by default"""
+    accept = parse_accept_header(request.headers.get("Accept"), MIMEAccept)
+    return accept.best_match(MEDIA_TYPES, default=JSON)
+
+
+def encode(request: Request, data: Any, code: int = status.HTTP_200_OK,
+           headers: dict = None) -> Response:
+    """Encodes data in the negotiated media type"""
+    mimetype = negotiate(request)
+    body = ENCODERS[mimetype](data) if mimetype in BINARY_MEDIA_TYPES \
+        else dumps(data, indent=flask_app.debug)
+    return Response(body, status_code=code, headers=dict(headers or {}, Vary="Accept"),
+                    media_type=mimetype)
+
+
+def suppliers_body(request: Request, message: Any) -> Any:
+    """Outputs one or more suppliers for the negotiated media type"""
+    if negotiate(request) in BINARY_MEDIA_TYPES:
+        return binary_suppliers(message)
+    return marshal_suppliers(message)
+
+
+async def read_payload(request: Request) -> Any:
+    """
+    Reads the request body as JSON, or as MessagePack or CBOR after its
+    Content-Type
+    """
+    mimetype = request.headers.get("Content-Type", "").split(";")[0].strip()
+    if mimetype in BINARY_MEDIA_TYPES:
+        return decode_body(mimetype, await request.body())
+    if mimetype != JSON:
+        logger.error("Invalid Content-Type: %s", mimetype)
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be {}".format(JSON))
+    try:
+        return orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise BadRequest("The browser (or proxy) sent a request that this server "
+                         "could not understand.")
+
+
+def expected_version(request: Request) -> Optional[int]:
+    """
+    Reads the version a write is conditional on from If-Match
+    Returns None when the write is unconditional (no If-Match, or *)
+    """
+    if_match = parse_etags(request.headers.get("If-Match"))
+    if not if_match or if_match.star_tag:
+        return None
+    tags = list(if_match)  # the strong ETags; weak ones never match
+    if len(tags) > 1:
+        raise BadRequest('400 BAD REQUEST. If-Match must hold a single ETag')
+    try:
+        return etag_version(tags[0])
+    except (IndexError, ValueError):
+        raise VersionConflict("412 PRECONDITION FAILED: If-Match {} matches no "
+                              "version".format(request.headers['If-Match']))
+
+
+def is_not_modified(request: Request, headers: dict) -> bool:
+    """Evaluates If-None-Match against the ETag in headers"""
+    if_none_match = parse_etags(request.headers.get("If-None-Match"))
+    return bool(if_none_match) and \
+        if_none_match.contains_weak(unquote_etag(headers['ETag'])[0])
+
+
+def not_modified_response(headers: dict) -> Response:
+    """Builds a 304 response carrying the validators"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers=dict(headers, Vary="Accept"))
+
+
+def next_page_link(request: Request, last_id: int, limit: int) -> str:
+    """Builds the Link header pointing at the page after last_id"""
+    url = request.url.include_query_params(after=encode_cursor(last_id), limit=limit)
+    return '<{}>; rel="next"'.format(url)
+
+
+def suppliers(request: Request) -> AsyncSuppliers:
+    """The Supplier data layer of the app"""
+    return request.app.state.suppliers
+
+
+######################################################################
+#  PATH: /suppliers/{id}
+######################################################################
+class SupplierResource(HTTPEndpoint):
+    """
+    Allows the manipulation of a single Supplier
+    GET /suppliers/{id} - Returns a supplier with the id
+    PUT /suppliers/{id} - Update a supplier with the id
+    DELETE /suppliers/{id} -  Deletes a supplier with the id
+    """
+    async def get(self, request: Request) -> Response:
+        """
+        Read a supplier and return the supplier as a dict
+        Answers If-None-Match with 304 when the supplier has not changed
+        """
+        supplier_id = convert_id_to_int(request.path_params['supplier_id'])
+        message = await suppliers(request).find(supplier_id)
+        headers = supplier_validators(message.pop('version'), message.pop('updated_at'),
+                                      negotiate(request))
+        if is_not_modified(request, headers):
+            return not_modified_response(headers)
+        return encode(request, suppliers_body(request, message), headers=headers)
+
+    async def put(self, request: Request) -> Response:
+        """
+        Updates a supplier with the provided supplier id
+        Returns the updated supplier
+        With If-Match, only updates the supplier at that ETag (version)
+        """
+        supplier_id = convert_id_to_int(request.path_params['supplier_id'])
+        request_body = await read_payload(request)
+        message = await suppliers(request).update(supplier_id, request_body,
+                                                  expected_version(request))
+        headers = supplier_validators(message.pop('version'), message.pop('updated_at'),
+                                      negotiate(request))
+        return encode(request, suppliers_body(request, message), headers=headers)
+
+    async def delete(self, request: Request) -> Response:
+        """Deletes a supplier with the provided supplier id"""
+        supplier_id = convert_id_to_int(request.path_params['supplier_id'])
+        await suppliers(request).delete(supplier_id)
+        logger.info("Supplier with id %s has been deleted.", supplier_id)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+#  PATH: /suppliers
+######################################################################
+class SupplierCollection(HTTPEndpoint):
+    """ Handles all interactions with collections of Suppliers """
+    async def get(self, request: Request) -> Response:
+        """
+        Reads a page of the suppliers satisfying the filters
+        When more suppliers remain, a Link header with rel="next" points
+        at the following page. A page is answered with 304 when it
+        matches If-None-Match
+        """
+        supplier_info = parse_supplier_filters(request.query_params)
+        if request.query_params.get('q') is not None:
+            abort(status.HTTP_501_NOT_IMPLEMENTED,
+                  '501 NOT IMPLEMENTED. Search is served by service:app')
+        after, limit = parse_page_args(request.query_params)
+        # fetch one extra row to learn whether another page exists
+        rows = await suppliers(request).find_page(supplier_info, after, limit + 1)
+        headers = page_validators([(row['id'], row['version'], row['updated_at'])
+                                   for row in rows], negotiate(request))
+        if is_not_modified(request, headers):
+            return not_modified_response(headers)
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['Link'] = next_page_link(request, rows[-1]['id'], limit)
+        if not rows and after is None and any(supplier_info.values()):
+            raise NotFound("404 NOT FOUND")
+        return encode(request, suppliers_body(request, rows), headers=headers)
+
+    async def post(self, request: Request) -> Response:
+        """ Create a supplier and return the supplier as a dict """
+        request_body = await read_payload(request)
+        message = await suppliers(request).create(request_body)
+        logger.info("created new supplier with id %s", message['id'])
+        return encode(request, suppliers_body(request, message), status.HTTP_201_CREATED)
+
+
+######################################################################
+#  PATH: /suppliers/{id}/products
+######################################################################
+class ProductsResource(HTTPEndpoint):
+    """ Add products to, or remove products from, a Supplier """
+    async def post(self, request: Request) -> Response:
+        """
+        Adds the provided list of products to a supplier
+        Returns the updated supplier
+        With If-Match, only updates the supplier at that ETag (version)
+        """
+        supplier_id = convert_id_to_int(request.path_params['supplier_id'])
+        request_body = await read_payload(request)
+        try:
+            products = request_body["products"]
+        except (KeyError, TypeError):
+            raise BadRequest("400 BAD REQUEST: products not provided")
+        message = await suppliers(request).add_products(supplier_id, products,
+                                                        expected_version(request))
+        headers = supplier_validators(message.pop('version'), message.pop('updated_at'),
+                                      negotiate(request))
+        if negotiate(request) not in BINARY_MEDIA_TYPES:
+            message['products'] = '['+', '.join(str(i) for i in message['products'])+']'
+        return encode(request, message, headers=headers)
+
+    async def delete(self, request: Request) -> Response:
+        """
+        Removes products, from the query string or the request body,
+        from a supplier
+        Returns the updated supplier and the products it did not carry
+        """
+        supplier_id = convert_id_to_int(request.path_params['supplier_id'])
+        products = request.query_params.get('products')
+        if products is None:
+            payload = await read_payload(request)
+            products = payload.get('products') if isinstance(payload, dict) else None
+            if products is None:
+                raise BadRequest("400 BAD REQUEST: products not provided")
+        message, missing = await suppliers(request).remove_products(
+            supplier_id, products, expected_version(request))
+        headers = supplier_validators(message.pop('version'), message.pop('updated_at'),
+                                      negotiate(request))
+        message['missing'] = missing
+        message = binary_removed_products(message) \
+            if negotiate(request) in BINARY_MEDIA_TYPES else marshal_removed_products(message)
+        return encode(request, message, headers=headers)
+
+
+######################################################################
+# Error Handlers
+######################################################################
+async def supplier_error(request: Request, error: SupplierException) -> Response:
+    """ Handles the errors of the validation, like the api error handlers """
+    message = str(error)
+    code = status.HTTP_412_PRECONDITION_FAILED if isinstance(error, VersionConflict) \
+        else status.HTTP_400_BAD_REQUEST
+    body = {
+        'status_code': code,
+        'error': '412 PRECONDITION FAILED' if code == status.HTTP_412_PRECONDITION_FAILED
+                 else '400 BAD REQUEST',
+        'message': message,
+    }
+    if not isinstance(error, (DuplicateProduct, VersionConflict)):
+        body['errors'] = list(error.errors)
+    logger.error(message)
+    return encode(request, body, code)
+
+
+async def http_error(request: Request, error: HTTPException) -> Response:
+    """ Handles the HTTP errors raised by the handlers, like flask-restx """
+    return encode(request, {'message': error.description}, error.code)
+
+
+######################################################################
+# Application
+######################################################################
+@asynccontextmanager
+async def lifespan(application: Starlette):
+    """
+    Opens the asyncpg pool of the worker, and closes it on shutdown
+    The Supplier queries are built in the app context of the Flask app,
+    pushed for the thread of the event loop
+    """
+    context = flask_app.app_context()
+    context.push()
+    application.state.suppliers = await AsyncSuppliers.connect(
+        flask_app.config['SQLALCHEMY_DATABASE_URI'],
+        min_size=flask_app.config['ASYNC_POOL_MIN_SIZE'],
+        max_size=flask_app.config['ASYNC_POOL_MAX_SIZE'])
+    try:
+        yield
+    finally:
+        await application.state.suppliers.close()
+        context.pop()
+
+
+app = Starlette(
+    routes=[
+        Route('/api' + BASE_URL, SupplierCollection),
+        Route('/api' + BASE_URL + '/{supplier_id}', SupplierResource),
+        Route('/api' + BASE_URL + '/{supplier_id}/products', ProductsResource),
+    ],
+    exception_handlers={
+        SupplierException: supplier_error,
+        HTTPException: http_error,
+    },
+    lifespan=lifespan,
+)
@@ -0,0 +1,322 @@
+'''
+Supplier data layer on an asyncpg pool
+
+The ASGI app (service.asgi) reads and writes Suppliers through
+AsyncSuppliers instead of the SQLAlchemy session, so a request waiting
+on Postgres does not hold a thread. The statements are those of the
+Supplier model: filter_query() and the products SQL are compiled by
+SQLAlchemy for the numeric paramstyle and run by asyncpg, the records
+go through the same validation and the products are stored as
+products_storage says, so both deployments find, store and reject
+Suppliers alike. Writes queue the same cache NOTIFY as the model, so
+the WSGI workers drop the Suppliers changed here.
+'''
+# pylint: disable=protected-access
+
+import re
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from werkzeug.exceptions import NotFound
+from service import product_codec
+from service.cache import supplier_cache
+from service.supplier import Supplier, TABLE_STORAGE, LINK_PRODUCTS_SQL, \
+    ADD_LINKED_PRODUCTS_SQL, REMOVE_LINKED_PRODUCTS_SQL, REMOVE_PRODUCTS_FROM_ONE_SQL, \
+    LOCK_SUPPLIER_SQL, TOUCH_LINKED_SUPPLIER_SQL, LINKED_SUPPLIER_SQL
+from service.supplier_exception import DuplicateProduct, VersionConflict, WrongArgType
+
+DIALECT = postgresql.dialect(paramstyle='numeric')
+NUMBERED_PARAM = re.compile(r'(?<![:\w]):(\d+)')
+
+# the fields of a Supplier, as serialize_to_dict returns them, with
+# its version and updated_at
+SUPPLIER_FIELDS = ('id', 'name', 'email', 'address', 'products', 'version', 'updated_at')
+
+INSERT_SQL = """
+INSERT INTO {table} (name, email, address, products, products_packed)
+VALUES (:name, :email, :address, :products, :products_packed)
+RETURNING id, version, updated_at
+"""
+
+# Updates Supplier :id unless another write bumped its :version since
+# it was read
+UPDATE_SQL = """
+UPDATE {table}
+SET name = :name, email = :email, address = :address,{set_products}
+    version = version + 1, updated_at = now()
+WHERE id = :id AND version = :version
+RETURNING version, updated_at
+"""
+
+DELETE_SQL = "DELETE FROM {table} WHERE id = :id RETURNING id"
+
+NOTIFY_SQL = "SELECT pg_notify(:channel, :payload)"
+
+
+def compile_statement(statement, params: dict = None) -> tuple:
+    '''
+    Compiles a SQLAlchemy statement for asyncpg
+    :return: the SQL with $1, $2... parameters followed by their values,
+             the arguments of connection.fetch
+    '''
+    compiled = statement.compile(dialect=DIALECT)
+    values = compiled.construct_params(params)
+    return (_numbered(compiled.string), *(values[name] for name in compiled.positiontup))
+
+
+@lru_cache(maxsize=None)
+def _compile_text(sql: str) -> Tuple[str, Tuple[str, ...]]:
+    compiled = text(sql).compile(dialect=DIALECT)
+    return _numbered(compiled.string), tuple(compiled.positiontup)
+
+
+def compile_text(sql: str, params: dict) -> tuple:
+    '''compile_statement of a SQL string with :name parameters, cached'''
+    sql, names = _compile_text(sql)
+    return (sql, *(params[name] for name in names))
+
+
+def _numbered(sql: str) -> str:
+    return NUMBERED_PARAM.sub(r'$\1', sql)
+
+
+def _not_found(supplier_id: int) -> NotFound:
+    return NotFound("404 NOT FOUND: Supplier with provided fields {} not found"
+                    .format({'id': supplier_id}))
+
+
+class AsyncSuppliers:
+    '''
+    The Supplier reads and writes served by the ASGI app
+    Every method takes a connection from the pool for the time of its
+    statements, and returns Suppliers as dicts of SUPPLIER_FIELDS
+    '''
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self.pool = pool
+        self.table = Supplier.__tablename__
+
+    @classmethod
+    async def connect(cls, dsn: str, min_size: int = 2, max_size: int = 20) -> "AsyncSuppliers":
+        '''Opens a pool of min_size to max_size connections to dsn'''
+        pool = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size,
+                                         server_settings={'application_name': 'supplier-asgi'})
+        return cls(pool)
+
+    async def close(self) -> None:
+        '''Closes the connections of the pool'''
+        await self.pool.close()
+
+    ##################################################
+    # READS
+    ##################################################
+    async def find(self, supplier_id: int) -> dict:
+        '''Returns Supplier supplier_id, or raises NotFound'''
+        suppliers = await self.find_page({'id': supplier_id}, limit=1)
+        if not suppliers:
+            raise _not_found(supplier_id)
+        return suppliers[0]
+
+    async def find_page(self, supplier_info: dict, after: int = None,
+                        limit: int = None) -> List[dict]:
+        '''
+        Returns a page of the Suppliers matching supplier_info, like
+        Supplier.find_page
+        '''
+        query = Supplier.filter_query(supplier_info).with_entities(
+            Supplier.id, Supplier.name, Supplier.email, Supplier.address,
+            Supplier.products, Supplier.products_packed, Supplier.linked_products,
+            Supplier.version, Supplier.updated_at)
+        if after is not None:
+            query = query.filter(Supplier.id > after)
+        statement = compile_statement(query.order_by(Supplier.id).limit(limit).statement)
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(*statement)
+        return [self._supplier(row) for row in rows]
+
+    @staticmethod
+    def _supplier(row: asyncpg.Record) -> dict:
+        '''A Supplier row with its products decoded like _unpack_products'''
+        # pylint: disable=unbalanced-tuple-unpacking
+        supplier_id, name, email, address, products, packed, linked, version, updated_at = row
+        if products is None and packed is not None:
+            products = product_codec.unpack(packed)
+        elif products is None and Supplier.products_storage == TABLE_STORAGE:
+            products = linked
+        return dict(zip(SUPPLIER_FIELDS,
+                        (supplier_id, name, email, address, products, version, updated_at)))
+
+    ##################################################
+    # WRITES
+    ##################################################
+    async def create(self, data: dict) -> dict:
+        '''Validates and inserts a Supplier, like Supplier.create'''
+        if not isinstance(data, dict):
+            raise WrongArgType("400 BAD REQUEST: <class 'dict'> expected for data, "
+                               "got %s" % type(data))
+        row = Supplier.validate_dict(data)
+        values = dict(row, **Supplier.products_values(row['products']))
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                inserted = await connection.fetchrow(
+                    *compile_text(INSERT_SQL.format(table=self.table), values))
+                if Supplier.products_storage == TABLE_STORAGE:
+                    await self._link_products(connection, inserted['id'], row['products'])
+        return dict(row, **inserted)
+
+    async def update(self, supplier_id: int, data: dict,
+                     expected_version: int = None) -> dict:
+        '''
+        Validates and writes the fields of data to Supplier supplier_id,
+        like Supplier.update
+        '''
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                current = await self._find(connection, supplier_id)
+                Supplier._check_version(supplier_id, current['version'], expected_version)
+                row = Supplier.validate_update(current, data)
+                # only rewrite the products, and their index entries, when they change
+                changed = row['products'] != current['products']
+                set_products = ""
+                values = dict(row, id=supplier_id, version=current['version'])
+                if changed and Supplier.products_storage != TABLE_STORAGE:
+                    set_products = " products = :products, products_packed = :products_packed,"
+                    values.update(Supplier.products_values(row['products']))
+                updated = await connection.fetchrow(*compile_text(
+                    UPDATE_SQL.format(table=self.table, set_products=set_products), values))
+                if updated is None:
+                    raise VersionConflict("412 PRECONDITION FAILED: Supplier {} was changed "
+                                          "by another request".format(supplier_id))
+                if changed and Supplier.products_storage == TABLE_STORAGE:
+                    await self._link_products(connection, supplier_id, row['products'])
+                await self._publish(connection, supplier_id)
+        return dict(row, id=supplier_id, **updated)
+
+    async def delete(self, supplier_id: int) -> None:
+        '''Deletes Supplier supplier_id, or raises NotFound'''
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                deleted = await connection.fetchval(
+                    *compile_text(DELETE_SQL.format(table=self.table), {'id': supplier_id}))
+                if deleted is None:
+                    raise _not_found(supplier_id)
+                await self._publish(connection, supplier_id)
+
+    async def add_products(self, supplier_id: int, products: Any,
+                           expected_version: int = None) -> dict:
+        '''Adds products to Supplier supplier_id, like Supplier.add_products_by_id'''
+        products = Supplier._parse_product_ids(products)
+        async with self.pool.acquire() as connection:
+            if not products:
+                supplier = await self._find(connection, supplier_id)
+                Supplier._check_version(supplier_id, supplier['version'], expected_version)
+                return supplier
+            async with connection.transaction():
+                if Supplier.products_storage == TABLE_STORAGE:
+                    return await self._add_linked_products(connection, supplier_id, products,
+                                                           expected_version)
+                statement = compile_text(Supplier._add_products_statement().text, {
+                    'id': supplier_id, 'new': products, 'expected': expected_version})
+                while True:
+                    row = await connection.fetchrow(*statement)
+                    if row is None:
+                        raise _not_found(supplier_id)
+                    if row['version'] is not None:
+                        break
+                    Supplier._check_version(supplier_id, row['current_version'],
+                                            expected_version)
+                    if row['duplicates']:
+                        raise DuplicateProduct("400 BAD REQUEST: Duplicated products: {}"
+                                               .format(set(row['duplicates'])))
+                    # a concurrent write committed after the statement's
+                    # snapshot was taken: look again
+                await self._publish(connection, supplier_id)
+        return {key: row[key] for key in SUPPLIER_FIELDS}
+
+    async def remove_products(self, supplier_id: int, products: Any,
+                              expected_version: int = None) -> Tuple[dict, List[int]]:
+        '''
+        Removes products from Supplier supplier_id, like
+        Supplier.remove_products_by_id
+        '''
+        products = Supplier._parse_products_to_remove(products)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if Supplier.products_storage == TABLE_STORAGE:
+                    return await self._remove_linked_products(connection, supplier_id,
+                                                              products, expected_version)
+                statement = Supplier._remove_products_statement(REMOVE_PRODUCTS_FROM_ONE_SQL,
+                                                                "id = :id")
+                row = await connection.fetchrow(*compile_text(statement.text, {
+                    'id': supplier_id, 'ids': products, 'expected': expected_version}))
+                if row is None:
+                    raise _not_found(supplier_id)
+                if not row['changed']:
+                    Supplier._check_version(supplier_id, row['version'], expected_version)
+                else:
+                    await self._publish(connection, supplier_id)
+        return {key: row[key] for key in SUPPLIER_FIELDS}, row['missing']
+
+    ##################################################
+    # TABLE STORAGE
+    ##################################################
+    async def _add_linked_products(self, connection, supplier_id: int, products: List[int],
+                                   expected_version: int = None) -> dict:
+        await self._lock_linked_supplier(connection, supplier_id, expected_version)
+        added = {product_id for product_id, in await connection.fetch(*compile_text(
+            ADD_LINKED_PRODUCTS_SQL, {'id': supplier_id, 'new': products}))}
+        if len(added) < len(products):
+            raise DuplicateProduct("400 BAD REQUEST: Duplicated products: {}"
+                                   .format(set(products) - added))
+        row = await connection.fetchrow(*compile_text(
+            Supplier._linked_supplier_statement(TOUCH_LINKED_SUPPLIER_SQL).text,
+            {'id': supplier_id}))
+        await self._publish(connection, supplier_id)
+        return dict(row)
+
+    async def _remove_linked_products(self, connection, supplier_id: int, products: List[int],
+                                      expected_version: int = None) -> Tuple[dict, List[int]]:
+        await self._lock_linked_supplier(connection, supplier_id, expected_version)
+        removed = {product_id for product_id, in await connection.fetch(*compile_text(
+            REMOVE_LINKED_PRODUCTS_SQL, {'id': supplier_id, 'ids': products}))}
+        row = await connection.fetchrow(*compile_text(
+            Supplier._linked_supplier_statement(
+                TOUCH_LINKED_SUPPLIER_SQL if removed else LINKED_SUPPLIER_SQL).text,
+            {'id': supplier_id}))
+        if removed:
+            await self._publish(connection, supplier_id)
+        return dict(row), sorted(set(products) - removed)
+
+    async def _lock_linked_supplier(self, connection, supplier_id: int,
+                                    expected_version: Optional[int]) -> None:
+        version = await connection.fetchval(*compile_text(
+            LOCK_SUPPLIER_SQL.format(table=self.table), {'id': supplier_id}))
+        if version is None:
+            raise _not_found(supplier_id)
+        Supplier._check_version(supplier_id, version, expected_version)
+
+    @staticmethod
+    async def _link_products(connection, supplier_id: int, products: List[int]) -> None:
+        await connection.execute(*compile_text(
+            LINK_PRODUCTS_SQL, {'ids': [supplier_id], 'products': products}))
+
+    ##################################################
+    # HELPERS
+    ##################################################
+    async def _find(self, connection, supplier_id: int) -> dict:
+        query = Supplier.filter_query({'id': supplier_id}).with_entities(
+            Supplier.id, Supplier.name, Supplier.email, Supplier.address,
+            Supplier.products, Supplier.products_packed, Supplier.linked_products,
+            Supplier.version, Supplier.updated_at)
+        row = await connection.fetchrow(*compile_statement(query.statement))
+        if row is None:
+            raise _not_found(supplier_id)
+        return self._supplier(row)
+
+    @staticmethod
+    async def _publish(connection, supplier_id: int) -> None:
+        '''Queues the cache invalidation of supplier_cache.publish'''
+        if supplier_cache.enabled:
+            await connection.execute(*compile_text(NOTIFY_SQL, {
+                'channel': supplier_cache.channel, 'payload': str(supplier_id)}))
@@ -0,0 +1,202 @@
+'''
+Read-through cache of serialized Suppliers
+
+Each worker process keeps a bounded LRU cache whose entries expire
+after a TTL. Writes invalidate the local entry once committed and
+queue a Postgres NOTIFY in the writing transaction. A listener thread
+in every worker applies those notifications, so no worker keeps
+serving a Supplier that was changed through another one.
+'''
+
+import os
+import time
+import select
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+from sqlalchemy import text
+from service.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger("flask.app")
+
+ALL = "*"
+
+
+class SupplierCache:
+    '''
+    LRU + TTL cache of serialized Suppliers keyed by id
+
+    A reader takes a token from begin() before loading a Supplier and
+    hands it back to put(); if anything was invalidated in between, the
+    possibly stale value is not cached
+    '''
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.enabled = True
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = "supplier_cache"
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._connect = None
+        self._listener = None
+
+    def init_app(self, app, connect: Callable) -> None:
+        '''
+        Configures the cache from the Flask app config
+        :param connect: returns a new pooled DBAPI connection, used
+                        by the invalidation listener
+        '''
+        self.enabled = app.config.get("CACHE_ENABLED", True)
+        self.maxsize = app.config.get("CACHE_MAXSIZE", self.maxsize)
+        self.ttl = app.config.get("CACHE_TTL", self.ttl)
+        self.channel = app.config.get("CACHE_CHANNEL", self.channel)
+        self._connect = connect
+        self.clear()
+
+    def begin(self) -> int:
+        '''Returns the token to pass to put() after loading a value'''
+        self._ensure_listener()
+        return self._generation
+
+    def get(self, supplier_id: int) -> Optional[dict]:
+        '''
+        Returns the cached Supplier, or None on a miss or while the
+        invalidations of the other workers cannot be heard
+        '''
+        if not self.enabled or not self._ensure_listener():
+            return None
+        with self._lock:
+            entry = self._entries.get(supplier_id)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(supplier_id)
+                self.hits += 1
+                CACHE_LOOKUPS.labels("hit").inc()
+                return dict(entry[1])
+            if entry is not None:
+                del self._entries[supplier_id]
+            self.misses += 1
+            CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+    def put(self, supplier_id: int, value: dict, token: int) -> None:
+        '''Caches value unless an invalidation happened since begin()'''
+        if not self.enabled or not self._ensure_listener():
+            return
+        with self._lock:
+            if token != self._generation:
+                return
+            self._entries[supplier_id] = (self.clock() + self.ttl, dict(value))
+            self._entries.move_to_end(supplier_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, supplier_id: int = None) -> None:
+        '''Drops one Supplier, or every Supplier if supplier_id is None'''
+        with self._lock:
+            self._generation += 1
+            if supplier_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(supplier_id, None)
+
+    def clear(self) -> None:
+        '''Drops every entry and resets the counters'''
+        self.invalidate()
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def publish(self, session, supplier_id: int = None) -> None:
+        '''
+        Queues the invalidation of a Supplier (or all of them) for the
+        other workers. NOTIFY is transactional: it is delivered when the
+        session commits and dropped if it rolls back
+        '''
+        if not self.enabled:
+            return
+        session.execute(text("SELECT pg_notify(:channel, :payload)"), {
+            'channel': self.channel,
+            'payload': ALL if supplier_id is None else str(supplier_id)
+        })
+
+    def stats(self) -> dict:
+        '''Returns the cache counters'''
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _ensure_listener(self) -> bool:
+        # serve nothing from the cache until invalidations can be heard:
+        # returns whether they can
+        listener = self._listener
+        if self._connect is None or not self.enabled:
+            return True
+        # threads do not survive fork, so each gunicorn worker starts its own
+        if listener is None or listener.pid != os.getpid():
+            with self._lock:
+                if self._listener is listener:
+                    self._listener = _InvalidationListener(self)
+                    self._listener.start()
+                listener = self._listener
+            listener.ready.wait(_InvalidationListener.POLL_SECONDS)
+        return listener.ready.is_set()
+
+
+class _InvalidationListener(threading.Thread):
+    '''LISTENs for invalidations published by any worker'''
+    POLL_SECONDS = 5.0
+    RETRY_SECONDS = 1.0
+
+    def __init__(self, cache: SupplierCache) -> None:
+        super().__init__(name="supplier-cache-listener", daemon=True)
+        self.cache = cache
+        self.pid = os.getpid()
+        self.ready = threading.Event()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self._listen()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Supplier cache listener failed: %s", error)
+            # notifications are missed while disconnected: the cache is
+            # bypassed until _listen hears them again
+            self.ready.clear()
+            self.cache.invalidate()
+            time.sleep(self.RETRY_SECONDS)
+
+    def _listen(self) -> None:
+        pooled = self.cache._connect()  # pylint: disable=protected-access
+        pooled.detach()
+        connection = pooled.connection
+        try:
+            connection.autocommit = True
+            connection.cursor().execute('LISTEN "{}"'.format(self.cache.channel))
+            # entries cached before LISTEN took effect may be stale
+            self.cache.invalidate()
+            self.ready.set()
+            while True:
+                select.select([connection], [], [], self.POLL_SECONDS)
+                connection.poll()
+                while connection.notifies:
+                    payload = connection.notifies.pop(0).payload
+                    self.cache.invalidate(None if payload == ALL else int(payload))
+        finally:
+            connection.close()
+
+
+supplier_cache = SupplierCache()
@@ -0,0 +1,26 @@
+"""
+Flask CLI commands for supplier maintenance
+
+    flask suppliers import <file.csv|file.ndjson>
+    flask suppliers export <file.csv|file.ndjson>[.gz]
+    flask suppliers convert-products
+"""
+import click
+from flask.cli import AppGroup
+from service.importer import import_command
+from service.exporter import export_command
+from service.supplier import Supplier
+
+suppliers_cli = AppGroup("suppliers", help="Supplier maintenance commands")
+suppliers_cli.add_command(import_command)
+suppliers_cli.add_command(export_command)
+
+
+@suppliers_cli.command("convert-products")
+@click.option("--batch-size", type=int, default=1000, show_default=True,
+              help="Suppliers rewritten per transaction")
+def convert_products_command(batch_size):
+    """Rewrite the products stored otherwise than PRODUCTS_STORAGE says"""
+    converted = Supplier.convert_products(batch_size)
+    click.echo("Converted the products of {} supplier(s) to {} storage"
+               .format(converted, Supplier.products_storage))
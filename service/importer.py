@@ -0,0 +1,237 @@
+'''
+Bulk import of Suppliers from CSV or NDJSON files
+
+Records are validated in chunks across a process pool with the same
+rules as the Supplier model. Valid rows are streamed into a temporary
+staging table with COPY FROM STDIN and merged into the supplier table
+in one INSERT ... SELECT. Rejected records go to a side file.
+
+Usage:
+    flask suppliers import suppliers.csv
+    python -m service.importer suppliers.ndjson --workers 4
+'''
+
+import os
+import csv
+import json
+import logging
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Iterable, Iterator, List, TextIO, Tuple
+import click
+from service.supplier import Supplier, db, TABLE_STORAGE
+from service.supplier_exception import SupplierException
+
+logger = logging.getLogger("flask.app")
+
+CHUNK_SIZE = 5000
+FIELDS = ("name", "email", "address", "products")
+STAGING_TABLE = "supplier_import"
+
+# Merges the staging table when products are stored in supplier_product:
+# the ids are drawn first, in file order, to link the products to them
+MERGE_LINKED_SQL = """
+WITH staged AS (
+    SELECT nextval(pg_get_serial_sequence('{table}', 'id')) AS id,
+           name, email, address, products
+    FROM {staging} ORDER BY line
+), inserted AS (
+    INSERT INTO {table} (id, name, email, address)
+    SELECT id, name, email, address FROM staged
+    RETURNING id
+), linked AS (
+    INSERT INTO supplier_product (supplier_id, product_id)
+    SELECT id, unnest(products) FROM staged
+)
+SELECT count(*) FROM inserted
+"""
+
+def import_suppliers(path: str, file_format: str = None, workers: int = None,
+                     chunk_size: int = CHUNK_SIZE,
+                     rejects_path: str = None) -> Tuple[int, int]:
+    '''
+    Imports the Suppliers in a CSV or NDJSON file
+    Nothing is imported unless the whole load succeeds; invalid
+    records are skipped and written to rejects_path as NDJSON
+    :param path: the file to import
+    :param file_format: csv or ndjson, guessed from the extension if None
+    :param workers: the number of validation processes
+    :param chunk_size: the number of records validated per task
+    :param rejects_path: where to write rejected records,
+                         defaults to <path>.rejected.ndjson
+    :return: the number of Suppliers imported and of records rejected
+    '''
+    file_format = file_format or _guess_format(path)
+    rejects_path = rejects_path or path + ".rejected.ndjson"
+    workers = workers or os.cpu_count() or 1
+    rejected = 0
+
+    def copy_lines(results: Iterable[Tuple[List[tuple], List[dict]]],
+                   rejects: TextIO) -> Iterator[str]:
+        nonlocal rejected
+        for rows, errors in results:
+            for error in errors:
+                rejects.write(json.dumps(error) + "\n")
+            rejected += len(errors)
+            yield "".join(_copy_line(row) for row in rows)
+
+    logger.info("Importing suppliers from %s", path)
+    connection = db.engine.raw_connection()
+    try:
+        with open(path, newline="", encoding="utf-8") as source, \
+                open(rejects_path, "w", encoding="utf-8") as rejects, \
+                ProcessPoolExecutor(workers) as pool:
+            chunks = _chunks(_read_records(source, file_format), chunk_size)
+            results = _map_bounded(pool, validate_chunk, chunks, 2 * workers)
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TEMP TABLE {} (line bigserial, name text, email text, "
+                "address text, products {}) ON COMMIT DROP"
+                .format(STAGING_TABLE, Supplier.__table__.c.products.type
+                        .compile(dialect=db.engine.dialect)))
+            cursor.copy_expert(
+                "COPY {} ({}) FROM STDIN WITH (FORMAT csv)"
+                .format(STAGING_TABLE, ", ".join(FIELDS)),
+                _LineReader(copy_lines(results, rejects)))
+            if Supplier.products_storage == TABLE_STORAGE:
+                cursor.execute(MERGE_LINKED_SQL.format(table=Supplier.__tablename__,
+                                                       staging=STAGING_TABLE))
+                imported = cursor.fetchone()[0]
+            else:
+                cursor.execute(
+                    "INSERT INTO {table} ({fields}, products_packed) "
+                    "SELECT {columns}, {products} FROM {staging} ORDER BY line"
+                    .format(table=Supplier.__tablename__, fields=", ".join(FIELDS),
+                            columns=", ".join(FIELDS[:-1]),
+                            products=", ".join(Supplier.products_sql("products")),
+                            staging=STAGING_TABLE))
+                imported = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    logger.info("Imported %d suppliers, rejected %d", imported, rejected)
+    return imported, rejected
+
+
+def validate_chunk(chunk: Tuple[int, List[Any]]) -> Tuple[List[tuple], List[dict]]:
+    '''
+    Validates a chunk of records with the Supplier model rules
+    Runs in a worker process
+    :param chunk: the index of the first record and the records, each a
+                  dict or an NDJSON line still to be decoded
+    :return: the valid rows and the {index, record, error} rejections
+    '''
+    start, records = chunk
+    rows, errors = [], []
+    for index, record in enumerate(records, start):
+        try:
+            data = json.loads(record) if isinstance(record, str) else record
+            row = Supplier.validate_dict(data)
+        except (SupplierException, ValueError) as error:
+            errors.append({"index": index, "record": record, "error": str(error)})
+            continue
+        rows.append(tuple(row[field] for field in FIELDS))
+    return rows, errors
+
+
+@click.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="File format, guessed from the extension by default")
+@click.option("--workers", type=int, help="Number of validation processes")
+@click.option("--chunk-size", type=int, default=CHUNK_SIZE, show_default=True,
+              help="Records validated per task")
+@click.option("--rejects", "rejects_path", type=click.Path(dir_okay=False),
+              help="Where to write rejected records [default: PATH.rejected.ndjson]")
+def import_command(path, file_format, workers, chunk_size, rejects_path):
+    """Import the suppliers in a CSV or NDJSON file"""
+    imported, rejected = import_suppliers(path, file_format, workers,
+                                          chunk_size, rejects_path)
+    click.echo("Imported {} supplier(s), rejected {}".format(imported, rejected))
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+class _LineReader:
+    '''File-like adapter feeding COPY FROM STDIN from a text iterator'''
+    def __init__(self, lines: Iterator[str]) -> None:
+        self.lines = lines
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _guess_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    raise click.BadParameter("cannot guess the format of {}, use --format".format(path))
+
+
+def _read_records(source: TextIO, file_format: str) -> Iterator[Any]:
+    '''Yields CSV rows as dicts, or NDJSON lines undecoded'''
+    if file_format == "ndjson":
+        for line in source:
+            if line.strip():
+                yield line
+        return
+    for row in csv.DictReader(source):
+        record = {field: (row.get(field) or None) for field in FIELDS}
+        if record["products"] is not None:
+            # accept 1,2,3 as well as the Postgres array form {1,2,3}
+            record["products"] = record["products"].strip("{}[] ") or None
+        yield record
+
+
+def _chunks(records: Iterable[Any], size: int) -> Iterator[Tuple[int, List[Any]]]:
+    chunk, start = [], 0
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield start, chunk
+            start, chunk = start + len(chunk), []
+    if chunk:
+        yield start, chunk
+
+
+def _map_bounded(pool: Executor, func, items: Iterable, window: int) -> Iterator:
+    '''Like pool.map, in order, but with at most window tasks in flight'''
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _copy_line(row: tuple) -> str:
+    '''Formats a row for COPY ... WITH (FORMAT csv); None becomes NULL'''
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append("")
+        elif isinstance(value, list):
+            fields.append('"{' + ",".join(map(str, value)) + '}"')
+        else:
+            fields.append('"' + value.replace('"', '""') + '"')
+    return ",".join(fields) + "\n"
+
+
+if __name__ == "__main__":
+    import_command.main(prog_name="python -m service.importer")  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,91 @@
+'''
+Incremental parsers for large JSON request bodies
+
+Both parsers read a binary stream chunk by chunk and yield one
+decoded record at a time, so a request body never has to be
+held in memory as a whole
+'''
+
+import re
+import json
+import codecs
+from typing import Any, BinaryIO, Iterator, Union
+from service.supplier_exception import InvalidFormat
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_array(stream: BinaryIO,
+                    chunk_size: int = CHUNK_SIZE) -> Iterator[Any]:
+    '''
+    Yields the elements of a top-level JSON array read from stream
+    Raises InvalidFormat if the body is not a well-formed array
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos, eof = '', 0, False
+    expect = '['
+
+    def refill(size: int) -> None:
+        nonlocal buffer, pos, eof
+        chunk = stream.read(size)
+        eof = not chunk
+        try:
+            buffer = buffer[pos:] + text.decode(chunk, final=eof)
+        except UnicodeDecodeError as error:
+            raise InvalidFormat("400 BAD REQUEST: body is not UTF-8: {}".format(error))
+        pos = 0
+
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                break
+            refill(chunk_size)
+            continue
+        char = buffer[pos]
+        if expect == '[':
+            if char != '[':
+                raise InvalidFormat("400 BAD REQUEST: a JSON array is expected")
+            pos, expect = pos + 1, 'first'
+        elif expect == 'first' and char == ']':
+            pos, expect = pos + 1, 'end'
+        elif expect in ('first', 'value'):
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except ValueError as error:
+                if eof:
+                    raise InvalidFormat("400 BAD REQUEST: malformed JSON: {}".format(error))
+                # read at least as much as is buffered, so a record spanning
+                # many chunks is decoded a logarithmic number of times
+                refill(max(chunk_size, len(buffer) - pos))
+                continue
+            if end == len(buffer) and not eof:
+                refill(chunk_size)  # a number may go on in the next chunk
+                continue
+            pos, expect = end, ','
+            yield value
+        elif expect == ',':
+            if char not in ',]':
+                raise InvalidFormat("400 BAD REQUEST: ',' or ']' expected in JSON array")
+            pos, expect = pos + 1, ('value' if char == ',' else 'end')
+        else:
+            raise InvalidFormat("400 BAD REQUEST: unexpected data after JSON array")
+    if expect != 'end':
+        raise InvalidFormat("400 BAD REQUEST: JSON array is not terminated")
+
+
+def iter_ndjson(stream: BinaryIO) -> Iterator[Union[Any, InvalidFormat]]:
+    '''
+    Yields the record on each non-blank line of an NDJSON stream
+    A line that is not valid JSON yields an InvalidFormat error instead
+    of raising it, so one bad line does not reject the whole body
+    '''
+    for line in iter(stream.readline, b''):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield InvalidFormat("400 BAD REQUEST: malformed JSON: {}".format(error))
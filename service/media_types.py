@@ -0,0 +1,71 @@
+'''
+MessagePack and CBOR bodies
+
+Machine clients may send and accept application/msgpack or
+application/cbor instead of JSON, negotiated through Content-Type and
+Accept. Both formats write integers in binary, so supplier bodies
+carry their id and products as integers instead of the strings of the
+JSON model, which is where most of their size goes.
+'''
+
+from typing import Any, Callable, Dict, Optional
+import cbor2
+import msgpack
+from flask import Response, current_app
+from flask_restx import fields
+from service.supplier_exception import InvalidFormat
+
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+ENCODERS: Dict[str, Callable[[Any], bytes]] = {
+    MSGPACK: msgpack.packb,
+    CBOR: cbor2.dumps,
+}
+
+
+def _loads_cbor(body: bytes) -> Any:
+    value = cbor2.loads(body)
+    # cbor2 5 returns a stray "break" stop code instead of raising
+    if value is cbor2.break_marker:
+        raise ValueError("unexpected break stop code")
+    return value
+
+
+DECODERS: Dict[str, Callable[[bytes], Any]] = {
+    MSGPACK: msgpack.unpackb,
+    CBOR: _loads_cbor,
+}
+
+BINARY_MEDIA_TYPES = tuple(ENCODERS)
+
+
+def binary_fields(model: dict) -> dict:
+    '''The fields of a model, output with the types they are stored with'''
+    return {key: fields.Raw() for key in getattr(model, 'resolved', model)}
+
+
+def decode_body(mimetype: str, body: bytes) -> Any:
+    '''
+    Decodes a request body of one of the BINARY_MEDIA_TYPES
+    Raises InvalidFormat if it is malformed
+    '''
+    try:
+        return DECODERS[mimetype](body)
+    except (ValueError, msgpack.UnpackException, cbor2.CBORError) as error:
+        raise InvalidFormat("400 BAD REQUEST: malformed {} body: {}".format(mimetype, error))
+
+
+def _representation(mimetype: str) -> Callable[..., Response]:
+    encode = ENCODERS[mimetype]
+
+    def output(data: Any, code: int, headers: Optional[dict] = None) -> Response:
+        response = current_app.response_class(encode(data), status=code, mimetype=mimetype)
+        response.headers.extend(headers or {})
+        return response
+    output.__doc__ = 'The {} representation of the api'.format(mimetype)
+    return output
+
+
+output_msgpack = _representation(MSGPACK)
+output_cbor = _representation(CBOR)
@@ -0,0 +1,118 @@
+'''
+Prometheus metrics of the Supplier service
+
+The metrics are module-level prometheus_client collectors. Under
+gunicorn, set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py does) so each
+worker writes its values to a shared directory and GET /metrics
+aggregates every live worker, whichever one answers the scrape.
+'''
+
+import os
+from time import perf_counter
+from flask import Flask, Response, current_app, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               multiprocess)
+
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+REQUESTS = Counter(
+    "supplier_http_requests_total", "HTTP requests answered",
+    ["resource", "method", "status"])
+LATENCY = Histogram(
+    "supplier_http_request_duration_seconds",
+    "Time to answer a request (to the first byte of streamed responses)",
+    ["resource", "method"])
+RESPONSE_SIZE = Histogram(
+    "supplier_http_response_size_bytes", "Size of non-streamed response bodies",
+    ["resource", "method"],
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000, float("inf")))
+ROWS = Histogram(
+    "supplier_rows_returned", "Suppliers returned by list queries",
+    ["resource"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, float("inf")))
+ERRORS = Counter(
+    "supplier_errors_total", "Errors answered, by exception type",
+    ["exception"])
+
+DB_STATEMENTS = Histogram(
+    "supplier_db_statements", "SQL statements issued per request",
+    ["resource"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, float("inf")))
+DB_TIME = Histogram(
+    "supplier_db_time_seconds", "Time spent running SQL statements per request",
+    ["resource"])
+
+CACHE_LOOKUPS = Counter(
+    "supplier_cache_lookups_total", "Supplier cache lookups", ["result"])
+
+POOL_CHECKED_OUT = Gauge(
+    "supplier_db_pool_checked_out", "Database connections in use",
+    multiprocess_mode="livesum")
+POOL_WAIT = Histogram(
+    "supplier_db_pool_wait_seconds", "Time spent waiting for a database connection")
+POOL_CONNECT = Histogram(
+    "supplier_db_connect_seconds", "Time spent opening a database connection")
+POOL_TIMEOUTS = Counter(
+    "supplier_db_pool_timeouts_total", "Requests that found the database pool exhausted")
+
+
+def init_metrics(app: Flask) -> None:
+    '''Times every request of app and serves GET /metrics'''
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+
+def metrics_view() -> Response:
+    '''Returns every metric in the Prometheus text format'''
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def record_error(error: Exception) -> None:
+    '''Counts an error by its exception type'''
+    ERRORS.labels(type(error).__name__).inc()
+
+
+def record_rows(count: int) -> None:
+    '''Records the number of Suppliers a list query returned'''
+    ROWS.labels(_resource()).observe(count)
+
+
+def record_queries(count: int, seconds: float) -> None:
+    '''Records the SQL statements a request issued and their total time'''
+    resource = _resource()
+    DB_STATEMENTS.labels(resource).observe(count)
+    DB_TIME.labels(resource).observe(seconds)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def _resource() -> str:
+    '''Names the restx Resource class (or view) serving the request'''
+    if request.url_rule is None:
+        return "unmatched"
+    view = request.url_rule.endpoint
+    view_class = getattr(current_app.view_functions.get(view), "view_class", None)
+    return view_class.__name__ if view_class is not None else view
+
+
+def _start_timer() -> None:
+    g.request_started = perf_counter()
+
+
+def _record_request(response: Response) -> Response:
+    started = g.pop("request_started", None)
+    resource, method = _resource(), request.method
+    REQUESTS.labels(resource, method, response.status_code).inc()
+    if started is not None:
+        LATENCY.labels(resource, method).observe(perf_counter() - started)
+    if not response.is_streamed and response.content_length is not None:
+        RESPONSE_SIZE.labels(resource, method).observe(response.content_length)
+    return response
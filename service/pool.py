@@ -0,0 +1,111 @@
+'''
+Instrumented database connection pool
+
+InstrumentedQueuePool is a QueuePool that records how long requests
+wait for a connection, how long opening a new connection takes and
+how often the pool times out, so the pool can be sized against the
+Postgres max_connections limit. The figures are kept per pool for
+GET /api/stats and also exported as Prometheus metrics.
+'''
+
+import logging
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Sequence
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from service.metrics import POOL_CHECKED_OUT, POOL_CONNECT, POOL_TIMEOUTS, POOL_WAIT
+
+logger = logging.getLogger("flask.app")
+
+# upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''Thread-safe histogram of durations with fixed bucket bounds'''
+    def __init__(self, buckets: Sequence[float] = BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        '''Records one duration in seconds'''
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def snapshot(self) -> dict:
+        '''Returns the cumulative count per upper bound, the sum and the count'''
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        return {'buckets': buckets, 'sum': total, 'count': cumulative}
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''QueuePool recording checkout wait times, connect latency and timeouts'''
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.wait_time = Histogram()
+        self.connect_time = Histogram()
+        self.timeouts = 0
+
+    def _do_get(self):
+        # the wait includes opening a connection when the pool has room
+        start = perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            POOL_TIMEOUTS.inc()
+            logger.warning("Database pool exhausted: %s", self.status())
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            self.wait_time.observe(elapsed)
+            POOL_WAIT.observe(elapsed)
+        return record
+
+    def _create_connection(self):
+        start = perf_counter()
+        connection = super()._create_connection()
+        elapsed = perf_counter() - start
+        self.connect_time.observe(elapsed)
+        POOL_CONNECT.observe(elapsed)
+        return connection
+
+    def stats(self) -> dict:
+        '''Returns the current state of the pool and its histograms'''
+        return {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow,
+            'timeouts': self.timeouts,
+            'wait_seconds': self.wait_time.snapshot(),
+            'connect_seconds': self.connect_time.snapshot(),
+        }
+
+
+# The connections in use are counted with the pool events: a detached
+# connection, like the one the cache listener keeps, is never checked in
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def _checkout(*_):
+    POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(InstrumentedQueuePool, "checkin")
+def _checkin(*_):
+    POOL_CHECKED_OUT.dec()
+
+
+@event.listens_for(InstrumentedQueuePool, "detach")
+def _detach(*_):
+    POOL_CHECKED_OUT.dec()
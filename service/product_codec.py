@@ -0,0 +1,113 @@
+'''
+Compact encoding of product id lists
+
+A catalogue is stored as its sorted ids, each written as the
+difference from the previous one in LEB128 varint form: 7 bits per
+byte, the high bit set on every byte but the last of a number. Dense
+catalogues take one or two bytes per product instead of the eight of a
+bigint[] element. The encoding is canonical, so two catalogues are
+equal exactly when their encodings are.
+
+PACK_SQL and UNPACK_SQL create the same functions in Postgres, so the
+SQL statements can rewrite packed catalogues in place. CATALOGUE_SQL
+reads the catalogue of a row whichever way it is stored; the product
+lookups and their GIN index all go through it. It names the schema of
+the unpack function (its {schema} placeholder), as the index is also
+evaluated under other search_paths: autovacuum, pg_restore.
+'''
+
+from typing import Iterable, List
+
+PACK_FUNCTION = "supplier_pack_products"
+UNPACK_FUNCTION = "supplier_unpack_products"
+CATALOGUE_FUNCTION = "supplier_products"
+
+PACK_SQL = """
+CREATE OR REPLACE FUNCTION {name}(products bigint[]) RETURNS bytea
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    bytes text[] := '{{}}';
+    previous bigint := 0;
+    product bigint;
+    delta bigint;
+    hex text;
+BEGIN
+    FOREACH product IN ARRAY products LOOP
+        delta := product - previous;
+        previous := product;
+        hex := '';
+        WHILE delta >= 128 LOOP
+            hex := hex || lpad(to_hex(delta & 127 | 128), 2, '0');
+            delta := delta >> 7;
+        END LOOP;
+        bytes := bytes || (hex || lpad(to_hex(delta), 2, '0'));
+    END LOOP;
+    RETURN decode(array_to_string(bytes, ''), 'hex');
+END
+$$
+""".format(name=PACK_FUNCTION)
+
+UNPACK_SQL = """
+CREATE OR REPLACE FUNCTION {name}(packed bytea) RETURNS bigint[]
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    -- fetched from TOAST once here, instead of by every get_byte()
+    bytes bytea := substring(packed FROM 1);
+    products bigint[] := '{{}}';
+    product bigint := 0;
+    delta bigint := 0;
+    shift integer := 0;
+    byte integer;
+BEGIN
+    FOR i IN 0 .. length(bytes) - 1 LOOP
+        byte := get_byte(bytes, i);
+        delta := delta | ((byte & 127)::bigint << shift);
+        IF byte < 128 THEN
+            product := product + delta;
+            products := products || product;
+            delta := 0;
+            shift := 0;
+        ELSE
+            shift := shift + 7;
+        END IF;
+    END LOOP;
+    RETURN products;
+END
+$$
+""".format(name=UNPACK_FUNCTION)
+
+CATALOGUE_SQL = """
+CREATE OR REPLACE FUNCTION {{schema}}.{name}(products bigint[], packed bytea) RETURNS bigint[]
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+SELECT coalesce(products, {{schema}}.{unpack}(packed))
+$$
+""".format(name=CATALOGUE_FUNCTION, unpack=UNPACK_FUNCTION)
+
+
+def pack(product_ids: Iterable[int]) -> bytes:
+    '''Encodes sorted, distinct, positive product ids'''
+    packed = bytearray()
+    previous = 0
+    for product_id in product_ids:
+        delta = product_id - previous
+        previous = product_id
+        while delta >= 0x80:
+            packed.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        packed.append(delta)
+    return bytes(packed)
+
+
+def unpack(packed: bytes) -> List[int]:
+    '''Decodes the product ids encoded by pack()'''
+    product_ids = []
+    product = delta = shift = 0
+    for byte in packed:
+        delta |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            product += delta
+            product_ids.append(product)
+            delta = shift = 0
+        else:
+            shift += 7
+    return product_ids
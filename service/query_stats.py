@@ -0,0 +1,134 @@
+'''
+SQL statement instrumentation
+
+Engine events count the statements each request issues and the time
+spent running them. The totals so far are sent in a Server-Timing
+header, and the totals of the whole request (streamed bodies included)
+are logged and exported as metrics once it ends. Statements slower
+than SLOW_QUERY_SECONDS are logged with their normalized SQL and the
+shape of their parameters, never their values, and a request issuing
+more than QUERY_BUDGET statements is logged as a warning.
+'''
+
+import re
+import logging
+from time import perf_counter
+from flask import Flask, Response, current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.metrics import record_queries
+
+logger = logging.getLogger("flask.app")
+
+SLOW_QUERY_SECONDS = 0.5
+QUERY_BUDGET = 20
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.%])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"\(\s*%\(\w+\)s(?:\s*,\s*%\(\w+\)s)*\s*\)")
+_ROWS = re.compile(r"\(\.\.\.\)(?:, \(\.\.\.\))+")
+
+
+def init_query_stats(app: Flask) -> None:
+    '''Counts the SQL statements of every request of app'''
+    if not event.contains(Engine, "before_cursor_execute", _before_execute):
+        event.listen(Engine, "before_cursor_execute", _before_execute)
+        event.listen(Engine, "after_cursor_execute", _after_execute)
+        event.listen(Engine, "handle_error", _failed_execute)
+    app.before_request(_start_request)
+    app.after_request(_add_server_timing)
+    app.teardown_request(_report_request)
+
+
+def normalize_sql(statement: str) -> str:
+    '''
+    Returns statement on one line with its literals replaced by ? and
+    its lists of placeholders and of VALUES rows collapsed, so the
+    statements of a same query compare equal whatever their arguments
+    '''
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _STRING.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _PLACEHOLDERS.sub("(...)", statement)
+    return _ROWS.sub("(...), ...", statement)
+
+
+def parameters_shape(parameters, executemany: bool = False) -> str:
+    '''Describes the names and types of the parameters, not their values'''
+    if executemany:
+        rows = list(parameters or ())
+        return "{} x {}".format(len(rows), _shape(rows[0]) if rows else "()")
+    return _shape(parameters)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def _shape(parameters) -> str:
+    if isinstance(parameters, dict):
+        return "{" + ", ".join("{}: {}".format(name, _type(value))
+                               for name, value in sorted(parameters.items())) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(_type(value) for value in parameters) + ")"
+    return _type(parameters)
+
+
+def _type(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return "{}[{}]".format(type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def _config(name: str, default):
+    return current_app.config.get(name, default) if has_app_context() else default
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    conn.info.setdefault("query_started", []).append(perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    elapsed = perf_counter() - conn.info["query_started"].pop()
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+    if elapsed >= _config("SLOW_QUERY_SECONDS", SLOW_QUERY_SECONDS):
+        logger.warning("Slow query (%.1f ms): %s parameters %s", elapsed * 1000,
+                       normalize_sql(statement), parameters_shape(parameters, executemany))
+
+
+def _failed_execute(context) -> None:
+    started = context.connection.info.get("query_started") if context.connection else None
+    if started:
+        started.pop()
+
+
+def _start_request() -> None:
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+def _add_server_timing(response: Response) -> Response:
+    if "sql_statements" in g:
+        response.headers.add("Server-Timing", 'db;dur={:.1f};desc="{} statements"'.format(
+            g.sql_seconds * 1000, g.sql_statements))
+    return response
+
+
+def _report_request(error=None) -> None:
+    # pylint: disable=unused-argument
+    # teardown runs once a streamed body has been sent
+    statements = g.pop("sql_statements", None)
+    if statements is None:
+        return
+    seconds = g.pop("sql_seconds")
+    record_queries(statements, seconds)
+    logger.info("%s %s: %d SQL statements in %.1f ms",
+                request.method, request.full_path.rstrip("?"), statements, seconds * 1000)
+    budget = _config("QUERY_BUDGET", QUERY_BUDGET)
+    if budget and statements > budget:
+        logger.warning("%s %s issued %d SQL statements, over the budget of %d",
+                       request.method, request.url_rule or request.path, statements, budget)
@@ -3,25 +3,53 @@ Supplier Store Service
 
 Paths:
 ------
-GET /suppliers - Returns a list all of the Suppliers
+GET /suppliers - Returns a page of the Suppliers (see limit/after),
+                 streams all of them as NDJSON, or searches them (q)
 GET /suppliers/{id} - Returns the Supplier with a given id number
 POST /suppliers - creates a new Supplier record in the database
 PUT /suppliers/{id} - updates a Supplier record in the database
 DELETE /suppliers/{id} - deletes a Supplier record in the database
+PATCH /suppliers?... - updates every Supplier matching the filters
+DELETE /suppliers?... - deletes every Supplier matching the filters
+POST /suppliers:bulk - creates many Suppliers from a JSON array or NDJSON body
+GET /suppliers:export - streams a point-in-time CSV or NDJSON export
+POST /suppliers/{id}/products - adds products to a Supplier
+DELETE /suppliers/{id}/products - removes products from a Supplier
+GET /products/{product_id}/suppliers - Returns the Suppliers carrying a product
+GET /products/suppliers - Maps several products to the ids of their Suppliers
+DELETE /products/suppliers - removes products from every Supplier carrying them
+GET /stats - Returns the connection pool and cache statistics of the worker
 """
 
+import os
 import json
-from typing import Tuple
-from flask import Response, request
-from werkzeug.exceptions import abort, BadRequest
+import base64
+import hashlib
+import binascii
+from datetime import datetime
+from typing import Any, Iterable, Iterator, List, Mapping, Optional, Tuple
+from urllib.parse import urlencode
+from flask import Response, request, stream_with_context
+from werkzeug.exceptions import abort, BadRequest, NotFound
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag
 from flask_restx import Api, Resource, fields, reqparse
 from service import status, app
-from service.supplier import Supplier
+from service.supplier import Supplier, db
+from service.pool import InstrumentedQueuePool
+from service.metrics import record_error, record_rows
+from service.cache import supplier_cache
+from service.json_stream import iter_json_array, iter_ndjson
+from service.exporter import iter_export
+from service.fast_json import compile_model, dumps_line, output_json
+from service.media_types import MSGPACK, CBOR, BINARY_MEDIA_TYPES, binary_fields, \
+    decode_body, output_msgpack, output_cbor
 from service.supplier_exception \
     import DuplicateProduct, MissingInfo, WrongArgType, \
-    UserDefinedIdError, OutOfRange, InvalidFormat
+    UserDefinedIdError, OutOfRange, InvalidFormat, VersionConflict
 
 BASE_URL = "/suppliers"
+PRODUCTS_URL = "/products"
+NDJSON = "application/x-ndjson"
 
 
 ######################################################################
@@ -36,7 +64,14 @@ def index_api() -> Tuple[Response, int]:
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
-api = Api(app,
+class SupplierApi(Api):
+    """ Api counting the errors it answers by exception type """
+    def handle_error(self, e):
+        record_error(e)
+        return super().handle_error(e)
+
+
+api = SupplierApi(app,
           version='1.0.0',
           title='Suppliers REST API Service',
           description='This is the Supplier service server.',
@@ -45,6 +80,21 @@ api = Api(app,
           doc='/apidocs',  # default also could use doc='/apidocs/'
           prefix='/api'
          )
+api.representations['application/json'] = output_json
+api.representations[MSGPACK] = output_msgpack
+api.representations[CBOR] = output_cbor
+
+# The ETag of a MessagePack or CBOR body is the one of its JSON body
+# tagged with the format, so that each representation has its own
+ETAG_SUFFIXES = {MSGPACK: 'msgpack', CBOR: 'cbor'}
+
+
+@app.after_request
+def vary_on_accept(response: Response) -> Response:
+    """Tells caches that the api answers in the media type Accept picks"""
+    if request.path.startswith(api.prefix):
+        response.vary.add('Accept')
+    return response
 
 
 products_list = api.model('Products', {
@@ -64,6 +114,50 @@ create_model = api.model('Supplier',
     }
 )
 
+product_ids_list = api.model('ProductIds', {
+    'products': fields.List(fields.Integer, required=True,
+                            description='The product ids to look up')
+})
+
+supplier_ids_by_product = api.model('SupplierIdsByProduct', {
+    'suppliers': fields.Raw(description='Maps each product id to the ids '
+                                        'of the Suppliers carrying it')
+})
+
+field_error_model = api.model('FieldError', {
+    'field': fields.String(description='The invalid field'),
+    'message': fields.String(description='Why the field is invalid'),
+})
+
+bulk_error_model = api.model('BulkError', {
+    'index': fields.Integer(description='The position of the rejected record'),
+    'message': fields.String(description='Why the record was rejected'),
+    'errors': fields.List(fields.Nested(field_error_model),
+                          description='Every invalid field of the record'),
+})
+
+bulk_result_model = api.model('BulkResult', {
+    'created': fields.Integer(description='The number of Suppliers created'),
+    'ids': fields.List(fields.Integer, description='The ids of the created Suppliers'),
+    'errors': fields.List(fields.Nested(bulk_error_model)),
+})
+
+update_model = api.model('SupplierUpdate', {
+    'name': fields.String(description='The new name of the Suppliers'),
+    'email': fields.String(description='The new email of the Suppliers'),
+    'address': fields.String(description='The new address of the Suppliers'),
+    'products': fields.List(fields.Integer,
+                            description='The new products of the Suppliers'),
+})
+
+deleted_model = api.model('DeletedSuppliers', {
+    'deleted': fields.Integer(description='The number of Suppliers deleted'),
+})
+
+updated_model = api.model('UpdatedSuppliers', {
+    'updated': fields.Integer(description='The number of Suppliers updated'),
+})
+
 supplier_model = api.inherit(
     'SupplierModel',
     create_model,
@@ -74,12 +168,82 @@ supplier_model = api.inherit(
 )
 
 
+removed_products_model = api.inherit('RemovedProducts', supplier_model, {
+    'missing': fields.List(fields.Integer,
+                           description='The products the Supplier did not carry'),
+})
+
+# marshal() of the hot endpoints, with the fields resolved once; the
+# binary media types keep id and products as integers
+marshal_suppliers = compile_model(supplier_model)
+marshal_removed_products = compile_model(removed_products_model)
+binary_suppliers = compile_model(binary_fields(supplier_model))
+binary_removed_products = compile_model(binary_fields(removed_products_model))
+
+products_removed_model = api.model('ProductsRemoved', {
+    'updated': fields.Integer(description='The number of Suppliers updated'),
+    'missing': fields.List(fields.Integer,
+                           description='The products no Supplier carried'),
+})
+
+
+stats_model = api.model('Stats', {
+    'pid': fields.Integer(description='The process id of the worker'),
+    'pool': fields.Raw(description='Database pool state, wait and connect '
+                                   'time histograms (in seconds) and timeouts'),
+    'cache': fields.Raw(description='Supplier cache size and hit/miss counters'),
+})
+
+
 # query string arguments
-supplier_args = reqparse.RequestParser()
-supplier_args.add_argument('name', type=str, required=False, help='List Suppliers by name')
-supplier_args.add_argument('email', type=str, required=False, help='List Suppliers by email')
-supplier_args.add_argument('address', type=str, required=False, help='List Suppliers by address')
-supplier_args.add_argument('products', type=str, required=False, help='List Suppliers by products')
+filter_args = reqparse.RequestParser()
+filter_args.add_argument('name', type=str, required=False, help='List Suppliers by name')
+filter_args.add_argument('email', type=str, required=False, help='List Suppliers by email')
+filter_args.add_argument('address', type=str, required=False, help='List Suppliers by address')
+filter_args.add_argument('products', type=str, required=False, help='List Suppliers by products')
+filter_args.add_argument('products_any', type=str, required=False,
+                         help='List Suppliers carrying any of these products')
+filter_args.add_argument('products_all', type=str, required=False,
+                         help='List Suppliers carrying all of these products')
+
+supplier_args = filter_args.copy()
+supplier_args.add_argument('limit', type=int, required=False,
+                           help='Maximum number of Suppliers per page')
+supplier_args.add_argument('after', type=str, required=False,
+                           help='Opaque cursor from the Link header of the previous page')
+supplier_args.add_argument('q', type=str, required=False,
+                           help='Search names and addresses by trigram similarity; '
+                                'the results are ranked and not paged')
+supplier_args.add_argument('threshold', type=float, required=False,
+                           help='Minimum similarity (0 to 1) of a search result')
+
+page_args = reqparse.RequestParser()
+page_args.add_argument('limit', type=int, required=False,
+                       help='Maximum number of Suppliers per page')
+page_args.add_argument('after', type=str, required=False,
+                       help='Opaque cursor from the Link header of the previous page')
+
+bulk_filter_args = filter_args.copy()
+bulk_filter_args.add_argument('all', type=str, required=False,
+                              help='Set to true to act on every Supplier '
+                                   'when no filter is given')
+
+bulk_args = reqparse.RequestParser()
+bulk_args.add_argument('mode', type=str, required=False,
+                       choices=('atomic', 'best-effort'), default='atomic',
+                       help='atomic creates nothing if any record is invalid, '
+                            'best-effort creates every valid record')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', type=str, required=False,
+                         choices=('csv', 'ndjson'), default='csv',
+                         help='The export file format')
+export_args.add_argument('gzip', type=str, required=False,
+                         help='Set to true to gzip the export')
+
+product_ids_args = reqparse.RequestParser()
+product_ids_args.add_argument('products', type=str, required=False,
+                              help='Comma separated product ids to look up')
 
 ######################################################################
 # Special Error Handlers
@@ -92,7 +256,8 @@ def request_invalidformat_error(error):
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': '400 BAD REQUEST',
-        'message': message
+        'message': message,
+        'errors': list(error.errors)
     }, status.HTTP_400_BAD_REQUEST
 
 @api.errorhandler(DuplicateProduct)
@@ -114,7 +279,8 @@ def request_missinginfo_error(error):
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': '400 BAD REQUEST',
-        'message': message
+        'message': message,
+        'errors': list(error.errors)
     }, status.HTTP_400_BAD_REQUEST
 
 @api.errorhandler(WrongArgType)
@@ -125,7 +291,8 @@ def request_wrongargtype_error(error):
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': '400 BAD REQUEST',
-        'message': message
+        'message': message,
+        'errors': list(error.errors)
     }, status.HTTP_400_BAD_REQUEST
 
 @api.errorhandler(UserDefinedIdError)
@@ -136,7 +303,8 @@ def request_userdefinedIderror_error(error):
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': '400 BAD REQUEST',
-        'message': message
+        'message': message,
+        'errors': list(error.errors)
     }, status.HTTP_400_BAD_REQUEST
 
 @api.errorhandler(OutOfRange)
@@ -147,10 +315,23 @@ def request_outofrange_error(error):
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': '400 BAD REQUEST',
-        'message': message
+        'message': message,
+        'errors': list(error.errors)
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(VersionConflict)
+def request_versionconflict_error(error):
+    """ Handles writes made against an outdated version """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': '412 PRECONDITION FAILED',
+        'message': message
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+
 ######################################################################
 #  PATH: /suppliers/{id}
 ######################################################################
@@ -172,17 +353,39 @@ class SupplierResource(Resource):
     @api.doc('get_suppliers')
     @api.response(404, 'Supplier Not Found')
     @api.response(400, 'Bad ID Type')
-    @api.response(200, '')
-    @api.marshal_with(supplier_model)
+    @api.response(304, 'Not Modified')
+    @api.response(200, '', supplier_model)
     def get(self, supplier_id) -> Tuple[Response, int]:
-        """ Read a supplier and return the supplier as a dict """
+        """
+        Read a supplier and return the supplier as a dict
+        Answers If-None-Match / If-Modified-Since with 304 when the
+        supplier has not changed, without loading it
+        """
         supplier_id = convert_id_to_int(supplier_id)
         app.logger.info('Reads a supplier with id: {}'.format(supplier_id))
-        supplier_info = {'id': supplier_id}
-        supplier = Supplier.find_first(supplier_info)
-        app.logger.info("Returning suppliers: %s", supplier.name)
-        message = supplier.serialize_to_dict()
-        return message, status.HTTP_200_OK
+        message = supplier_cache.get(supplier_id)
+        cache_status = 'HIT'
+        if message is None:
+            cache_status = 'MISS'
+            version = Supplier.find_version(supplier_id) \
+                if is_conditional_request() else None
+            if version is not None:
+                headers = supplier_validators(*version, negotiated_mimetype())
+                if is_not_modified(headers):
+                    return not_modified_response(headers)
+            token = supplier_cache.begin()
+            supplier_info = {'id': supplier_id}
+            supplier = Supplier.find_first(supplier_info)
+            app.logger.info("Returning suppliers: %s", supplier.name)
+            message = dict(supplier.serialize_to_dict(), version=supplier.version,
+                           updated_at=supplier.updated_at)
+            supplier_cache.put(supplier_id, message, token)
+        headers = supplier_validators(message['version'], message['updated_at'],
+                                      negotiated_mimetype())
+        if is_not_modified(headers):
+            return not_modified_response(headers)
+        headers['X-Cache'] = cache_status
+        return suppliers_body(message), status.HTTP_200_OK, headers
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING SUPPLIER
@@ -190,24 +393,25 @@ class SupplierResource(Resource):
     @api.doc('update_suppliers')
     @api.response(404, 'Supplier Not Found')
     @api.response(400, 'Invalid Attributes')
-    @api.response(200, '')
+    @api.response(412, 'If-Match Does Not Match The Supplier Version')
+    @api.response(200, '', supplier_model)
     @api.expect(supplier_model)
-    @api.marshal_with(supplier_model)
     def put(self, supplier_id: int) -> Tuple[Response, int]:
         """
         Updates a supplier with the provided supplier id
         Returns the updated supplier
+        With If-Match, only updates the supplier at that ETag (version)
         """
         supplier_id = convert_id_to_int(supplier_id)
-        check_content_type_is_json()
-        request_body = api.payload
+        request_body = read_payload()
         app.logger.info("request body: {}".format(request_body))
         supplier_info = {'id': supplier_id}
         supplier = Supplier.find_first(supplier_info)
-        supplier.update(request_body)
+        supplier.update(request_body, expected_version())
         message = supplier.serialize_to_dict()
 
-        return message, status.HTTP_200_OK
+        return suppliers_body(message), status.HTTP_200_OK, \
+            supplier_validators(supplier.version, supplier.updated_at, negotiated_mimetype())
 
     #------------------------------------------------------------------
     # DELETE A SUPPLIER
@@ -241,64 +445,173 @@ class SupplierCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_suppliers_by_attributes')
     @api.expect(supplier_args, validate=True)
-    @api.response(200, '')
+    @api.response(200, '', [supplier_model])
+    @api.response(304, 'Not Modified')
     @api.response(404, 'Supplier Not Found')
     @api.response(400, 'Invalid Attributes')
-    @api.marshal_list_with(supplier_model)
+    @api.produces(['application/json', NDJSON, MSGPACK, CBOR])
     def get(self) -> Tuple[Response, int]:
         """ Reads suppliers satisfying required attributes
-            and returns the suppliers as a dict """
-        supplier_info = {}
-        try:
-            supplier_info['id'] = request.args.get('id')
-            if supplier_info['id'] is not None:
-                supplier_info['id'] = int(supplier_info['id'])
-        except ValueError:
-            raise BadRequest('400 BAD REQUEST. Wrong ID type')
-        supplier_info['name'] = request.args.get('name')
-        supplier_info['email'] = request.args.get('email')
-        supplier_info['address'] = request.args.get('address')
-        supplier_info['products'] = None
-        try:
-            supplier_info['products'] = request.args.get('products')
-            if supplier_info['products'] is not None:
-                supplier_info['products'] =\
-                    [int(x) for x in supplier_info['products'].split(',')]
-        except ValueError:
-            raise BadRequest('400 BAD REQUEST. Wrong Products type')
-        if not any(supplier_info.values()):
-            suppliers = Supplier.list()
-            app.logger.info("List all {} suppliers".format(len(suppliers)))
-        else:
-            suppliers = Supplier.find_all(supplier_info)
-            app.logger.info('Reads a supplier with {}'.
+            and returns the suppliers as a dict
+
+            Results are paged by id. When more suppliers remain, a
+            Link header with rel="next" points at the following page.
+            With Accept: application/x-ndjson every matching supplier is
+            streamed instead, one JSON object per line.
+            A page is answered with 304 when it matches If-None-Match.
+            With q, the suppliers whose name or address resemble q are
+            returned instead, most similar first.
+        """
+        supplier_info = parse_supplier_filters()
+        if request.args.get('q') is not None:
+            return search_suppliers(supplier_info)
+        after, limit = parse_page_args()
+        if wants_ndjson():
+            app.logger.info('Streams suppliers with {}'.
                             format(json.dumps(supplier_info)))
+            suppliers = Supplier.stream(supplier_info, after,
+                                        app.config['STREAM_BATCH_SIZE'])
+            return Response(stream_with_context(
+                ndjson_lines(suppliers, app.config['STREAM_BATCH_SIZE'])),
+                            status=status.HTTP_200_OK, mimetype=NDJSON)
+        unchanged = check_page_not_modified(supplier_info, after, limit)
+        if unchanged is not None:
+            return unchanged
+        suppliers, headers = find_page_of_suppliers(supplier_info, after, limit)
+        if not suppliers and after is None and any(supplier_info.values()):
+            raise NotFound("404 NOT FOUND")
+        app.logger.info('Reads a page of {} supplier(s) with {}'.
+                        format(len(suppliers), json.dumps(supplier_info)))
         message = [supplier.serialize_to_dict() for supplier in suppliers]
         app.logger.info("Returning supplier(s): {}".
                         format(", ".join(s.name for s in suppliers)))
-        return message, status.HTTP_200_OK
+        return suppliers_body(message), status.HTTP_200_OK, headers
+
+
+    #------------------------------------------------------------------
+    # UPDATE SUPPLIERS BY ATTRIBUTES
+    #------------------------------------------------------------------
+    @api.doc('update_suppliers_by_attributes')
+    @api.expect(bulk_filter_args, update_model)
+    @api.response(200, '', updated_model)
+    @api.response(400, 'Invalid Attributes or No Filter')
+    def patch(self) -> Tuple[Response, int]:
+        """
+        Updates every supplier satisfying the filters in one statement
+        Returns the number of suppliers updated
+        """
+        request_body = read_payload()
+        supplier_info = parse_bulk_filters()
+        app.logger.info("Updates suppliers with {} to {}".
+                        format(json.dumps(supplier_info), request_body))
+        count = Supplier.update_where(supplier_info, request_body)
+        return {'updated': count}, status.HTTP_200_OK
 
+    #------------------------------------------------------------------
+    # DELETE SUPPLIERS BY ATTRIBUTES
+    #------------------------------------------------------------------
+    @api.doc('delete_suppliers_by_attributes')
+    @api.expect(bulk_filter_args)
+    @api.response(200, '', deleted_model)
+    @api.response(400, 'Invalid Attributes or No Filter')
+    def delete(self) -> Tuple[Response, int]:
+        """
+        Deletes every supplier satisfying the filters in one statement
+        Returns the number of suppliers deleted
+        """
+        supplier_info = parse_bulk_filters()
+        app.logger.info("Deletes suppliers with {}".format(json.dumps(supplier_info)))
+        count = Supplier.delete_where(supplier_info)
+        return {'deleted': count}, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # ADD A NEW SUPPLIER
     #------------------------------------------------------------------
     @api.doc('create_suppliers')
-    @api.response(201, '')
+    @api.response(201, '', supplier_model)
     @api.response(400, 'Invalid Attributes')
     @api.expect(create_model)
-    @api.marshal_with(supplier_model, code=201)
     def post(self) -> Tuple[Response, int]:
         """ Create a supplier and return the supplier as a dict """
-        check_content_type_is_json()
-        request_body = api.payload
+        request_body = read_payload()
         app.logger.info("request body: {}".format(request_body))
 
         new_supplier = Supplier.deserialize_from_dict(request_body)
         new_supplier.create()
         message = new_supplier.serialize_to_dict()
         app.logger.info("created new supplier with id {}".format(new_supplier.id))
+        return suppliers_body(message), status.HTTP_201_CREATED
+
+######################################################################
+#  PATH: /suppliers:bulk
+######################################################################
+@api.route(BASE_URL + ':bulk')
+class SupplierBulkResource(Resource):
+    """ Creates many Suppliers in one request """
+    @api.doc('bulk_create_suppliers')
+    @api.expect(bulk_args, validate=True)
+    @api.response(201, '', bulk_result_model)
+    @api.response(400, 'Invalid Attributes', bulk_result_model)
+    @api.response(415, 'Unsupported Content-Type')
+    def post(self) -> Tuple[Response, int]:
+        """
+        Creates the suppliers in a JSON array or NDJSON request body
+        The body is parsed incrementally and inserted in batches.
+        Rejected records are reported by their index in the body.
+        """
+        mode = request.args.get('mode', 'atomic')
+        if mode not in ('atomic', 'best-effort'):
+            raise BadRequest("400 BAD REQUEST: mode must be atomic or best-effort")
+        if request.mimetype == NDJSON:
+            records = iter_ndjson(request.stream)
+        elif request.mimetype == "application/json":
+            records = iter_json_array(request.stream)
+        else:
+            app.logger.error("Invalid Content-Type: %s", request.mimetype)
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                  "Content-Type must be application/json or {}".format(NDJSON))
+        created, errors = Supplier.bulk_create(records, mode == 'atomic',
+                                               app.config['BULK_BATCH_SIZE'])
+        app.logger.info("bulk created {} supplier(s), rejected {}".
+                        format(len(created), len(errors)))
+        message = {'created': len(created), 'ids': created, 'errors': errors}
+        if errors and not created:
+            return message, status.HTTP_400_BAD_REQUEST
         return message, status.HTTP_201_CREATED
 
+
+######################################################################
+#  PATH: /suppliers:export
+######################################################################
+@api.route(BASE_URL + ':export')
+class SupplierExportResource(Resource):
+    """ Exports every Supplier from a consistent snapshot """
+    @api.doc('export_suppliers')
+    @api.expect(export_args, validate=True)
+    @api.response(200, 'The export file')
+    @api.response(400, 'Invalid format')
+    @api.produces(['text/csv', NDJSON, 'application/gzip'])
+    def get(self) -> Response:
+        """
+        Streams every supplier as CSV or NDJSON
+        The rows come from one REPEATABLE READ snapshot through a
+        server-side cursor, so the file is point-in-time consistent
+        """
+        file_format = request.args.get('format', 'csv')
+        if file_format not in ('csv', 'ndjson'):
+            raise BadRequest("400 BAD REQUEST: format must be csv or ndjson")
+        compress = request.args.get('gzip', '').lower() == 'true'
+        filename = 'suppliers.' + file_format + ('.gz' if compress else '')
+        mimetype = 'application/gzip' if compress else \
+            ('text/csv' if file_format == 'csv' else NDJSON)
+        app.logger.info("Exports suppliers to {}".format(filename))
+        return Response(stream_with_context(
+            iter_export(file_format, compress, app.config['STREAM_BATCH_SIZE'])),
+                        status=status.HTTP_200_OK, mimetype=mimetype,
+                        headers={'Content-Disposition':
+                                 'attachment; filename=' + filename})
+
+
 ######################################################################
 #  PATH: /suppliers/{id}/products
 ######################################################################
@@ -306,28 +619,163 @@ class SupplierCollection(Resource):
 @api.param('supplier_id', 'The Supplier identifier')
 @api.expect(products_list)
 class AddProductsResource(Resource):
-    """ Add products to a Supplier """
+    """ Add products to, or remove products from, a Supplier """
     @api.doc('add_products_to_suppliers')
     @api.response(200, '')
     @api.response(404, 'Supplier Not Found')
     @api.response(400, 'Invalid products')
+    @api.response(412, 'If-Match Does Not Match The Supplier Version')
     def post(self, supplier_id: int) -> Tuple[Response, int]:
         """
         Adds the provided list of products to a supplier
         Returns the updated supplier
+        With If-Match, only updates the supplier at that ETag (version)
         """
         supplier_id = convert_id_to_int(supplier_id)
-        check_content_type_is_json()
-        request_body = api.payload
+        request_body = read_payload()
         app.logger.info("request body: {}".format(request_body))
-        supplier = Supplier.find_first({'id': supplier_id})
         try:
-            supplier.add_products(request_body["products"])
-            message = supplier.serialize_to_dict()
-            message['products'] = '['+', '.join(str(i) for i in message['products'])+']'
-            return message, status.HTTP_200_OK
-        except KeyError:
+            products = request_body["products"]
+        except (KeyError, TypeError):
             raise BadRequest("400 BAD REQUEST: products not provided")
+        message = Supplier.add_products_by_id(supplier_id, products, expected_version())
+        headers = supplier_validators(message.pop('version'), message.pop('updated_at'),
+                                      negotiated_mimetype())
+        if not wants_binary():
+            message['products'] = '['+', '.join(str(i) for i in message['products'])+']'
+        return message, status.HTTP_200_OK, headers
+
+    @api.doc('remove_products_from_suppliers')
+    @api.expect(product_ids_args, product_ids_list)
+    @api.response(200, '', removed_products_model)
+    @api.response(404, 'Supplier Not Found')
+    @api.response(400, 'Invalid products')
+    @api.response(412, 'If-Match Does Not Match The Supplier Version')
+    def delete(self, supplier_id: int) -> Tuple[Response, int]:
+        """
+        Removes products, from the query string or the request body,
+        from a supplier
+        Returns the updated supplier and the products it did not carry
+        With If-Match, only updates the supplier at that ETag (version)
+        """
+        supplier_id = convert_id_to_int(supplier_id)
+        products = read_product_ids()
+        app.logger.info("Removes products {} from supplier {}".format(products, supplier_id))
+        message, missing = Supplier.remove_products_by_id(supplier_id, products,
+                                                          expected_version())
+        headers = supplier_validators(message.pop('version'), message.pop('updated_at'),
+                                      negotiated_mimetype())
+        message['missing'] = missing
+        message = binary_removed_products(message) if wants_binary() \
+            else marshal_removed_products(message)
+        return message, status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /products/{product_id}/suppliers
+######################################################################
+@api.route(PRODUCTS_URL + '/<product_id>/suppliers')
+@api.param('product_id', 'The product identifier')
+class ProductSuppliersResource(Resource):
+    """ Finds the Suppliers carrying a product """
+    @api.doc('list_suppliers_of_product')
+    @api.expect(page_args, validate=True)
+    @api.response(200, '', [supplier_model])
+    @api.response(304, 'Not Modified')
+    @api.response(400, 'Bad ID Type')
+    def get(self, product_id: int) -> Tuple[Response, int]:
+        """
+        Reads a page of the suppliers carrying the product
+        Paged like the supplier collection
+        """
+        product_id = convert_id_to_int(product_id)
+        after, limit = parse_page_args()
+        supplier_info = {'products_all': [product_id]}
+        unchanged = check_page_not_modified(supplier_info, after, limit)
+        if unchanged is not None:
+            return unchanged
+        suppliers, headers = find_page_of_suppliers(supplier_info, after, limit)
+        app.logger.info("Returning {} supplier(s) of product {}".
+                        format(len(suppliers), product_id))
+        message = [supplier.serialize_to_dict() for supplier in suppliers]
+        return suppliers_body(message), status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /products/suppliers
+######################################################################
+@api.route(PRODUCTS_URL + '/suppliers')
+class ProductSuppliersBatchResource(Resource):
+    """ Finds the Suppliers of many products in one round trip """
+    @api.doc('map_products_to_suppliers')
+    @api.expect(product_ids_args, validate=True)
+    @api.response(400, 'Invalid products')
+    @api.marshal_with(supplier_ids_by_product)
+    def get(self) -> Tuple[Response, int]:
+        """ Maps the products in the query string to their supplier ids """
+        try:
+            product_ids = [int(x) for x in request.args.get('products', '').split(',')]
+        except ValueError:
+            raise BadRequest('400 BAD REQUEST. Wrong Products type')
+        return self._lookup(product_ids)
+
+    @api.doc('map_many_products_to_suppliers')
+    @api.expect(product_ids_list)
+    @api.response(400, 'Invalid products')
+    @api.marshal_with(supplier_ids_by_product)
+    def post(self) -> Tuple[Response, int]:
+        """ Maps the products in the request body to their supplier ids """
+        check_content_type_is_json()
+        product_ids = api.payload.get('products') \
+            if isinstance(api.payload, dict) else None
+        if not isinstance(product_ids, list) or \
+                not all(isinstance(x, int) for x in product_ids):
+            raise BadRequest('400 BAD REQUEST: a list of product ids is required')
+        return self._lookup(product_ids)
+
+    @api.doc('remove_products_from_all_suppliers')
+    @api.expect(product_ids_args, product_ids_list)
+    @api.response(400, 'Invalid products')
+    @api.marshal_with(products_removed_model)
+    def delete(self) -> Tuple[Response, int]:
+        """
+        Removes products, from the query string or the request body,
+        from every supplier carrying them
+        """
+        products = read_product_ids()
+        updated, missing = Supplier.remove_products_from_all(products)
+        app.logger.info("Removed products from {} supplier(s)".format(updated))
+        return {'updated': updated, 'missing': missing}, status.HTTP_200_OK
+
+    @staticmethod
+    def _lookup(product_ids: List[int]) -> Tuple[dict, int]:
+        app.logger.info("Looks up suppliers of {} product(s)".format(len(product_ids)))
+        mapping = Supplier.supplier_ids_by_product(product_ids)
+        message = {'suppliers': {str(k): v for k, v in mapping.items()}}
+        return message, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /stats
+######################################################################
+@api.route('/stats')
+class StatsResource(Resource):
+    """ Reports the state of this worker's connection pool and cache """
+    @api.doc('get_stats')
+    @api.response(200, '', stats_model)
+    def get(self) -> Tuple[Response, int]:
+        """
+        Returns the database pool and supplier cache statistics
+        Each gunicorn worker has its own pool and cache, identified by pid
+        """
+        pool = db.engine.pool
+        message = {
+            'pid': os.getpid(),
+            'pool': pool.stats() if isinstance(pool, InstrumentedQueuePool)
+                    else {'status': pool.status()},
+            'cache': supplier_cache.stats(),
+        }
+        return message, status.HTTP_200_OK
 
 
 ######################################################################
@@ -344,8 +792,307 @@ def check_content_type_is_json():
         "Content-Type must be {}".format("application/json"),
     )
 
+def read_payload() -> Any:
+    """
+    Reads the request body as JSON, or as MessagePack or CBOR after its
+    Content-Type
+    """
+    if request.mimetype in BINARY_MEDIA_TYPES:
+        return decode_body(request.mimetype, request.get_data())
+    check_content_type_is_json()
+    return api.payload
+
+
+def negotiated_mimetype() -> str:
+    """Picks the media type of the response the way the api does, from Accept"""
+    return request.accept_mimetypes.best_match(
+        api.representations, default=api.default_mediatype)
+
+
+def wants_binary() -> bool:
+    """Checks whether the response is negotiated to MessagePack or CBOR"""
+    return negotiated_mimetype() in BINARY_MEDIA_TYPES
+
+
+def suppliers_body(message: Any) -> Any:
+    """Outputs one or more suppliers for the negotiated media type"""
+    return binary_suppliers(message) if wants_binary() else marshal_suppliers(message)
+
+
+def expected_version() -> Optional[int]:
+    """
+    Reads the version a write is conditional on from If-Match
+    Returns None when the write is unconditional (no If-Match, or *)
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    tags = list(if_match)  # the strong ETags; weak ones never match
+    if len(tags) > 1:
+        raise BadRequest('400 BAD REQUEST. If-Match must hold a single ETag')
+    try:
+        return etag_version(tags[0])
+    except (IndexError, ValueError):
+        raise VersionConflict("412 PRECONDITION FAILED: If-Match {} matches no "
+                              "version".format(request.headers['If-Match']))
+
+
+def etag_version(tag: str) -> int:
+    """
+    Reads the supplier version from the ETag of any of its representations
+    Raises ValueError if tag is not one
+    """
+    version, _, suffix = tag.partition('-')
+    if suffix and suffix not in ETAG_SUFFIXES.values():
+        raise ValueError("unknown ETag {}".format(tag))
+    return int(version)
+
+
+def read_product_ids():
+    """
+    Reads the products to act on from the products query argument
+    (1,2,3) or else from a {"products": [...]} JSON body
+    """
+    if request.args.get('products') is not None:
+        return request.args['products']
+    payload = read_payload()
+    products = payload.get('products') if isinstance(payload, dict) else None
+    if products is None:
+        raise BadRequest("400 BAD REQUEST: products not provided")
+    return products
+
 def convert_id_to_int(supplier_id):
     try:
         return int(supplier_id)
     except ValueError:
         raise BadRequest("400 BAD REQUEST: id must be int")
+
+
+def parse_supplier_filters(args: Mapping[str, str] = None) -> dict:
+    """Reads the supplier filters from the query string, or from args"""
+    args = request.args if args is None else args
+    supplier_info = {}
+    try:
+        supplier_info['id'] = args.get('id')
+        if supplier_info['id'] is not None:
+            supplier_info['id'] = int(supplier_info['id'])
+    except ValueError:
+        raise BadRequest('400 BAD REQUEST. Wrong ID type')
+    supplier_info['name'] = args.get('name')
+    supplier_info['email'] = args.get('email')
+    supplier_info['address'] = args.get('address')
+    for key in ('products', 'products_any', 'products_all'):
+        supplier_info[key] = None
+        try:
+            supplier_info[key] = args.get(key)
+            if supplier_info[key] is not None:
+                supplier_info[key] =\
+                    [int(x) for x in supplier_info[key].split(',')]
+        except ValueError:
+            raise BadRequest('400 BAD REQUEST. Wrong Products type')
+    return supplier_info
+
+
+def parse_bulk_filters() -> dict:
+    """
+    Reads the supplier filters of a bulk update or delete
+    Refuses to match every supplier unless all=true is given
+    """
+    supplier_info = parse_supplier_filters()
+    if not any(value is not None for value in supplier_info.values()) and \
+            request.args.get('all', '').lower() != 'true':
+        raise BadRequest('400 BAD REQUEST. A filter or all=true is required')
+    return supplier_info
+
+
+def search_suppliers(supplier_info: dict) -> Tuple[list, int]:
+    """
+    Answers GET /suppliers?q=... with the suppliers ranked by trigram
+    similarity; threshold and limit default to SEARCH_THRESHOLD and
+    SEARCH_LIMIT
+    """
+    text = request.args['q'].strip()
+    if not text:
+        raise BadRequest('400 BAD REQUEST. q must not be blank')
+    if request.args.get('after') is not None:
+        raise BadRequest('400 BAD REQUEST. Search results are not paged')
+    try:
+        threshold = float(request.args.get('threshold', app.config['SEARCH_THRESHOLD']))
+        limit = int(request.args.get('limit', app.config['SEARCH_LIMIT']))
+    except ValueError:
+        raise BadRequest('400 BAD REQUEST. Wrong threshold or limit type')
+    if not 0 <= threshold <= 1 or limit <= 0:
+        raise BadRequest('400 BAD REQUEST. threshold must be within [0, 1] '
+                         'and limit positive')
+    limit = min(limit, app.config['PAGE_SIZE_MAX'])
+    if not Supplier.search_enabled:
+        abort(status.HTTP_501_NOT_IMPLEMENTED,
+              '501 NOT IMPLEMENTED. Search needs the pg_trgm extension')
+    suppliers = Supplier.search(text, supplier_info, threshold, limit)
+    record_rows(len(suppliers))
+    if not suppliers:
+        raise NotFound("404 NOT FOUND")
+    app.logger.info('Found {} supplier(s) resembling {}'.format(len(suppliers), text))
+    message = [supplier.serialize_to_dict() for supplier in suppliers]
+    return suppliers_body(message), status.HTTP_200_OK
+
+
+def parse_page_args(args: Mapping[str, str] = None) -> Tuple[int, int]:
+    """
+    Reads the keyset pagination arguments from the query string, or
+    from args
+    Returns the decoded cursor (or None) and the page size,
+    clamped to PAGE_SIZE_MAX
+    """
+    args = request.args if args is None else args
+    try:
+        limit = int(args.get('limit', app.config['PAGE_SIZE_DEFAULT']))
+    except ValueError:
+        raise BadRequest('400 BAD REQUEST. Wrong limit type')
+    if limit <= 0:
+        raise BadRequest('400 BAD REQUEST. limit must be positive')
+    limit = min(limit, app.config['PAGE_SIZE_MAX'])
+    after = args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    return after, limit
+
+
+def find_page_of_suppliers(supplier_info: dict, after: int,
+                           limit: int) -> Tuple[List[Supplier], dict]:
+    """
+    Finds one page of suppliers and the headers to send with it
+    Adds a Link header when another page follows
+    """
+    # fetch one extra row to learn whether another page exists
+    suppliers = Supplier.find_page(supplier_info, after, limit + 1)
+    headers = page_validators([(supplier.id, supplier.version, supplier.updated_at)
+                               for supplier in suppliers], negotiated_mimetype())
+    if len(suppliers) > limit:
+        suppliers = suppliers[:limit]
+        headers['Link'] = next_page_link(suppliers[-1].id, limit)
+    record_rows(len(suppliers))
+    return suppliers, headers
+
+
+def check_page_not_modified(supplier_info: dict, after: int,
+                            limit: int) -> Optional[Response]:
+    """
+    Answers a page request carrying If-None-Match with 304 when the page
+    is unchanged, looking up only the ids and versions of its suppliers
+    """
+    if not request.if_none_match:
+        return None
+    versions = Supplier.find_page_versions(supplier_info, after, limit + 1)
+    headers = page_validators(versions, negotiated_mimetype())
+    if is_not_modified(headers, use_date=False):
+        return not_modified_response(headers)
+    return None
+
+
+def representation_etag(tag: str, mimetype: Optional[str]) -> str:
+    """Tags an ETag with the binary media type the body is encoded in"""
+    if mimetype in ETAG_SUFFIXES:
+        return "{}-{}".format(tag, ETAG_SUFFIXES[mimetype])
+    return tag
+
+
+def supplier_validators(version: int, updated_at: datetime,
+                        mimetype: Optional[str] = None) -> dict:
+    """
+    Builds the ETag and Last-Modified headers of a supplier sent as
+    mimetype, JSON by default
+    """
+    return {'ETag': quote_etag(representation_etag(str(version), mimetype)),
+            'Last-Modified': http_date(updated_at)}
+
+
+def page_validators(versions: List[Tuple[int, int, datetime]],
+                    mimetype: Optional[str] = None) -> dict:
+    """
+    Builds the ETag and Last-Modified headers of a page of suppliers
+    sent as mimetype, JSON by default, from their (id, version,
+    updated_at), including the extra row telling whether another page
+    follows
+    """
+    digest = hashlib.sha1(",".join(
+        "{}:{}".format(supplier_id, version) for supplier_id, version, _ in versions
+    ).encode()).hexdigest()
+    headers = {'ETag': quote_etag(representation_etag(digest, mimetype), weak=True)}
+    if versions:
+        headers['Last-Modified'] = http_date(max(row[2] for row in versions))
+    return headers
+
+
+def is_conditional_request() -> bool:
+    """Checks whether the request carries If-None-Match or If-Modified-Since"""
+    return bool(request.if_none_match) or request.if_modified_since is not None
+
+
+def is_not_modified(headers: dict, use_date: bool = True) -> bool:
+    """
+    Evaluates If-None-Match, or else If-Modified-Since, against the
+    validators in headers. A page ignores If-Modified-Since (use_date),
+    as deleting one of its suppliers does not move its Last-Modified
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(unquote_etag(headers['ETag'])[0])
+    since = request.if_modified_since
+    if not use_date or since is None or 'Last-Modified' not in headers:
+        return False
+    last_modified = parse_date(headers['Last-Modified'])
+    return last_modified.replace(tzinfo=None) <= since.replace(tzinfo=None)
+
+
+def not_modified_response(headers: dict) -> Response:
+    """Builds a 304 response carrying the validators"""
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def encode_cursor(supplier_id: int) -> str:
+    """Encodes the id of the last Supplier of a page as an opaque cursor"""
+    token = base64.urlsafe_b64encode(str(supplier_id).encode())
+    return token.decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    """Decodes a cursor produced by encode_cursor"""
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(cursor + padding).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest('400 BAD REQUEST. Invalid cursor')
+
+
+def next_page_link(last_id: int, limit: int) -> str:
+    """Builds the Link header pointing at the page after last_id"""
+    args = request.args.to_dict(flat=False)
+    args['after'] = [encode_cursor(last_id)]
+    args['limit'] = [str(limit)]
+    return '<{}?{}>; rel="next"'.format(request.base_url,
+                                        urlencode(args, doseq=True))
+
+
+def wants_ndjson() -> bool:
+    """Checks whether the client asked for a streamed NDJSON response"""
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+def ndjson_lines(suppliers: Iterable[Supplier],
+                 batch_size: int) -> Iterator[bytes]:
+    """
+    Encodes suppliers as NDJSON, one object per line
+    Lines are flushed batch_size at a time so that neither the
+    whole result nor one write per row is held in memory
+    """
+    lines, count = [], 0
+    for supplier in suppliers:
+        lines.append(dumps_line(supplier.serialize_to_dict()))
+        count += 1
+        if len(lines) >= batch_size:
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
+    record_rows(count)
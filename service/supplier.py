@@ -3,21 +3,243 @@ This file defines the model for Supplier
 '''
 
 import json
-import re
 import logging
-from typing import List, Set, Union
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.dialects.postgresql import ARRAY
+import orjson
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extras import execute_values
+from sqlalchemy import and_, case, cast, event, exists, func, inspect, literal, or_, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import column_property
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
 from werkzeug.exceptions import NotFound
+from service.cache import supplier_cache
+from service.pool import InstrumentedQueuePool
 from service.supplier_exception \
-    import DuplicateProduct, MissingInfo, WrongArgType, \
-    UserDefinedIdError, OutOfRange, InvalidFormat
+    import SupplierException, DuplicateProduct, MissingInfo, WrongArgType, \
+    VersionConflict
+from service import product_codec, validation
 
 
 db = SQLAlchemy()
 logger = logging.getLogger("flask.app")
 
+# Appends :new to the products of Supplier :id unless it already carries
+# one of them or its version is not :expected (when given). The snapshot
+# row reports the duplicates and version when the UPDATE matches nothing;
+# no row at all means the Supplier does not exist
+ADD_PRODUCTS_SQL = """
+WITH updated AS (
+    UPDATE {table}
+    SET {set_products},
+        version = version + 1,
+        updated_at = now()
+    WHERE id = :id
+      AND NOT coalesce(supplier_products(products, products_packed), '{{}}')
+              && CAST(:new AS {products_type})
+      AND (CAST(:expected AS integer) IS NULL OR version = :expected)
+    RETURNING id, name, email, address, supplier_products(products, products_packed) AS products,
+              version, updated_at
+)
+SELECT updated.*,
+       snapshot.version AS current_version,
+       ARRAY(SELECT unnest(supplier_products(snapshot.products, snapshot.products_packed))
+             INTERSECT SELECT unnest(CAST(:new AS {products_type}))
+             ORDER BY 1) AS duplicates
+FROM {table} AS snapshot LEFT JOIN updated ON true
+WHERE snapshot.id = :id
+"""
+ADD_PRODUCTS_VALUE = """ARRAY(SELECT DISTINCT unnest(supplier_products(products, products_packed)
+                                          || CAST(:new AS {products_type}))
+                         ORDER BY 1)"""
+
+# Removes :ids from the products of Supplier :id (or, without the id
+# filter, of every Supplier carrying one of them) if their version is
+# :expected (when given). The locked rows give the products as they
+# were, to report the ids that were not present, and the products that
+# remain; rows carrying none of the ids are left untouched
+REMOVE_PRODUCTS_SQL = """
+WITH old AS (
+    SELECT id, name, email, address, version, updated_at, products,
+           ARRAY(SELECT product FROM unnest(products) AS product
+                 WHERE product <> ALL(CAST(:ids AS {products_type}))
+                 ORDER BY product) AS remaining
+    FROM (SELECT id, name, email, address, version, updated_at,
+                 supplier_products(products, products_packed) AS products
+          FROM {table} WHERE {where} FOR UPDATE) AS locked
+), updated AS (
+    UPDATE {table} AS supplier
+    SET {set_products},
+        version = supplier.version + 1,
+        updated_at = now()
+    FROM old
+    WHERE supplier.id = old.id AND old.products && CAST(:ids AS {products_type})
+      AND (CAST(:expected AS integer) IS NULL OR old.version = :expected)
+    RETURNING supplier.id, supplier.version, supplier.updated_at
+)
+"""
+REMOVE_PRODUCTS_VALUE = "old.remaining"
+
+REMOVE_PRODUCTS_FROM_ONE_SQL = REMOVE_PRODUCTS_SQL + """
+SELECT old.id, old.name, old.email, old.address,
+       CASE WHEN updated.id IS NULL THEN old.products ELSE old.remaining END AS products,
+       coalesce(updated.version, old.version) AS version,
+       coalesce(updated.updated_at, old.updated_at) AS updated_at,
+       updated.id IS NOT NULL AS changed,
+       ARRAY(SELECT unnest(CAST(:ids AS {products_type}))
+             EXCEPT SELECT unnest(old.products)
+             ORDER BY 1) AS missing
+FROM old LEFT JOIN updated ON true
+"""
+
+REMOVE_PRODUCTS_FROM_ALL_SQL = REMOVE_PRODUCTS_SQL + """
+SELECT (SELECT count(*) FROM updated) AS updated,
+       ARRAY(SELECT unnest(CAST(:ids AS {products_type}))
+             EXCEPT SELECT unnest(products) FROM old
+             ORDER BY 1) AS missing
+"""
+
+# Rewrites up to :limit Suppliers whose products are not stored the
+# way products_storage says
+CONVERT_PRODUCTS_SQL = """
+UPDATE {table}
+SET {set_products}
+WHERE id IN (SELECT id FROM {table} WHERE {stale} IS NOT NULL
+             ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED)
+"""
+CONVERT_PRODUCTS_VALUE = "supplier_products(products, products_packed)"
+
+# The products of Supplier {table}.id in the supplier_product table
+LINKED_PRODUCTS_SQL = """ARRAY(SELECT product_id FROM supplier_product
+                            WHERE supplier_id = {table}.id ORDER BY product_id)"""
+
+# Makes :products the products of the Suppliers :ids in the
+# supplier_product table, touching only the rows that change
+LINK_PRODUCTS_SQL = """
+WITH unlinked AS (
+    DELETE FROM supplier_product
+    WHERE supplier_id = ANY(CAST(:ids AS integer[]))
+      AND product_id NOT IN (SELECT unnest(CAST(:products AS bigint[])))
+)
+INSERT INTO supplier_product (supplier_id, product_id)
+SELECT supplier_id, product_id
+FROM unnest(CAST(:ids AS integer[])) AS supplier_id,
+     unnest(CAST(:products AS bigint[])) AS product_id
+ON CONFLICT DO NOTHING
+"""
+
+# Links :new to Supplier :id, returning the products it did not carry
+ADD_LINKED_PRODUCTS_SQL = """
+INSERT INTO supplier_product (supplier_id, product_id)
+SELECT :id, unnest(CAST(:new AS bigint[]))
+ON CONFLICT DO NOTHING
+RETURNING product_id
+"""
+
+# Unlinks :ids from Supplier :id, returning the products it carried
+REMOVE_LINKED_PRODUCTS_SQL = """
+DELETE FROM supplier_product
+WHERE supplier_id = :id AND product_id = ANY(CAST(:ids AS bigint[]))
+RETURNING product_id
+"""
+
+# Unlinks :ids from every Supplier and bumps the version of those
+# that carried one
+REMOVE_LINKED_PRODUCTS_FROM_ALL_SQL = """
+WITH removed AS (
+    DELETE FROM supplier_product WHERE product_id = ANY(CAST(:ids AS bigint[]))
+    RETURNING supplier_id, product_id
+), updated AS (
+    UPDATE {table} SET version = version + 1, updated_at = now()
+    WHERE id IN (SELECT supplier_id FROM removed)
+    RETURNING id
+)
+SELECT (SELECT count(*) FROM updated) AS updated,
+       ARRAY(SELECT unnest(CAST(:ids AS bigint[]))
+             EXCEPT SELECT product_id FROM removed
+             ORDER BY 1) AS missing
+"""
+
+# Locks Supplier :id for a write to its linked products
+LOCK_SUPPLIER_SQL = "SELECT version FROM {table} WHERE id = :id FOR UPDATE"
+
+# Bumps the version of Supplier :id after a write to its linked products
+TOUCH_LINKED_SUPPLIER_SQL = """
+UPDATE {table} SET version = version + 1, updated_at = now() WHERE id = :id
+RETURNING id, name, email, address, {products} AS products, version, updated_at
+"""
+
+# Supplier :id with its linked products
+LINKED_SUPPLIER_SQL = """
+SELECT id, name, email, address, {products} AS products, version, updated_at
+FROM {table} WHERE id = :id
+"""
+
+# Moves the products of up to :limit Suppliers from their columns to
+# the supplier_product table
+LINK_STORED_PRODUCTS_SQL = """
+WITH stale AS (
+    SELECT id, supplier_products(products, products_packed) AS products
+    FROM {table} WHERE products IS NOT NULL OR products_packed IS NOT NULL
+    ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED
+), linked AS (
+    INSERT INTO supplier_product (supplier_id, product_id)
+    SELECT id, unnest(products) FROM stale
+    ON CONFLICT DO NOTHING
+)
+UPDATE {table} SET products = NULL, products_packed = NULL
+FROM stale WHERE {table}.id = stale.id
+"""
+
+# Moves the products of up to :limit Suppliers from the
+# supplier_product table back to their columns
+UNLINK_STORED_PRODUCTS_SQL = """
+WITH stale AS (
+    SELECT id FROM {table}
+    WHERE EXISTS (SELECT 1 FROM supplier_product WHERE supplier_id = {table}.id)
+    ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED
+), unlinked AS (
+    DELETE FROM supplier_product WHERE supplier_id IN (SELECT id FROM stale)
+    RETURNING supplier_id, product_id
+), moved AS (
+    SELECT supplier_id, array_agg(product_id ORDER BY product_id) AS products
+    FROM unlinked GROUP BY supplier_id
+)
+UPDATE {table} SET {set_products}
+FROM moved WHERE {table}.id = moved.supplier_id
+"""
+UNLINK_STORED_PRODUCTS_VALUE = "moved.products"
+
+# How the products of a Supplier are stored: a bigint[] in the products
+# column, packed by product_codec in the products_packed column, or
+# one row per product in the supplier_product table
+ARRAY_STORAGE = "array"
+PACKED_STORAGE = "packed"
+TABLE_STORAGE = "table"
+PRODUCTS_STORAGE_MODES = (ARRAY_STORAGE, PACKED_STORAGE, TABLE_STORAGE)
+
+# The errors of CREATE EXTENSION pg_trgm that leave search disabled: the
+# extension is not installed on the server, or the role may not create it
+EXTENSION_UNAVAILABLE = (errorcodes.FEATURE_NOT_SUPPORTED, errorcodes.UNDEFINED_FILE,
+                         errorcodes.INSUFFICIENT_PRIVILEGE)
+
+# Supplier -> product membership of the table storage
+supplier_product = db.Table(
+    'supplier_product',
+    db.Column('supplier_id', db.Integer, db.ForeignKey('supplier.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('product_id', db.BigInteger, primary_key=True),
+    # serves the lookups of the Suppliers carrying a product
+    db.Index('ix_supplier_product_product_id', 'product_id', 'supplier_id'),
+)
+
 
 def init_db(app):
     """Initialies the SQLAlchemy app"""
@@ -30,28 +252,49 @@ class Supplier(db.Model):
     necessary info about a supplier
     '''
     app: Flask = None
+    search_enabled: bool = False
+    products_storage: str = ARRAY_STORAGE
     __tablename__ = "supplier"
     __table_args__ = (
         db.CheckConstraint('NOT(email IS NULL AND address IS NULL)'),
+        # serves the && (overlap), @> (contains) and = product lookups
+        # of the array and packed storages, whichever a row is in
+        db.Index('ix_supplier_catalogue', text('supplier_products(products, products_packed)'),
+                 postgresql_using='gin'),
     )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
     email = db.Column(db.String(63), nullable=True)
     address = db.Column(db.String(63), nullable=True)
-    products = db.Column(ARRAY(db.Integer), nullable=True)
+    products = db.Column(ARRAY(db.BigInteger), nullable=True)
+    # the products encoded by product_codec.pack, instead of the
+    # products column, when products_storage is packed
+    products_packed = db.Column(db.LargeBinary, nullable=True)
+    # the products in the supplier_product table, read with the row
+    # when it stores none in its own columns
+    linked_products = column_property(case([(
+        and_(products.is_(None), products_packed.is_(None)),
+        func.array(select([supplier_product.c.product_id])
+                   .where(supplier_product.c.supplier_id == id)
+                   .order_by(supplier_product.c.product_id)
+                   .correlate_except(supplier_product).as_scalar(),
+                   type_=ARRAY(db.BigInteger)))]))
+    # bumped by every write; the ETag of the Supplier
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=func.now(), onupdate=func.now())
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        if self.id is not None:
-            raise UserDefinedIdError("User cannot set the value of id")
-        self._check_name(self.name)
-        self._check_email(self.email)
-        self._check_address(self.address)
-        self._check_product_ids(self.products)
-        self.products = sorted(set(self.products))
-        self._check_contact_methods()
+        row, errors = validation.validate_supplier({
+            'id': self.id, 'name': self.name, 'email': self.email,
+            'address': self.address, 'products': self.products})
+        validation.raise_errors(errors)
+        self.products = row['products']
 
     # def __repr__(self):
     #     return "<Supplier %r, id=%s>" % (self.name, self.id)
@@ -77,9 +320,138 @@ class Supplier(db.Model):
         """
         logger.info("Initializing database")
         cls.app = app
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {}) \
+            .setdefault("poolclass", InstrumentedQueuePool)
+        cls.products_storage = app.config.get("PRODUCTS_STORAGE", ARRAY_STORAGE)
+        if cls.products_storage not in PRODUCTS_STORAGE_MODES:
+            raise ValueError("PRODUCTS_STORAGE must be one of {}, got {!r}"
+                             .format(", ".join(PRODUCTS_STORAGE_MODES), cls.products_storage))
         db.init_app(app)
         app.app_context().push()
+        cls._create_functions()
         db.create_all()  # make our sqlalchemy tables
+        cls._migrate_products()
+        cls._create_missing_columns()
+        cls._create_missing_indexes()
+        cls._move_linked_products()
+        cls.create_search_indexes()
+        supplier_cache.init_app(app, db.engine.raw_connection)
+
+    @classmethod
+    def _create_functions(cls):
+        """Creates the SQL functions that read and write packed products"""
+        with db.engine.begin() as connection:
+            # concurrent CREATE OR REPLACE of a same function fails
+            cls._lock_schema(connection)
+            connection.execute(product_codec.PACK_SQL)
+            connection.execute(product_codec.UNPACK_SQL)
+            # the schema the functions above were created in
+            schema = connection.execute(func.current_schema().select()).scalar()
+            connection.execute(product_codec.CATALOGUE_SQL.format(
+                schema=connection.dialect.identifier_preparer.quote_schema(schema)))
+
+    @classmethod
+    def _lock_schema(cls, connection):
+        """Waits for the schema changes of the other workers starting
+        together; holds the lock until the transaction of connection ends
+        """
+        connection.execute(func.pg_advisory_xact_lock(
+            func.hashtext(product_codec.CATALOGUE_FUNCTION)).select())
+
+    @classmethod
+    def _migrate_products(cls):
+        """Widens integer[] products to bigint[] and drops the index on
+        the products column that ix_supplier_catalogue replaced
+        """
+        with db.engine.begin() as connection:
+            # the column is inspected under the lock, after the workers
+            # that got it first converted it
+            cls._lock_schema(connection)
+            connection.execute("DROP INDEX IF EXISTS ix_supplier_products")
+            for column in inspect(connection).get_columns(cls.__tablename__):
+                if column['name'] == 'products' and \
+                        not isinstance(column['type'].item_type, db.BigInteger):
+                    logger.info("Converting products to %s", cls.products.type)
+                    connection.execute("ALTER TABLE {} ALTER COLUMN products TYPE {}".format(
+                        cls.__tablename__,
+                        cls.__table__.c.products.type.compile(dialect=db.engine.dialect)))
+
+    @classmethod
+    def _create_missing_columns(cls):
+        """Adds columns added to the model after the table was created"""
+        with db.engine.begin() as connection:
+            # the columns are listed under the lock, after the workers
+            # that got it first added theirs
+            cls._lock_schema(connection)
+            existing = {column['name'] for column in
+                        inspect(connection).get_columns(cls.__tablename__)}
+            for column in cls.__table__.columns:
+                if column.name not in existing:
+                    logger.info("Adding column %s", column.name)
+                    connection.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                        cls.__tablename__,
+                        CreateColumn(column).compile(dialect=db.engine.dialect)))
+
+    @classmethod
+    def _create_missing_indexes(cls):
+        """Creates indexes added to the model after the table was created"""
+        with db.engine.begin() as connection:
+            # the indexes are listed under the lock, after the workers
+            # that got it first created theirs
+            cls._lock_schema(connection)
+            # pg_indexes lists the expression indexes reflection skips
+            existing = {name for name, in connection.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+                table=cls.__tablename__)}
+            for index in cls.__table__.indexes:
+                if index.name not in existing:
+                    logger.info("Creating index %s", index.name)
+                    index.create(connection)
+
+    @classmethod
+    def create_search_indexes(cls):
+        """Creates the pg_trgm GIN indexes behind search()
+        Search stays disabled when the extension cannot be installed
+        """
+        try:
+            with db.engine.begin() as connection:
+                # IF NOT EXISTS does not stop workers starting together
+                # from colliding in the catalogs
+                cls._lock_schema(connection)
+                connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                for column in ('name', 'address'):
+                    connection.execute(
+                        "CREATE INDEX IF NOT EXISTS ix_supplier_{column}_trgm ON {table} "
+                        "USING gin ({column} gin_trgm_ops)"
+                        .format(table=cls.__tablename__, column=column))
+            cls.search_enabled = True
+        except DBAPIError as error:
+            if getattr(error.orig, 'pgcode', None) not in EXTENSION_UNAVAILABLE:
+                raise
+            logger.warning("Supplier search is disabled, pg_trgm is unavailable: %s",
+                           error.orig)
+            cls.search_enabled = False
+
+    @classmethod
+    def search(cls, text: str, supplier_info: dict = None,
+               threshold: float = 0.5, limit: int = 20) -> List["Supplier"]:
+        """Finds the Suppliers whose name or address resembles text
+        Matches with the pg_trgm word similarity operator <%, which the
+        trigram GIN indexes serve, and ranks by the best similarity
+        :param text: the words to look for, e.g. the start of a name
+        :param supplier_info: further fields to filter by, as for find_all
+        :param threshold: the minimum word similarity, between 0 and 1
+        :param limit: the maximum number of Suppliers to return
+        :return: the matching Suppliers, most similar first
+        """
+        text = literal(text, db.Text)
+        db.session.execute(func.set_config('pg_trgm.word_similarity_threshold',
+                                           str(threshold), True).select())
+        rank = func.greatest(func.word_similarity(text, cls.name),
+                             func.word_similarity(text, func.coalesce(cls.address, '')))
+        return cls.filter_query(supplier_info) \
+            .filter(or_(text.op('<%')(cls.name), text.op('<%')(cls.address))) \
+            .order_by(rank.desc(), cls.id).limit(limit).all()
 
     @classmethod
     def list(cls) -> List["Supplier"]:
@@ -95,23 +467,248 @@ class Supplier(db.Model):
                  or 404_NOT_FOUND if not found
         :rtype: Supplier
         """
+        ret = cls.filter_query(supplier_info).all()
+        if len(ret) == 0:
+            raise NotFound("404 NOT FOUND")
+        return ret
+
+    @classmethod
+    def find_page(cls, supplier_info: dict, after: int = None,
+                  limit: int = None) -> List["Supplier"]:
+        """Finds one page of Suppliers using keyset pagination
+        Runs WHERE id > :after ORDER BY id LIMIT :limit so that the
+        primary key index bounds the work regardless of table size
+        :param supplier_info: the fields to filter by
+        :param after: the id of the last Supplier of the previous page
+        :param limit: the maximum number of Suppliers to return
+        :rtype: list of Supplier
+        """
+        query = cls.filter_query(supplier_info)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def find_version(cls, supplier_id: int) -> Optional[Tuple[int, datetime]]:
+        """Looks up the version of a Supplier without loading it
+        :param supplier_id: the id of the Supplier
+        :return: the version and the time of the last write,
+                 or None if the Supplier does not exist
+        """
+        return db.session.query(cls.version, cls.updated_at) \
+            .filter(cls.id == supplier_id).first()
+
+    @classmethod
+    def find_page_versions(cls, supplier_info: dict, after: int = None,
+                           limit: int = None) -> List[Tuple[int, int, datetime]]:
+        """Looks up the (id, version, updated_at) of the Suppliers
+        find_page would return, without loading them
+        """
+        query = cls.filter_query(supplier_info)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.with_entities(cls.id, cls.version, cls.updated_at) \
+            .order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def stream(cls, supplier_info: dict, after: int = None,
+               batch_size: int = 1000) -> Iterator["Supplier"]:
+        """Iterates over the matching Suppliers ordered by id
+        Rows are fetched from a server-side cursor batch_size at a time,
+        so memory stays bounded however many Suppliers match
+        :param supplier_info: the fields to filter by
+        :param after: only yield Suppliers with an id greater than this
+        :param batch_size: the number of rows fetched per round trip
+        """
+        query = cls.filter_query(supplier_info)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return iter(query.order_by(cls.id).yield_per(batch_size))
+
+    @classmethod
+    def supplier_ids_by_product(cls, product_ids: Iterable[int]) -> Dict[int, List[int]]:
+        """Maps each product to the ids of the Suppliers carrying it
+        Answers every product in one statement; the products && :ids
+        predicate lets the GIN index pick the candidate rows
+        :param product_ids: the products to look up
+        :return: a dict from product id to sorted Supplier ids,
+                 with an empty list for products nobody carries
+        """
+        product_ids = sorted(set(product_ids))
+        mapping = {product_id: [] for product_id in product_ids}
+        if not product_ids:
+            return mapping
+        if cls.products_storage == TABLE_STORAGE:
+            rows = db.session.query(
+                supplier_product.c.product_id,
+                func.array_agg(aggregate_order_by(supplier_product.c.supplier_id,
+                                                  supplier_product.c.supplier_id))
+            ).filter(supplier_product.c.product_id.in_(product_ids)) \
+                .group_by(supplier_product.c.product_id)
+            mapping.update(rows)
+            return mapping
+        carried = db.session.query(
+            cls.id.label('supplier_id'),
+            func.unnest(cls.catalogue()).label('product_id')
+        ).filter(cls.catalogue().overlap(cls._products_literal(product_ids))).subquery()
+        rows = db.session.query(
+            carried.c.product_id,
+            func.array_agg(aggregate_order_by(carried.c.supplier_id,
+                                              carried.c.supplier_id))
+        ).filter(carried.c.product_id.in_(product_ids)) \
+            .group_by(carried.c.product_id)
+        for product_id, supplier_ids in rows:
+            mapping[product_id] = supplier_ids
+        return mapping
+
+    @classmethod
+    def filter_query(cls, supplier_info: dict):
+        """Builds a query on the non-empty fields of supplier_info
+        products matches the whole catalogue exactly, products_any
+        matches Suppliers carrying any of the given products and
+        products_all those carrying every one of them
+        :param supplier_info: the fields to filter by, or a Supplier id
+        :return: a query over the matching Suppliers
+        """
         if isinstance(supplier_info, int):
             supplier_info = {'id': supplier_info}
-        useless_info = []
-        for k, value in supplier_info.items():
-            if value is None:
-                useless_info.append(k)
-            elif k == 'products':
-                supplier_info[k] = sorted(supplier_info[k])
-        for k in useless_info:
-            supplier_info.pop(k)
+        supplier_info = {
+            k: (sorted(value) if k == 'products' else value)
+            for k, value in (supplier_info or {}).items() if value is not None
+        }
         # logger.info("Processing lookup or 404 for id %s ...",
         #             supplier_info['id'])  # may not have ID,
         #                                   # need other way to log
-        ret = Supplier.query.filter_by(**supplier_info).all()
-        if len(ret) == 0:
-            raise NotFound("404 NOT FOUND")
-        return ret
+        products = supplier_info.pop('products', None)
+        products_any = supplier_info.pop('products_any', None)
+        products_all = supplier_info.pop('products_all', None)
+        query = cls.query.filter_by(**supplier_info)
+        if cls.products_storage == TABLE_STORAGE:
+            return cls._filter_linked_products(query, products, products_any, products_all)
+        if products is not None:
+            query = query.filter(cls.catalogue() == cls._products_literal(products))
+        if products_any:
+            query = query.filter(cls.catalogue().overlap(cls._products_literal(products_any)))
+        if products_all:
+            query = query.filter(cls.catalogue().contains(cls._products_literal(products_all)))
+        return query
+
+    @classmethod
+    def _filter_linked_products(cls, query, products: Optional[List[int]],
+                                products_any: Optional[List[int]],
+                                products_all: Optional[List[int]]):
+        """filter_query of the products in the supplier_product table"""
+        linked = supplier_product.c
+        if products == []:
+            query = query.filter(~exists().where(linked.supplier_id == cls.id))
+        elif products is not None:
+            # candidates carrying the first product, then the whole list
+            query = query.filter(cls.id.in_(
+                select([linked.supplier_id])
+                .where(linked.supplier_id.in_(select([linked.supplier_id])
+                                              .where(linked.product_id == products[0])))
+                .group_by(linked.supplier_id)
+                .having(func.array_agg(aggregate_order_by(linked.product_id, linked.product_id))
+                        == cls._products_literal(products))))
+        if products_any:
+            query = query.filter(cls.id.in_(
+                select([linked.supplier_id]).where(linked.product_id.in_(products_any))))
+        if products_all:
+            products_all = sorted(set(products_all))
+            query = query.filter(cls.id.in_(
+                select([linked.supplier_id]).where(linked.product_id.in_(products_all))
+                .group_by(linked.supplier_id)
+                .having(func.count() == len(products_all))))
+        return query
+
+    @classmethod
+    def catalogue(cls):
+        """The products of a Supplier as a SQL expression, read from
+        either column; the product lookups must go through it to use
+        the ix_supplier_catalogue index
+        """
+        return func.supplier_products(cls.products, cls.products_packed,
+                                      type_=cls.__table__.c.products.type)
+
+    @classmethod
+    def _products_literal(cls, products: List[int]):
+        # psycopg2 sends a list of ints as an integer[]
+        return cast(products, cls.__table__.c.products.type)
+
+    @classmethod
+    def products_sql(cls, value: str) -> Tuple[str, str]:
+        """The SQL values of the products and products_packed columns
+        that store the bigint[] expression value as products_storage says;
+        both are NULL for the table storage, see link_products
+        """
+        if cls.products_storage == TABLE_STORAGE:
+            return "NULL", "NULL"
+        if cls.products_storage == PACKED_STORAGE:
+            return "NULL", "{}({})".format(product_codec.PACK_FUNCTION, value)
+        return value, "NULL"
+
+    @classmethod
+    def products_values(cls, products: Optional[List[int]]) -> dict:
+        """The products and products_packed column values that store
+        the sorted product ids as products_storage says; both are None
+        for the table storage, see link_products
+        """
+        if cls.products_storage == TABLE_STORAGE:
+            return {'products': None, 'products_packed': None}
+        if cls.products_storage == PACKED_STORAGE:
+            return {'products': None,
+                    'products_packed': None if products is None
+                                       else product_codec.pack(products)}
+        return {'products': products, 'products_packed': None}
+
+    @classmethod
+    def convert_products(cls, batch_size: int = 1000) -> int:
+        """Rewrites the products stored the other way than products_storage
+        says, batch_size Suppliers per transaction. Until then, rows in
+        the array and packed storages are read as they are and converted
+        by their next write; init_db moves rows in or out of the table
+        storage itself, as it answers lookups of its own
+        :return: the number of Suppliers converted
+        """
+        table = cls.__tablename__
+        if cls.products_storage == TABLE_STORAGE:
+            statements = [LINK_STORED_PRODUCTS_SQL.format(table=table)]
+        else:
+            stale = "products" if cls.products_storage == PACKED_STORAGE else "products_packed"
+            statements = [
+                CONVERT_PRODUCTS_SQL.format(
+                    table=table, stale=stale,
+                    set_products=cls._set_products_sql(CONVERT_PRODUCTS_VALUE)),
+                UNLINK_STORED_PRODUCTS_SQL.format(
+                    table=table,
+                    set_products=cls._set_products_sql(UNLINK_STORED_PRODUCTS_VALUE)),
+            ]
+        converted = 0
+        for statement in statements:
+            while True:
+                count = db.session.execute(text(statement), {'limit': batch_size}).rowcount
+                db.session.commit()
+                converted += count
+                if count < batch_size:
+                    break
+        logger.info("Converted the products of %d suppliers to %s storage",
+                    converted, cls.products_storage)
+        return converted
+
+    @classmethod
+    def _move_linked_products(cls):
+        """Moves products in or out of the supplier_product table when
+        the products_storage changed to or from the table storage
+        """
+        if cls.products_storage == TABLE_STORAGE:
+            stale = "SELECT 1 FROM {} WHERE products IS NOT NULL " \
+                    "OR products_packed IS NOT NULL".format(cls.__tablename__)
+        else:
+            stale = "SELECT 1 FROM supplier_product"
+        if db.engine.execute("SELECT EXISTS ({})".format(stale)).scalar():
+            logger.warning("Moving products to %s storage", cls.products_storage)
+            cls.convert_products()
+            db.session.remove()
 
     @classmethod
     def find_first(cls, supplier_info: dict) -> "Supplier":
@@ -131,6 +728,369 @@ class Supplier(db.Model):
                 format(supplier_info))
 
 
+    @classmethod
+    def bulk_create(cls, records: Iterable, atomic: bool = True,
+                    batch_size: int = 1000) -> Tuple[List[int], List[dict]]:
+        """Validates and inserts many Suppliers
+        Valid rows are inserted batch_size at a time with one
+        multi-row INSERT ... RETURNING id per batch
+        :param records: the Supplier dicts to create; an item may also be
+                        the SupplierException met while parsing that record
+        :param atomic: insert nothing unless every record is valid,
+                       otherwise insert the valid records and skip the rest
+        :return: the ids of the created Suppliers and a list of
+                 {'index', 'message'} errors for the rejected records
+        """
+        created, errors, batch = [], [], []
+
+        def flush():
+            ids, batch_errors = cls._insert_batch(batch, atomic)
+            created.extend(ids)
+            errors.extend(batch_errors)
+            batch.clear()
+
+        try:
+            for index, data in enumerate(records):
+                try:
+                    if isinstance(data, SupplierException):
+                        raise data
+                    row = Supplier.validate_dict(data)
+                except SupplierException as error:
+                    errors.append({'index': index, 'message': str(error),
+                                   'errors': list(error.errors)})
+                    continue
+                if atomic and errors:
+                    continue  # keep validating, nothing will be inserted
+                batch.append((index, row))
+                if len(batch) >= batch_size:
+                    flush()
+            if batch and not (atomic and errors):
+                flush()
+        except Exception:
+            db.session.rollback()
+            raise
+        if atomic and errors:
+            db.session.rollback()
+            return [], errors
+        db.session.commit()
+        logger.info("Bulk created %d suppliers, rejected %d",
+                    len(created), len(errors))
+        return created, errors
+
+    @classmethod
+    def _insert_batch(cls, batch: List[Tuple[int, dict]],
+                      atomic: bool) -> Tuple[List[int], List[dict]]:
+        """Inserts (index, row) pairs with a single INSERT ... RETURNING id
+        In best-effort mode the batch runs in a savepoint, and a database
+        error rejects the rows of that batch only
+        """
+        if atomic:
+            return cls._execute_insert([row for _, row in batch]), []
+        savepoint = db.session.begin_nested()
+        try:
+            ids = cls._execute_insert([row for _, row in batch])
+            savepoint.commit()
+            return ids, []
+        except psycopg2.Error as error:
+            savepoint.rollback()
+            message = "400 BAD REQUEST: {}".format(error)
+            return [], [{'index': index, 'message': message, 'errors': []}
+                        for index, _ in batch]
+
+    @classmethod
+    def _execute_insert(cls, rows: List[dict]) -> List[int]:
+        """Runs one multi-row INSERT ... RETURNING id in the session's
+        transaction; psycopg2 builds the VALUES list directly, which
+        is far cheaper than compiling a SQLAlchemy multi-values insert
+        """
+        connection = db.session.connection()
+        cursor = connection.connection.cursor()
+        try:
+            result = execute_values(
+                cursor,
+                "INSERT INTO {} (name, email, address, products, products_packed) "
+                "VALUES %s RETURNING id".format(cls.__tablename__),
+                [dict(row, **cls.products_values(row['products'])) for row in rows],
+                template="(%(name)s, %(email)s, %(address)s, %(products)s, "
+                         "%(products_packed)s)",
+                page_size=len(rows), fetch=True)
+            ids = [row[0] for row in result]
+            if cls.products_storage == TABLE_STORAGE:
+                execute_values(
+                    cursor,
+                    "INSERT INTO supplier_product (supplier_id, product_id) VALUES %s",
+                    [(supplier_id, product_id)
+                     for supplier_id, row in zip(ids, rows) for product_id in row['products']],
+                    page_size=10000)
+        finally:
+            cursor.close()
+        return ids
+
+    @classmethod
+    def link_products(cls, connection, supplier_ids: List[int], products: List[int]):
+        """Makes products the products of the Suppliers supplier_ids in
+        the supplier_product table; only the rows that change are written
+        :param connection: the connection of the transaction to write in
+        """
+        connection.execute(text(LINK_PRODUCTS_SQL), ids=supplier_ids, products=products)
+
+    @classmethod
+    def add_products_by_id(cls, supplier_id: int,
+                           products: Union[List[int], Set[int], str],
+                           expected_version: int = None) -> dict:
+        """Adds products to a Supplier in one atomic UPDATE ... RETURNING
+        The union is computed in the database from the row being
+        updated, so concurrent adds never drop each other's products.
+        Only the new product ids are validated
+        :param supplier_id: the id of the Supplier
+        :param products: the product ids to add, or a comma separated string
+        :param expected_version: raise VersionConflict unless the Supplier
+                                 is still at this version
+        :return: the updated Supplier as serialize_to_dict, with its
+                 version and updated_at
+        """
+        products = cls._parse_product_ids(products)
+        if not products:
+            supplier = cls.find_first({'id': supplier_id})
+            cls._check_version(supplier_id, supplier.version, expected_version)
+            return dict(supplier.serialize_to_dict(), version=supplier.version,
+                        updated_at=supplier.updated_at)
+        if cls.products_storage == TABLE_STORAGE:
+            return cls._add_linked_products(supplier_id, products, expected_version)
+        statement = cls._add_products_statement()
+        while True:
+            row = db.session.execute(statement, {'id': supplier_id, 'new': products,
+                                                 'expected': expected_version}).first()
+            if row is None:
+                db.session.rollback()
+                raise NotFound("404 NOT FOUND: Supplier with provided fields {} not found"
+                               .format({'id': supplier_id}))
+            if row['version'] is not None:
+                break
+            if expected_version is not None and row['current_version'] != expected_version:
+                db.session.rollback()
+                cls._check_version(supplier_id, row['current_version'], expected_version)
+            if row['duplicates']:
+                db.session.rollback()
+                raise DuplicateProduct("400 BAD REQUEST: Duplicated products: {}"
+                                       .format(set(row['duplicates'])))
+            # a concurrent write committed after the statement's
+            # snapshot was taken: look again
+        supplier_cache.publish(db.session, supplier_id)
+        db.session.commit()
+        supplier_cache.invalidate(supplier_id)
+        return {key: row[key] for key in
+                ('id', 'name', 'email', 'address', 'products', 'version', 'updated_at')}
+
+    @classmethod
+    def remove_products_by_id(cls, supplier_id: int,
+                              products: Union[List[int], Set[int], str],
+                              expected_version: int = None) -> Tuple[dict, List[int]]:
+        """Removes products from a Supplier with one array-difference UPDATE
+        :param supplier_id: the id of the Supplier
+        :param products: the product ids to remove, or a comma separated string
+        :param expected_version: raise VersionConflict unless the Supplier
+                                 is still at this version
+        :return: the updated Supplier as serialize_to_dict, with its
+                 version and updated_at, and the ids it did not carry
+        """
+        products = cls._parse_products_to_remove(products)
+        if cls.products_storage == TABLE_STORAGE:
+            return cls._remove_linked_products(supplier_id, products, expected_version)
+        row = db.session.execute(
+            cls._remove_products_statement(REMOVE_PRODUCTS_FROM_ONE_SQL, "id = :id"),
+            {'id': supplier_id, 'ids': products, 'expected': expected_version}).first()
+        if row is None:
+            db.session.rollback()
+            raise NotFound("404 NOT FOUND: Supplier with provided fields {} not found"
+                           .format({'id': supplier_id}))
+        if not row['changed'] and expected_version is not None:
+            db.session.rollback()
+            cls._check_version(supplier_id, row['version'], expected_version)
+        if row['changed']:
+            supplier_cache.publish(db.session, supplier_id)
+        db.session.commit()
+        if row['changed']:
+            supplier_cache.invalidate(supplier_id)
+        supplier = {key: row[key] for key in
+                    ('id', 'name', 'email', 'address', 'products', 'version', 'updated_at')}
+        return supplier, row['missing']
+
+    @classmethod
+    def remove_products_from_all(cls, products: Union[List[int], Set[int], str]
+                                 ) -> Tuple[int, List[int]]:
+        """Removes products from every Supplier carrying them
+        Runs as a single UPDATE; the GIN index finds the Suppliers
+        :param products: the product ids to remove, or a comma separated string
+        :return: the number of Suppliers updated and the ids no Supplier carried
+        """
+        products = cls._parse_products_to_remove(products)
+        if cls.products_storage == TABLE_STORAGE:
+            statement = text(REMOVE_LINKED_PRODUCTS_FROM_ALL_SQL.format(table=cls.__tablename__))
+        else:
+            statement = cls._remove_products_statement(
+                REMOVE_PRODUCTS_FROM_ALL_SQL,
+                "supplier_products(products, products_packed) && CAST(:ids AS {products_type})")
+        row = db.session.execute(statement, {'ids': products, 'expected': None}).first()
+        if row['updated']:
+            supplier_cache.publish(db.session)
+        db.session.commit()
+        if row['updated']:
+            supplier_cache.invalidate()
+        logger.info("Removed %d product(s) from %d suppliers", len(products), row['updated'])
+        return row['updated'], row['missing']
+
+    @classmethod
+    def _add_linked_products(cls, supplier_id: int, products: List[int],
+                             expected_version: int = None) -> dict:
+        """add_products_by_id for the table storage: inserts one
+        supplier_product row per new product under the Supplier row lock
+        """
+        cls._lock_linked_supplier(supplier_id, expected_version)
+        added = {product_id for product_id, in db.session.execute(
+            text(ADD_LINKED_PRODUCTS_SQL), {'id': supplier_id, 'new': products})}
+        if len(added) < len(products):
+            db.session.rollback()
+            raise DuplicateProduct("400 BAD REQUEST: Duplicated products: {}"
+                                   .format(set(products) - added))
+        row = db.session.execute(cls._linked_supplier_statement(TOUCH_LINKED_SUPPLIER_SQL),
+                                 {'id': supplier_id}).first()
+        supplier_cache.publish(db.session, supplier_id)
+        db.session.commit()
+        supplier_cache.invalidate(supplier_id)
+        return dict(row)
+
+    @classmethod
+    def _remove_linked_products(cls, supplier_id: int, products: List[int],
+                                expected_version: int = None) -> Tuple[dict, List[int]]:
+        """remove_products_by_id for the table storage: deletes the
+        supplier_product rows of the products under the Supplier row lock
+        """
+        cls._lock_linked_supplier(supplier_id, expected_version)
+        removed = {product_id for product_id, in db.session.execute(
+            text(REMOVE_LINKED_PRODUCTS_SQL), {'id': supplier_id, 'ids': products})}
+        row = db.session.execute(cls._linked_supplier_statement(
+            TOUCH_LINKED_SUPPLIER_SQL if removed else LINKED_SUPPLIER_SQL),
+                                 {'id': supplier_id}).first()
+        if removed:
+            supplier_cache.publish(db.session, supplier_id)
+        db.session.commit()
+        if removed:
+            supplier_cache.invalidate(supplier_id)
+        return dict(row), sorted(set(products) - removed)
+
+    @classmethod
+    def _lock_linked_supplier(cls, supplier_id: int, expected_version: int = None):
+        version = db.session.execute(text(LOCK_SUPPLIER_SQL.format(table=cls.__tablename__)),
+                                     {'id': supplier_id}).scalar()
+        if version is None:
+            db.session.rollback()
+            raise NotFound("404 NOT FOUND: Supplier with provided fields {} not found"
+                           .format({'id': supplier_id}))
+        if expected_version is not None and version != expected_version:
+            db.session.rollback()
+            cls._check_version(supplier_id, version, expected_version)
+
+    @classmethod
+    def _linked_supplier_statement(cls, sql: str):
+        return text(sql.format(table=cls.__tablename__,
+                               products=LINKED_PRODUCTS_SQL.format(table=cls.__tablename__)))
+
+    @classmethod
+    def _check_version(cls, supplier_id: int, version: int, expected_version: int):
+        if expected_version is not None and version != expected_version:
+            raise VersionConflict(
+                "412 PRECONDITION FAILED: Supplier {} is at version {}, not {}"
+                .format(supplier_id, version, expected_version))
+
+    @classmethod
+    def _add_products_statement(cls):
+        products_type = cls.__table__.c.products.type.compile(dialect=db.engine.dialect)
+        return text(ADD_PRODUCTS_SQL.format(
+            table=cls.__tablename__, products_type=products_type,
+            set_products=cls._set_products_sql(
+                ADD_PRODUCTS_VALUE.format(products_type=products_type))))
+
+    @classmethod
+    def _remove_products_statement(cls, sql: str, where: str):
+        products_type = cls.__table__.c.products.type.compile(dialect=db.engine.dialect)
+        return text(sql.format(table=cls.__tablename__, products_type=products_type,
+                               where=where.format(products_type=products_type),
+                               set_products=cls._set_products_sql(REMOVE_PRODUCTS_VALUE)))
+
+    @classmethod
+    def _set_products_sql(cls, value: str) -> str:
+        return "products = {}, products_packed = {}".format(*cls.products_sql(value))
+
+    @classmethod
+    def _parse_products_to_remove(cls, products: Union[List[int], Set[int], str]
+                                  ) -> List[int]:
+        products = cls._parse_product_ids(products)
+        if not products:
+            raise MissingInfo("400 BAD REQUEST: no product to remove")
+        return products
+
+    @classmethod
+    def delete_where(cls, supplier_info: dict) -> int:
+        """Deletes every Supplier matching supplier_info
+        Runs as a single DELETE statement
+        :param supplier_info: the fields to filter by, as for find_all
+        :return: the number of Suppliers deleted
+        """
+        count = cls.filter_query(supplier_info).delete(synchronize_session=False)
+        supplier_cache.publish(db.session)
+        db.session.commit()
+        supplier_cache.invalidate()
+        logger.info("Deleted %d suppliers", count)
+        return count
+
+    @classmethod
+    def update_where(cls, supplier_info: dict, data: dict) -> int:
+        """Updates every Supplier matching supplier_info with data
+        Runs as a single UPDATE statement. Only the non-empty name,
+        email, address and products in data are set
+        :param supplier_info: the fields to filter by, as for find_all
+        :param data: the new field values
+        :return: the number of Suppliers updated
+        """
+        if not isinstance(data, dict):
+            raise WrongArgType("400 BAD REQUEST: <class 'dict'> expected for data, "
+                               "got %s" % type(data))
+        values = {key: data[key] for key in ('name', 'email', 'address', 'products')
+                  if data.get(key) not in (None, "", [])}
+        if not values:
+            raise MissingInfo("400 BAD REQUEST: no field to update")
+        errors = []
+        for field, check in (('name', validation.check_name),
+                             ('email', validation.check_email),
+                             ('address', validation.check_address)):
+            error = check(values[field]) if field in values else None
+            if error is not None:
+                errors.append(validation.FieldError(field, error))
+        if 'products' in values:
+            values['products'], error = validation.parse_product_ids(values['products'],
+                                                                     allow_str=False)
+            if error is not None:
+                errors.append(validation.FieldError('products', error))
+        validation.raise_errors(errors)
+        query = cls.filter_query(supplier_info)
+        if 'products' in values:
+            products = values['products']
+            values.update(cls.products_values(products))
+            if cls.products_storage == TABLE_STORAGE:
+                # the filter may match on the products about to change
+                ids = [supplier_id for supplier_id, in
+                       query.with_entities(cls.id).with_for_update(of=cls)]
+                cls.link_products(db.session.connection(), ids, products)
+                query = cls.query.filter(cls.id.in_(ids))
+        values['version'] = cls.version + 1
+        count = query.update(values, synchronize_session=False)
+        supplier_cache.publish(db.session)
+        db.session.commit()
+        supplier_cache.invalidate()
+        logger.info("Updated %d suppliers", count)
+        return count
+
     ##################################################
     # STATIC METHODS
     ##################################################
@@ -156,6 +1116,38 @@ class Supplier(db.Model):
                             products=products)
         return supplier
 
+    @staticmethod
+    def validate_dict(data: dict) -> dict:
+        """
+        Validates a supplier dictionary with the same rules as the
+        constructor, without building a Supplier
+        Args:
+            data (dict): A dictionary containing the supplier data
+        Returns the column values to store for the supplier
+        """
+        row, errors = validation.validate_supplier(data)
+        validation.raise_errors(errors)
+        return row
+
+    @staticmethod
+    def validate_update(current: dict, data: dict) -> dict:
+        """
+        Validates an update of a supplier: the fields of data that are
+        given and not empty replace those of current
+        Args:
+            current (dict): the supplier as serialize_to_dict returns it
+            data (dict): the fields to update
+        Returns the column values to store for the supplier
+        """
+        if not isinstance(data, dict):
+            raise WrongArgType("400 BAD REQUEST: <class 'dict'> expected for data, "
+                               "got %s" % type(data))
+        values = {field: data[field] if field in data and data[field] not in ("", [])
+                  else current[field] for field in validation.FIELDS}
+        row, errors = validation.validate_supplier(values, check_id=False)
+        validation.raise_errors(errors)
+        return row
+
     @staticmethod
     def deserialize_from_json(data: str) -> "Supplier":
         """
@@ -184,57 +1176,55 @@ class Supplier(db.Model):
         except Exception:
             db.session.rollback()
 
-    def update(self, data: dict) -> "Supplier":
+    def update(self, data: dict, expected_version: int = None) -> "Supplier":
         """
         Updates self with data in dict
-        Saves changes to the database
+        Saves changes to the database with an UPDATE conditional on the
+        version self was loaded at, and raises VersionConflict if another
+        write got there first, or if self is not at expected_version
         """
-        self.name = data["name"] if "name" in data and data["name"] != "" else self.name
-        self.email = data["email"] if "email" in data and data["email"] != "" else self.email
-        self.address = data["address"] if "address" in data and data["address"] != "" \
-            else self.address
-        self.products = data["products"] if "products" in data and data["products"] != []\
-                                            else self.products
-
-        self._check_name(self.name)
-        self._check_email(self.email)
-        self._check_address(self.address)
-        self._check_product_ids(self.products)
-
-        self.products = sorted(set(self.products))
-
-        self._check_contact_methods()
-        db.session.commit()
+        self._check_version(self.id, self.version, expected_version)
+        row = self.validate_update(self.serialize_to_dict(), data)
+        for field, value in row.items():
+            setattr(self, field, value)
+        supplier_cache.publish(db.session, self.id)
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflict("412 PRECONDITION FAILED: Supplier {} was changed "
+                                  "by another request".format(self.id))
+        supplier_cache.invalidate(self.id)
         return self
 
     def delete(self) -> None:
         """
         Deletes a supplier by its id in database
+        Deletes the row at whatever version another write left it, as the
+        ORM delete would check the version self was loaded at, and raises
+        NotFound if another request deleted it first
         """
-        db.session.delete(self)
+        supplier_id = self.id
+        deleted = Supplier.query.filter(Supplier.id == supplier_id) \
+            .delete(synchronize_session='evaluate')
+        if not deleted:
+            db.session.rollback()
+            raise NotFound("404 NOT FOUND: Supplier with provided fields {} not found"
+                           .format({'id': supplier_id}))
+        supplier_cache.publish(db.session, supplier_id)
         db.session.commit()
+        supplier_cache.invalidate(supplier_id)
 
     def add_products(self, products: Union[List[int], Set[int], str]) -> "Supplier":
         """
         Adds the list of suppliers to self and commits to database.
+        Runs as a single atomic UPDATE, see add_products_by_id.
         Returns self
         """
-        if isinstance(products, str):
-            try:
-                products = list(map(int, products.strip().split(',')))
-            except ValueError:
-                raise InvalidFormat("400 BAD REQUEST: products cannot be parsed")
-        self._check_product_ids(products, False)
-        current_products = self.products or []
-        duplicates = set(current_products).intersection(set(products))
-
-        if len(duplicates) != 0:
-            raise DuplicateProduct(
-                "400 BAD REQUEST: Duplicated products: {}".format(duplicates))
-        new_products = list(current_products) + list(products)
-        return self.update({
-            "products": new_products
-        })
+        row = self.add_products_by_id(self.id, products)
+        for key in ('products', 'version', 'updated_at'):
+            set_committed_value(self, key, row[key])
+        return self
 
     def serialize_to_dict(self) -> dict:
         """Serializes a supplier into a dictionary"""
@@ -248,66 +1238,64 @@ class Supplier(db.Model):
 
     def serialize_to_json(self) -> str:
         '''convert the supplier to JSON formatted string'''
-        return json.dumps(self.serialize_to_dict(), indent=4)
+        return orjson.dumps(self.serialize_to_dict()).decode()
 
     ##################################################
-    # PRIVATE INSTANCE METHODS
+    # PRIVATE METHODS
     ##################################################
-    def _check_name(self, name: str) -> None:
-        '''check the type of name'''
-        if name is None or name == "":
-            raise MissingInfo("400 BAD REQUEST: supplier name is required")
-        elif not isinstance(name, str):
-            raise WrongArgType("400 BAD REQUEST: class<'str'> expected for supplier name, "
-                               "got %s" % type(name))
-
-    def _check_email(self, email: str) -> None:
-        '''check the type of email'''
-        regex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-        if email is not None and not isinstance(email, str):
-            raise WrongArgType("400 BAD REQUEST: <class 'str'> expected for email, "
-                               "got %s" % type(email))
-        elif email != "" and email is not None and\
-                not re.fullmatch(regex, email):
-            raise InvalidFormat("400 BAD REQUEST: wrong email format")
-
-    def _check_address(self, address: str) -> None:
-        '''check the type of address'''
-        if address is not None and not isinstance(address, str):
-            raise WrongArgType("400 BAD REQUEST: <class 'str'> expected for address, "
-                               "got %s" % type(address))
-
-    def _check_product_id(self, product_id: int) -> None:
-        '''check the type of product'''
-        if not isinstance(product_id, int):
-            raise WrongArgType("400 BAD REQUEST: class<'int'> expected for product ID, "
-                               "got %s" % type(product_id))
-        elif (product_id <= 0 or product_id >= 1e15):
-            raise OutOfRange("400 BAD REQUEST: product id is not within range (0, 1e15), "
-                             "got %s" % id)
-
-    def _check_product_ids(self, product_ids:
-                           Union[List[int], Set[int]], is_self=True) -> None:
-        '''check the type of product ids'''
-        if product_ids is None:
-            product_ids = []
-            if is_self:
-                self.products = product_ids
-            return
-        elif is_self and isinstance(product_ids, str):
-            try:
-                product_ids = list(map(int, product_ids.strip().split(',')))
-                self.products = product_ids
-            except ValueError:
-                raise InvalidFormat("400 BAD REQUEST: products cannot be parsed")
-        elif not isinstance(product_ids, (List, Set)):
-            raise WrongArgType("400 BAD REQUEST: class<'List'> or class<'Set'> expected "
-                               "for product ids, got %s" % type(product_ids))
-        for id in product_ids:
-            self._check_product_id(id)
-
-    def _check_contact_methods(self) -> None:
-        if (self.email is None and self.address is None) or\
-                (self.email == "" and self.address == ""):
-            raise MissingInfo("400 BAD REQUEST: At least one contact method "
-                              "(email or address) is required")
+    @staticmethod
+    def _parse_product_ids(product_ids: Union[List[int], Set[int], str]) -> List[int]:
+        '''check the product ids and return them sorted without duplicates'''
+        product_ids, error = validation.parse_product_ids(product_ids)
+        if error is not None:
+            raise error
+        return product_ids
+
+
+######################################################################
+#  P R O D U C T S   S T O R A G E
+######################################################################
+@event.listens_for(Supplier, 'before_insert')
+@event.listens_for(Supplier, 'before_update')
+def _store_products(mapper, connection, supplier: Supplier) -> None:
+    '''Writes changed products to the columns products_storage says'''
+    # pylint: disable=unused-argument
+    if inspect(supplier).attrs.products.history.has_changes():
+        products = supplier.products
+        for column, value in Supplier.products_values(products).items():
+            setattr(supplier, column, value)
+        if Supplier.products_storage == TABLE_STORAGE:
+            # linked once the row is written, and its id known
+            supplier.__dict__['_products_to_link'] = products
+
+
+@event.listens_for(Supplier, 'after_insert')
+@event.listens_for(Supplier, 'after_update')
+def _restore_products(mapper, connection, supplier: Supplier) -> None:
+    # pylint: disable=unused-argument
+    products = supplier.__dict__.pop('_products_to_link', None)
+    if products is not None:
+        Supplier.link_products(connection, [supplier.id], products)
+        set_committed_value(supplier, 'products', products)
+    else:
+        _unpack_products(supplier)
+
+
+@event.listens_for(Supplier, 'load')
+@event.listens_for(Supplier, 'refresh')
+def _load_products(supplier: Supplier, *args) -> None:
+    # pylint: disable=unused-argument
+    _unpack_products(supplier)
+
+
+def _unpack_products(supplier: Supplier) -> None:
+    '''Decodes packed or linked products into the products attribute'''
+    values = supplier.__dict__
+    if values.get('products') is not None:
+        return
+    if values.get('products_packed') is not None:
+        set_committed_value(supplier, 'products',
+                            product_codec.unpack(values['products_packed']))
+    elif Supplier.products_storage == TABLE_STORAGE and \
+            values.get('linked_products') is not None:
+        set_committed_value(supplier, 'products', values['linked_products'])
@@ -1,4 +1,8 @@
 class SupplierException(Exception):
+    # the {field, message} of every invalid field of the record, set
+    # when the exception is raised by the validation
+    errors = ()
+
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
 
@@ -31,3 +35,8 @@ class DuplicateProduct(SupplierException):
 class InvalidFormat(SupplierException):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
+
+
+class VersionConflict(SupplierException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
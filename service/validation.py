@@ -0,0 +1,151 @@
+'''
+Validation of the Supplier fields
+
+The checks return the error of a field instead of raising it, so every
+problem of a record is collected in one pass; raise_errors() then
+raises the first one with all of them attached as its errors. Product
+ids are checked as a whole: converting them to an array('q') checks
+in C that each one is an integer, and the ends of the sorted ids that
+are stored anyway bound their range, so the per-element loop only runs
+to describe the first bad id of an invalid list.
+'''
+
+import re
+from array import array
+from typing import List, NamedTuple, Optional, Set, Tuple, Union
+from service.supplier_exception \
+    import SupplierException, MissingInfo, WrongArgType, \
+    UserDefinedIdError, OutOfRange, InvalidFormat
+
+EMAIL_PATTERN = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
+# product ids lie in the open interval (0, PRODUCT_ID_MAX)
+PRODUCT_ID_MAX = 10 ** 15
+
+FIELDS = ('name', 'email', 'address', 'products')
+
+
+class FieldError(NamedTuple):
+    '''The error found in one field of a record'''
+    field: str
+    error: SupplierException
+
+
+def check_name(name: str) -> Optional[SupplierException]:
+    '''Returns the error of a supplier name, if any'''
+    if name is None or name == "":
+        return MissingInfo("400 BAD REQUEST: supplier name is required")
+    if not isinstance(name, str):
+        return WrongArgType("400 BAD REQUEST: class<'str'> expected for supplier name, "
+                            "got %s" % type(name))
+    return None
+
+
+def check_email(email: str) -> Optional[SupplierException]:
+    '''Returns the error of an email, if any'''
+    if email is not None and not isinstance(email, str):
+        return WrongArgType("400 BAD REQUEST: <class 'str'> expected for email, "
+                            "got %s" % type(email))
+    if email and not EMAIL_PATTERN.fullmatch(email):
+        return InvalidFormat("400 BAD REQUEST: wrong email format")
+    return None
+
+
+def check_address(address: str) -> Optional[SupplierException]:
+    '''Returns the error of an address, if any'''
+    if address is not None and not isinstance(address, str):
+        return WrongArgType("400 BAD REQUEST: <class 'str'> expected for address, "
+                            "got %s" % type(address))
+    return None
+
+
+def check_product_id(product_id: int) -> Optional[SupplierException]:
+    '''Returns the error of a single product id, if any'''
+    if not isinstance(product_id, int):
+        return WrongArgType("400 BAD REQUEST: class<'int'> expected for product ID, "
+                            "got %s" % type(product_id))
+    if product_id <= 0 or product_id >= PRODUCT_ID_MAX:
+        return OutOfRange("400 BAD REQUEST: product id is not within range (0, 1e15), "
+                          "got %s" % product_id)
+    return None
+
+
+def check_contacts(email: str, address: str) -> Optional[SupplierException]:
+    '''Returns an error unless at least one contact method is given'''
+    if (email is None and address is None) or (email == "" and address == ""):
+        return MissingInfo("400 BAD REQUEST: At least one contact method "
+                           "(email or address) is required")
+    return None
+
+
+def parse_product_ids(product_ids: Union[List[int], Set[int], str, None],
+                      allow_str: bool = True
+                      ) -> Tuple[List[int], Optional[SupplierException]]:
+    '''
+    Checks product ids given as a list, a set or a comma separated
+    string, and returns them sorted without duplicates with the error
+    of the first invalid one, if any
+    '''
+    if product_ids is None:
+        return [], None
+    if allow_str and isinstance(product_ids, str):
+        try:
+            product_ids = list(map(int, product_ids.strip().split(',')))
+        except ValueError:
+            return [], InvalidFormat("400 BAD REQUEST: products cannot be parsed")
+    elif not isinstance(product_ids, (list, set)):
+        return [], WrongArgType("400 BAD REQUEST: class<'List'> or class<'Set'> expected "
+                                "for product ids, got %s" % type(product_ids))
+    try:
+        array('q', product_ids)
+        unique = sorted(set(product_ids))
+        valid = not unique or (unique[0] > 0 and unique[-1] < PRODUCT_ID_MAX)
+    except (TypeError, OverflowError):
+        valid = False
+    if not valid:
+        for product_id in product_ids:
+            error = check_product_id(product_id)
+            if error is not None:
+                return [], error
+        unique = sorted(set(product_ids))
+    return unique, None
+
+
+def validate_supplier(data: dict, check_id: bool = True
+                      ) -> Tuple[dict, List[FieldError]]:
+    '''
+    Checks every field of a supplier record
+    :param data: the record; a missing field counts as None
+    :param check_id: reject a record that sets its own id
+    :return: the column values to store, products sorted without
+             duplicates, and the errors of every invalid field
+    '''
+    if not isinstance(data, dict):
+        return {}, [FieldError(None, WrongArgType(
+            "400 BAD REQUEST: <class 'dict'> expected for data, got %s" % type(data)))]
+    errors = []
+    if check_id and data.get('id') is not None:
+        errors.append(FieldError('id', UserDefinedIdError("User cannot set the value of id")))
+    for field, check in (('name', check_name), ('email', check_email),
+                         ('address', check_address)):
+        error = check(data.get(field))
+        if error is not None:
+            errors.append(FieldError(field, error))
+    products, error = parse_product_ids(data.get('products'))
+    if error is not None:
+        errors.append(FieldError('products', error))
+    error = check_contacts(data.get('email'), data.get('address'))
+    if error is not None:
+        errors.append(FieldError('contact', error))
+    row = {field: data.get(field) for field in FIELDS}
+    row['products'] = products
+    return row, errors
+
+
+def raise_errors(errors: List[FieldError]) -> None:
+    '''Raises the first error, carrying every {field, message} as its errors'''
+    if errors:
+        error = errors[0].error
+        error.errors = [{'field': field, 'message': str(field_error)}
+                        for field, field_error in errors]
+        raise error
@@ -0,0 +1,72 @@
+"""
+Test cases for the compiled serializers and the orjson representation
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import json
+import unittest
+from flask_restx import fields, marshal
+from service import app
+from service.fast_json import compile_model, dumps, dumps_line
+from service.routes import supplier_model, removed_products_model
+
+
+######################################################################
+#  F A S T   J S O N   T E S T   C A S E S
+######################################################################
+class TestFastJson(unittest.TestCase):
+    """Test Cases for compile_model and the JSON encoding"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.rows = [
+            {'id': 1, 'name': "Ken", 'email': "ken@example.com",
+             'address': None, 'products': [1, 2, 3]},
+            {'id': 2, 'name': "Amy", 'address': "NY", 'products': []},
+            {'name': "Tom", 'unknown': True},
+        ]
+
+    def test_compiled_models_match_marshal(self):
+        """Output what marshal outputs, in the same order"""
+        for model in (supplier_model, removed_products_model):
+            convert = compile_model(model)
+            for row in self.rows:
+                row = dict(row, missing=[4])
+                self.assertEqual(list(convert(row).items()),
+                                 list(marshal(row, model).items()))
+            self.assertEqual(convert(self.rows), marshal(self.rows, model))
+        self.assertEqual(compile_model(supplier_model)(self.rows[0])['products'], "[1, 2, 3]")
+
+    def test_fields_fall_back_to_output(self):
+        """Fields with a default or a type of their own go through field.output"""
+        model = {
+            'count': fields.Integer(default=7),
+            'label': fields.String(attribute='name'),
+            'tags': fields.List(fields.Integer),
+        }
+        for row in ({}, {'count': "3", 'name': 5, 'tags': ["1", 2]}):
+            self.assertEqual(compile_model(model)(row), marshal(row, model))
+
+    def test_dumps(self):
+        """Encode to JSON bytes, indented only in debug mode"""
+        data = {'suppliers': {1: [2, 3]}, 'name': "Ké"}
+        with app.app_context():
+            encoded = dumps(data)
+            self.assertEqual(json.loads(encoded), {'suppliers': {'1': [2, 3]}, 'name': "Ké"})
+            self.assertEqual(encoded.count(b"\n"), 1)
+            app.debug = True
+            try:
+                self.assertGreater(dumps(data).count(b"\n"), 1)
+            finally:
+                app.debug = False
+        self.assertEqual(dumps_line([1, None]), b"[1,null]\n")
+
+    def test_swagger_docs(self):
+        """Keep documenting the Supplier model"""
+        resp = app.test_client().get("/api/swagger.json")
+        self.assertEqual(resp.status_code, 200)
+        definitions = resp.get_json()['definitions']
+        self.assertEqual(definitions['SupplierModel']['allOf'][0]['$ref'],
+                         "#/definitions/Supplier")
+        self.assertIn('products', definitions['Supplier']['properties'])
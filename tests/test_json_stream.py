@@ -0,0 +1,42 @@
+"""
+Test cases for the incremental JSON parsers
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import io
+import json
+import unittest
+from service.json_stream import iter_json_array, iter_ndjson
+from service.supplier_exception import InvalidFormat
+
+
+######################################################################
+#  J S O N   S T R E A M   T E S T   C A S E S
+######################################################################
+class TestJsonStream(unittest.TestCase):
+    """Test Cases for the incremental JSON parsers"""
+
+    def test_json_array_across_chunk_boundaries(self):
+        """Parse an array whatever the size of the chunks read"""
+        records = [{"name": "S{}".format(i), "products": list(range(i * 50))}
+                   for i in range(20)] + [123456789, "x", None, 1.5, []]
+        body = json.dumps(records).encode()
+        for chunk_size in (1, 7, 64, 4096):
+            self.assertEqual(list(iter_json_array(io.BytesIO(body), chunk_size)),
+                             records)
+        self.assertEqual(list(iter_json_array(io.BytesIO(b" [ ] "))), [])
+
+    def test_malformed_json_array(self):
+        """Reject bodies that are not a single well-formed array"""
+        for body in (b"", b"{}", b"[1, 2", b"[1 2]", b"[1,]", b"[1] 2",
+                     b'[{"a": ]', b"[\xff]"):
+            with self.assertRaises(InvalidFormat):
+                list(iter_json_array(io.BytesIO(body), 2))
+
+    def test_ndjson(self):
+        """Parse NDJSON, reporting malformed lines in place"""
+        records = list(iter_ndjson(io.BytesIO(b'{"a": 1}\n\n  \nnot json\n[2]')))
+        self.assertEqual(records[0], {"a": 1})
+        self.assertIsInstance(records[1], InvalidFormat)
+        self.assertEqual(records[2], [2])
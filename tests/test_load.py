@@ -0,0 +1,88 @@
+"""
+Test cases for the load-test harness
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import argparse
+import unittest
+import requests
+from benchmarks.load import (Recorder, compare, failed, parse_log, parse_mix, percentile,
+                             route_of, send, summarize)
+
+
+######################################################################
+#  L O A D   T E S T   C A S E S
+######################################################################
+class TestLoad(unittest.TestCase):
+    """Test Cases for parsing, summarizing and comparing load tests"""
+
+    def test_parse_mix(self):
+        """Parse operation weights"""
+        self.assertEqual(parse_mix("get=80, put=20"), {"get": 80, "put": 20})
+        self.assertRaises(argparse.ArgumentTypeError, parse_mix, "fetch=1")
+        self.assertRaises(argparse.ArgumentTypeError, parse_mix, "get=many")
+
+    def test_parse_log(self):
+        """Parse NDJSON and access log lines"""
+        lines = [
+            '{"method": "post", "path": "/api/suppliers", "body": {"name": "Ken"}}',
+            '127.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET /api/suppliers/7?x=1 HTTP/1.1" '
+            '200 12 "-" "curl/8.0"',
+            'not a request',
+        ]
+        self.assertEqual(parse_log(lines), [
+            ("POST", "/api/suppliers", {"name": "Ken"}),
+            ("GET", "/api/suppliers/7?x=1", None),
+        ])
+
+    def test_route_of(self):
+        """Name the route of a request"""
+        self.assertEqual(route_of("GET", "/api/suppliers/7?x=1"), "GET /api/suppliers/{id}")
+        self.assertEqual(route_of("POST", "/api/suppliers/7/products"),
+                         "POST /api/suppliers/{id}/products")
+
+    def test_percentile(self):
+        """Use nearest-rank percentiles"""
+        values = [float(value) for value in range(1, 101)]
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3.0], 0.99), 3)
+
+    def test_summarize_and_compare(self):
+        """Flag routes slower or with less throughput than the baseline"""
+        recorder = Recorder()
+        for value in range(1, 101):
+            recorder.record("get", value / 1000, failed=value == 100)
+        baseline = summarize(recorder, elapsed=10)
+        self.assertEqual(baseline["routes"]["get"]["requests"], 100)
+        self.assertEqual(baseline["routes"]["get"]["errors"], 1)
+        self.assertEqual(baseline["routes"]["get"]["throughput"], 10)
+        self.assertEqual(compare(baseline, baseline, 0.2), [])
+        slower = summarize(recorder, elapsed=20)
+        self.assertEqual(compare(slower, baseline, 0.2),
+                         ["get: 5.0 req/s < 10.0 req/s"])
+        self.assertEqual(compare(summarize(Recorder(), 1), baseline, 0.2),
+                         ["get: not exercised"])
+
+    def test_compare_errors(self):
+        """Flag routes failing more often than in the baseline, however fast"""
+        recorder = Recorder()
+        for value in range(1, 101):
+            recorder.record("get", value / 1000, failed=False)
+        baseline = summarize(recorder, elapsed=10)
+        recorder = Recorder()
+        for value in range(1, 101):
+            recorder.record("get", value / 10000, failed=value > 50)
+        self.assertEqual(compare(summarize(recorder, elapsed=10), baseline, 0.2),
+                         ["get: 50.0% errors > 0.0%"])
+        self.assertEqual(compare(baseline, summarize(recorder, elapsed=10), 0.2), [
+            "get: p95 95.0 ms > 9.5 ms", "get: p99 99.0 ms > 9.9 ms"])
+
+    def test_send_without_response(self):
+        """Record a request that got no response as failed"""
+        with requests.Session() as session:
+            resp = send(session, "http://127.0.0.1:1", ("GET", "/api/suppliers", None))
+        self.assertIsNone(resp)
+        self.assertTrue(failed(resp))
@@ -6,6 +6,7 @@ Test cases can be run with:
 While debugging just these tests it's convinient to use this:
     nosetests --stop tests/test_routes.py:TestSupplierServer
 """
+import gzip
 import json
 import logging
 import os
@@ -13,7 +14,8 @@ import unittest
 
 
 from service import status
-from service.supplier import db, init_db
+from service.cache import supplier_cache
+from service.supplier import Supplier, db, init_db
 from service.routes import app
 from .factories import SupplierFactory
 
@@ -63,6 +65,7 @@ class TestSupplierServer(unittest.TestCase):
         """Runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        supplier_cache.clear()  # ids are reused by the new tables
         self.app = app.test_client()
 
     def tearDown(self):
@@ -154,6 +157,90 @@ class TestSupplierServer(unittest.TestCase):
         self.assertEqual(resp.status_code,
                          status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_get_supplier_is_cached(self):
+        """Serve a Supplier from the cache until it is updated"""
+        test_supplier = self._create_suppliers(1)[0]
+        url = "{}/{}".format(BASE_URL, test_supplier.id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.headers["X-Cache"], "MISS")
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Cache"], "HIT")
+        self.assertEqual(resp.get_json()["name"], test_supplier.name)
+        resp = self.app.put(url, json={"name": "Renamed"},
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(url)
+        self.assertEqual(resp.headers["X-Cache"], "MISS")
+        self.assertEqual(resp.get_json()["name"], "Renamed")
+        self.app.delete(url)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_supplier_not_modified(self):
+        """Answer a conditional GET of an unchanged Supplier with 304"""
+        test_supplier = self._create_suppliers(1)[0]
+        url = "{}/{}".format(BASE_URL, test_supplier.id)
+        resp = self.app.get(url)
+        etag, last_modified = resp.headers["ETag"], resp.headers["Last-Modified"]
+        self.assertEqual(etag, '"1"')
+        for headers in ({"If-None-Match": etag},
+                        {"If-Modified-Since": last_modified}):
+            supplier_cache.clear()  # also answered without the cache
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.headers["ETag"], etag)
+            self.assertEqual(resp.data, b"")
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put(url, json={"name": "Renamed"}, content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        self.assertEqual(resp.get_json()["name"], "Renamed")
+
+    def test_list_suppliers_not_modified(self):
+        """Answer a conditional GET of an unchanged page with 304"""
+        suppliers = self._create_suppliers(3)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn("Last-Modified", resp.headers)
+        resp = self.app.get(BASE_URL, query_string="limit=2",
+                            headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # deleting the supplier after the page removes its Link header
+        self.app.delete("{}/{}".format(BASE_URL, suppliers[2].id))
+        resp = self.app.get(BASE_URL, query_string="limit=2",
+                            headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Link", resp.headers)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_search_suppliers(self):
+        """Search Suppliers by name or address"""
+        resp = self.app.get(BASE_URL, query_string="q=%20")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="q=acme&threshold=2")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="q=acme&after=MQ")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        if not Supplier.search_enabled:
+            resp = self.app.get(BASE_URL, query_string="q=acme")
+            self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+            self.skipTest("pg_trgm is not available")
+        for name in ("Acme Corp", "ACME Supplies", "Globex"):
+            self.app.post(BASE_URL, json={"name": name, "address": "NY"},
+                          content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(BASE_URL, query_string="q=acme+corp")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s["name"] for s in resp.get_json()],
+                         ["Acme Corp", "ACME Supplies"])
+        resp = self.app.get(BASE_URL, query_string="q=acme&limit=1")
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.get(BASE_URL, query_string="q=initech")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_supplier(self):
         """Get a single Supplier"""
         # first create a new Supplier
@@ -307,6 +394,23 @@ class TestSupplierServer(unittest.TestCase):
                          test_supplier['products'],
                          "Products does not match")
 
+    def test_get_suppliers_by_any_or_all_products(self):
+        """Get suppliers carrying any or all of the given products"""
+        for name, products in (("Ken", [2, 5, 8]), ("Tom", [8]), ("Amy", [3])):
+            resp = self.app.post(BASE_URL, json={"name": name, "address": "NY",
+                                                 "products": products},
+                                 content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get("{}?products_any=2,8".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s["name"] for s in resp.get_json()], ["Ken", "Tom"])
+        resp = self.app.get("{}?products_all=2,8".format(BASE_URL))
+        self.assertEqual([s["name"] for s in resp.get_json()], ["Ken"])
+        resp = self.app.get("{}?products_all=3,8".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("{}?products_any=x".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_all_suppliers(self):
         """Get all suppliers"""
         self._create_suppliers(3)
@@ -315,6 +419,59 @@ class TestSupplierServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(len(data), 3)
 
+    def test_get_suppliers_paged_with_cursor(self):
+        """Walk the supplier collection page by page"""
+        suppliers = self._create_suppliers(5)
+        resp = self.app.get("{}?limit=2".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s["id"] for s in resp.get_json()],
+                         [str(s.id) for s in suppliers[:2]])
+        seen = []
+        url = "{}?limit=2".format(BASE_URL)
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen += [s["id"] for s in resp.get_json()]
+            link = resp.headers.get("Link")
+            url = link[link.index("/api"):link.index(">")] if link else None
+        self.assertEqual(seen, [str(s.id) for s in suppliers])
+
+    def test_get_suppliers_page_size_is_capped(self):
+        """The server enforces a maximum page size"""
+        self._create_suppliers(3)
+        app.config["PAGE_SIZE_MAX"], page_size_max = 2, app.config["PAGE_SIZE_MAX"]
+        try:
+            resp = self.app.get("{}?limit=50".format(BASE_URL))
+        finally:
+            app.config["PAGE_SIZE_MAX"] = page_size_max
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn('rel="next"', resp.headers["Link"])
+
+    def test_get_suppliers_with_invalid_page_args(self):
+        """Reject malformed page sizes and cursors"""
+        resp = self.app.get("{}?limit=abc".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("{}?limit=0".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("{}?after=!!".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_suppliers_as_ndjson(self):
+        """Stream every supplier as NDJSON regardless of page size"""
+        suppliers = self._create_suppliers(3)
+        app.config["STREAM_BATCH_SIZE"], batch_size = 2, app.config["STREAM_BATCH_SIZE"]
+        try:
+            resp = self.app.get("{}?limit=1".format(BASE_URL),
+                                headers={"Accept": "application/x-ndjson"})
+        finally:
+            app.config["STREAM_BATCH_SIZE"] = batch_size
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [int(s.id) for s in suppliers])
+        self.assertEqual(rows[0]["products"], sorted(suppliers[0].products))
+
     def test_get_all_suppliers_even_with_invalid_attributes(self):
         """Get all suppliers even with invalid attributes"""
         self._create_suppliers(3)
@@ -463,6 +620,280 @@ class TestSupplierServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+    def test_conditional_writes(self):
+        """Only write a supplier whose version matches If-Match"""
+        resp = self.app.post(BASE_URL, json={"name": "TOM", "address": "asd",
+                                             "products": [1]},
+                             content_type=CONTENT_TYPE_JSON)
+        url = "{}/{}".format(BASE_URL, resp.json["id"])
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.put(url, json={"name": "Ken"}, content_type=CONTENT_TYPE_JSON,
+                            headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        for method, path, body in ((self.app.put, url, {"name": "Amy"}),
+                                   (self.app.post, url + "/products", {"products": [2]}),
+                                   (self.app.delete, url + "/products", {"products": [1]})):
+            resp = method(path, json=body, content_type=CONTENT_TYPE_JSON,
+                          headers={"If-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url, json={"name": "Amy"}, content_type=CONTENT_TYPE_JSON,
+                            headers={"If-Match": 'W/"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url, json={"name": "Amy"}, content_type=CONTENT_TYPE_JSON,
+                            headers={"If-Match": '"1", "2"'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(url + "/products", json={"products": [2]},
+                             content_type=CONTENT_TYPE_JSON, headers={"If-Match": '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"3"')
+        resp = self.app.put(url, json={"name": "Amy"}, content_type=CONTENT_TYPE_JSON,
+                            headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()["name"], "Amy")
+
+    def test_stats(self):
+        """Report the pool and cache statistics of the worker"""
+        self._create_suppliers(1)
+        resp = self.app.get("/api/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = resp.get_json()
+        self.assertEqual(stats["pid"], os.getpid())
+        pool = stats["pool"]
+        self.assertEqual(pool["size"], app.config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"])
+        self.assertGreater(pool["wait_seconds"]["count"], 0)
+        self.assertEqual(pool["wait_seconds"]["buckets"]["+Inf"],
+                         pool["wait_seconds"]["count"])
+        self.assertGreater(pool["connect_seconds"]["count"], 0)
+        self.assertIn("hits", stats["cache"])
+
+    def test_remove_products_from_supplier(self):
+        """Remove products from a supplier, by body or query string"""
+        resp = self.app.post(BASE_URL, json={"name": "TOM", "address": "asd",
+                                             "products": [1, 2, 3, 4]},
+                             content_type=CONTENT_TYPE_JSON)
+        url = "{}/{}/products".format(BASE_URL, resp.json["id"])
+        resp = self.app.delete(url, json={"products": [2, 9]},
+                               content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["products"], "[1, 3, 4]")
+        self.assertEqual(resp.get_json()["missing"], [9])
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        resp = self.app.delete(url, query_string="products=1,4")
+        self.assertEqual(resp.get_json()["products"], "[3]")
+        self.assertEqual(resp.get_json()["missing"], [])
+        resp = self.app.delete(url, query_string="products=a")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete(url, json={}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete("{}/0/products".format(BASE_URL), query_string="products=1")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_remove_products_from_all_suppliers(self):
+        """Remove products from every supplier carrying them"""
+        for products in ([1, 2], [2, 3], [4]):
+            self.app.post(BASE_URL, json={"name": "TOM", "address": "asd",
+                                          "products": products},
+                          content_type=CONTENT_TYPE_JSON)
+        resp = self.app.delete("/api/products/suppliers", json={"products": [2, 5]},
+                               content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"updated": 2, "missing": [5]})
+        resp = self.app.get(BASE_URL)
+        self.assertEqual([s["products"] for s in resp.get_json()], ["[1]", "[3]", "[4]"])
+
+    def test_bulk_create_suppliers(self):
+        """Create many suppliers from a JSON array"""
+        records = [{"name": "S{}".format(i), "address": "NY", "products": [i + 1]}
+                   for i in range(5)]
+        app.config["BULK_BATCH_SIZE"], batch_size = 2, app.config["BULK_BATCH_SIZE"]
+        try:
+            resp = self.app.post(BASE_URL + ":bulk", data=json.dumps(records),
+                                 content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["BULK_BATCH_SIZE"] = batch_size
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        body = resp.get_json()
+        self.assertEqual(body["created"], 5)
+        self.assertEqual(body["errors"], [])
+        resp = self.app.get(BASE_URL)
+        self.assertEqual([s["name"] for s in resp.get_json()],
+                         [r["name"] for r in records])
+        self.assertEqual([int(s["id"]) for s in resp.get_json()], body["ids"])
+
+    def test_create_supplier_reports_every_error(self):
+        """Report every invalid field of a rejected Supplier"""
+        resp = self.app.post(BASE_URL, json={"name": "", "email": "abc", "products": [1, 0]},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        body = resp.get_json()
+        self.assertEqual(body["message"], "400 BAD REQUEST: supplier name is required")
+        self.assertEqual([e["field"] for e in body["errors"]], ["name", "email", "products"])
+
+    def test_bulk_create_atomic_rejects_all(self):
+        """An invalid record aborts an atomic bulk create"""
+        records = [{"name": "Ken", "address": "NY"},
+                   {"name": "Tom"},
+                   {"name": "Amy", "email": "bad"}]
+        resp = self.app.post(BASE_URL + ":bulk", data=json.dumps(records),
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        body = resp.get_json()
+        self.assertEqual(body["created"], 0)
+        self.assertEqual([e["index"] for e in body["errors"]], [1, 2])
+        self.assertEqual(self.app.get(BASE_URL).get_json(), [])
+
+    def test_bulk_create_best_effort_ndjson(self):
+        """Best-effort bulk create from NDJSON keeps the valid records"""
+        lines = [json.dumps({"name": "Ken", "address": "NY"}),
+                 "not json",
+                 json.dumps({"name": "Tom", "address": "LA", "products": [-1]}),
+                 json.dumps({"name": "Amy", "email": "amy@nyu.edu"})]
+        resp = self.app.post(BASE_URL + ":bulk?mode=best-effort",
+                             data="\n".join(lines) + "\n",
+                             content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        body = resp.get_json()
+        self.assertEqual(body["created"], 2)
+        self.assertEqual([e["index"] for e in body["errors"]], [1, 2])
+        self.assertEqual(body["errors"][1]["errors"],
+                         [{"field": "products", "message": body["errors"][1]["message"]}])
+        resp = self.app.get(BASE_URL)
+        self.assertEqual([s["name"] for s in resp.get_json()], ["Ken", "Amy"])
+
+    def test_bulk_create_bad_requests(self):
+        """Reject malformed bulk create requests"""
+        resp = self.app.post(BASE_URL + ":bulk", data="[{}",
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + ":bulk", data="[]", content_type="text/csv")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.post(BASE_URL + ":bulk?mode=some", data="[]",
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_suppliers(self):
+        """Export every supplier as CSV, NDJSON or gzipped"""
+        self.app.post(BASE_URL, json={"name": "Ken", "email": "ken@nyu.edu",
+                                      "products": [5, 2]},
+                      content_type=CONTENT_TYPE_JSON)
+        self.app.post(BASE_URL, json={"name": "Tom", "address": "NY, 5th"},
+                      content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(BASE_URL + ":export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertEqual(resp.get_data(as_text=True).splitlines(),
+                         ["id,name,email,address,products",
+                          "1,Ken,ken@nyu.edu,,\"{2,5}\"",
+                          "2,Tom,,\"NY, 5th\",{}"])
+        resp = self.app.get(BASE_URL + ":export?format=ndjson&gzip=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/gzip")
+        rows = [json.loads(line) for line in
+                gzip.decompress(resp.get_data()).decode().splitlines()]
+        self.assertEqual(rows[0], {"id": 1, "name": "Ken", "email": "ken@nyu.edu",
+                                   "address": None, "products": [2, 5]})
+        resp = self.app.get(BASE_URL + ":export?format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_suppliers_by_filter(self):
+        """Delete every supplier matching a filter"""
+        for name, products in (("Ken", [2, 5]), ("Tom", [5]), ("Amy", [3])):
+            resp = self.app.post(BASE_URL, json={"name": name, "address": "NY",
+                                                 "products": products},
+                                 content_type=CONTENT_TYPE_JSON)
+        resp = self.app.delete("{}?products_any=5".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        resp = self.app.get(BASE_URL)
+        self.assertEqual([s["name"] for s in resp.get_json()], ["Amy"])
+        resp = self.app.delete("{}?name=Nobody".format(BASE_URL))
+        self.assertEqual(resp.get_json(), {"deleted": 0})
+
+    def test_delete_all_suppliers_requires_confirmation(self):
+        """Deleting without a filter needs all=true"""
+        self._create_suppliers(2)
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete("{}?country=inatsuma".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+        resp = self.app.delete("{}?all=true".format(BASE_URL))
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        self.assertEqual(self.app.get(BASE_URL).get_json(), [])
+
+    def test_update_suppliers_by_filter(self):
+        """Update every supplier matching a filter"""
+        for name in ("Ken", "Tom", "Amy"):
+            resp = self.app.post(BASE_URL, json={"name": name, "address": "NY"},
+                                 content_type=CONTENT_TYPE_JSON)
+        resp = self.app.patch("{}?address=NY&name=Ken".format(BASE_URL),
+                              json={"address": "LA", "products": [3, 1]},
+                              content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"updated": 1})
+        resp = self.app.get("{}?address=LA".format(BASE_URL))
+        self.assertEqual([(s["name"], s["products"]) for s in resp.get_json()],
+                         [("Ken", "[1, 3]")])
+        resp = self.app.patch("{}?all=true".format(BASE_URL), json={"email": "a@b.cn"},
+                              content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.get_json(), {"updated": 3})
+
+    def test_update_suppliers_by_filter_bad_requests(self):
+        """Reject invalid bulk updates"""
+        self._create_suppliers(1)
+        resp = self.app.patch(BASE_URL, json={"address": "LA"},
+                              content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for body in ({"email": "gg"}, {"products": [-1]}, {"name": 1}, {}):
+            resp = self.app.patch("{}?all=true".format(BASE_URL), json=body,
+                                  content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("{}?all=true".format(BASE_URL), data="x")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_list_suppliers_of_product(self):
+        """List the suppliers carrying a product"""
+        ids = []
+        for name, products in (("Ken", [2, 5]), ("Tom", [5]), ("Amy", [3])):
+            resp = self.app.post(BASE_URL, json={"name": name, "address": "NY",
+                                                 "products": products},
+                                 content_type=CONTENT_TYPE_JSON)
+            ids.append(resp.get_json()["id"])
+        resp = self.app.get("/api/products/5/suppliers")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s["id"] for s in resp.get_json()], ids[:2])
+        resp = self.app.get("/api/products/5/suppliers?limit=1")
+        self.assertEqual([s["id"] for s in resp.get_json()], ids[:1])
+        self.assertIn('rel="next"', resp.headers["Link"])
+        resp = self.app.get("/api/products/7/suppliers")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/api/products/abc/suppliers")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_map_products_to_suppliers(self):
+        """Map many products to their supplier ids in one request"""
+        ids = []
+        for name, products in (("Ken", [2, 5]), ("Tom", [5]), ("Amy", [3])):
+            resp = self.app.post(BASE_URL, json={"name": name, "address": "NY",
+                                                 "products": products},
+                                 content_type=CONTENT_TYPE_JSON)
+            ids.append(int(resp.get_json()["id"]))
+        expected = {"2": [ids[0]], "5": [ids[0], ids[1]], "9": []}
+        resp = self.app.get("/api/products/suppliers?products=5,2,9")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["suppliers"], expected)
+        resp = self.app.post("/api/products/suppliers", json={"products": [5, 2, 9]},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["suppliers"], expected)
+        resp = self.app.get("/api/products/suppliers?products=a")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/api/products/suppliers", json={"products": "5"},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_delete_supplier_does_not_exist(self):
         """
         Delete a supplier which does not exist
@@ -8,14 +8,19 @@ While debugging just these tests it's convinient to use this:
 """
 import json
 import os
+import threading
 import unittest
 import logging
+from unittest import mock
+import psycopg2
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
 from werkzeug.exceptions import NotFound
 from service import app
 from service.supplier import Supplier, db
 from service.supplier_exception \
     import InvalidFormat, MissingInfo, OutOfRange, WrongArgType,\
-    UserDefinedIdError, DuplicateProduct
+    UserDefinedIdError, DuplicateProduct, VersionConflict
 from .factories import SupplierFactory
 
 # DATABASE_URI \
@@ -30,6 +35,26 @@ if 'VCAP_SERVICES' in os.environ:
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 
 
+def start_workers(boot, workers=4):
+    """Runs boot in threads starting together like gunicorn workers;
+    returns the errors raised"""
+    errors = []
+
+    def start():
+        with app.app_context():
+            try:
+                boot()
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+    threads = [threading.Thread(target=start) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
 ######################################################################
 #  S U P P L I E R   M O D E L   T E S T   C A S E S
 ######################################################################
@@ -202,6 +227,164 @@ class TestSupplierModel(unittest.TestCase):
         self.assertEqual(supplier.email, suppliers[1].email)
         self.assertEqual(supplier.products, suppliers[1].products)
 
+    def test_find_page(self):
+        """Find Suppliers one keyset page at a time"""
+        suppliers = SupplierFactory.create_batch(5)
+        for supplier in suppliers:
+            supplier.create()
+        page = Supplier.find_page({}, limit=2)
+        self.assertEqual([s.id for s in page], [suppliers[0].id, suppliers[1].id])
+        page = Supplier.find_page({}, after=page[-1].id, limit=10)
+        self.assertEqual([s.id for s in page], [s.id for s in suppliers[2:]])
+        self.assertEqual(Supplier.find_page({}, after=suppliers[-1].id), [])
+
+    def test_find_by_any_or_all_products(self):
+        """Find Suppliers carrying any or all of some products"""
+        Supplier(name="Ken", email="Ken@gmail.com", products=[1, 2, 3]).create()
+        Supplier(name="Tom", email="Tom@gmail.com", products=[3, 4]).create()
+        Supplier(name="Amy", email="Amy@gmail.com", products=[5]).create()
+        found = Supplier.find_all({'products_any': [2, 4]})
+        self.assertEqual(sorted(s.name for s in found), ["Ken", "Tom"])
+        found = Supplier.find_all({'products_all': [3, 1]})
+        self.assertEqual([s.name for s in found], ["Ken"])
+        found = Supplier.find_all({'products_any': [3], 'name': "Tom"})
+        self.assertEqual([s.name for s in found], ["Tom"])
+        self.assertRaises(NotFound, Supplier.find_all, {'products_all': [1, 5]})
+
+    def test_supplier_ids_by_product(self):
+        """Map products to the Suppliers carrying them"""
+        ken = Supplier(name="Ken", email="Ken@gmail.com", products=[1, 2])
+        ken.create()
+        tom = Supplier(name="Tom", email="Tom@gmail.com", products=[2, 3])
+        tom.create()
+        self.assertEqual(Supplier.supplier_ids_by_product([2, 1, 4]),
+                         {1: [ken.id], 2: [ken.id, tom.id], 4: []})
+        self.assertEqual(Supplier.supplier_ids_by_product([]), {})
+
+    def test_missing_indexes_are_created(self):
+        """Indexes declared on the model are added to an existing table"""
+        db.session.execute("DROP INDEX ix_supplier_catalogue")
+        db.session.commit()
+        Supplier._create_missing_indexes()
+        indexes = {name for name, in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'supplier'")}
+        self.assertIn('ix_supplier_catalogue', indexes)
+
+    def test_workers_create_missing_indexes_together(self):
+        """Workers starting together create a missing index once"""
+        db.session.execute("DROP INDEX ix_supplier_catalogue")
+        db.session.commit()
+        self.assertEqual(start_workers(Supplier._create_missing_indexes), [])
+        indexes = {name for name, in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'supplier'")}
+        self.assertIn('ix_supplier_catalogue', indexes)
+
+    def test_products_are_migrated_to_bigint(self):
+        """integer[] products of an existing table are widened to bigint[]"""
+        Supplier(name="Ken", email="Ken@gmail.com", products=[1, 2]).create()
+        db.session.execute("ALTER TABLE supplier ALTER COLUMN products TYPE integer[]")
+        db.session.execute("CREATE INDEX ix_supplier_products ON supplier "
+                           "USING gin (products)")
+        db.session.commit()
+        Supplier._migrate_products()
+        columns = {column['name']: column['type'] for column in
+                   db.inspect(db.engine).get_columns('supplier')}
+        self.assertIsInstance(columns['products'].item_type, db.BigInteger)
+        indexes = {name for name, in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'supplier'")}
+        self.assertNotIn('ix_supplier_products', indexes)
+        self.assertEqual(Supplier.list()[0].products, [1, 2])
+
+    def test_workers_migrate_products_together(self):
+        """Workers starting together widen integer[] products once"""
+        Supplier(name="Ken", email="Ken@gmail.com", products=[1, 2]).create()
+        db.session.execute("ALTER TABLE supplier ALTER COLUMN products TYPE integer[]")
+        db.session.execute("CREATE INDEX ix_supplier_products ON supplier "
+                           "USING gin (products)")
+        db.session.commit()
+        self.assertEqual(start_workers(Supplier._migrate_products), [])
+        self.assertEqual(Supplier.list()[0].products, [1, 2])
+
+    def test_large_product_ids(self):
+        """Product ids beyond 32 bits are stored and looked up"""
+        large = [2 ** 31, 10 ** 15 - 1]
+        supplier = Supplier(name="Ken", email="Ken@gmail.com", products=large)
+        supplier.create()
+        supplier.add_products([2 ** 40])
+        self.assertEqual(Supplier.find_first(supplier.id).products,
+                         [2 ** 31, 2 ** 40, 10 ** 15 - 1])
+        self.assertEqual(len(Supplier.find_all({'products_any': [2 ** 40]})), 1)
+        self.assertEqual(Supplier.supplier_ids_by_product([10 ** 15 - 1]),
+                         {10 ** 15 - 1: [supplier.id]})
+
+    def test_missing_columns_are_added(self):
+        """Columns declared on the model are added to an existing table"""
+        Supplier(name="Ken", email="Ken@gmail.com").create()
+        db.session.execute("ALTER TABLE supplier DROP COLUMN version, "
+                           "DROP COLUMN updated_at")
+        db.session.commit()
+        Supplier._create_missing_columns()
+        columns = {column['name'] for column in
+                   db.inspect(db.engine).get_columns('supplier')}
+        self.assertTrue({'version', 'updated_at'} <= columns)
+        self.assertEqual(Supplier.list()[0].version, 1)
+
+    def test_workers_add_missing_columns_together(self):
+        """Workers starting together add a missing column once"""
+        Supplier(name="Ken", email="Ken@gmail.com").create()
+        db.session.execute("ALTER TABLE supplier DROP COLUMN version, "
+                           "DROP COLUMN updated_at")
+        db.session.commit()
+        self.assertEqual(start_workers(Supplier._create_missing_columns), [])
+        self.assertEqual(Supplier.list()[0].version, 1)
+
+    def test_version_is_bumped_by_writes(self):
+        """Every write bumps the version and updated_at of a Supplier"""
+        supplier = Supplier(name="Ken", email="Ken@gmail.com", products=[1])
+        supplier.create()
+        version, created_at = Supplier.find_version(supplier.id)
+        self.assertEqual(version, 1)
+        supplier.update({"name": "Super Ken"})
+        self.assertEqual(Supplier.find_version(supplier.id)[0], 2)
+        supplier.add_products([2])
+        self.assertEqual(Supplier.find_version(supplier.id)[0], 3)
+        Supplier.update_where({'name': "Super Ken"}, {'address': "NY"})
+        version, updated_at = Supplier.find_version(supplier.id)
+        self.assertEqual(version, 4)
+        self.assertGreater(updated_at, created_at)
+        self.assertEqual(Supplier.find_page_versions({}, None, 10),
+                         [(supplier.id, 4, updated_at)])
+        self.assertIsNone(Supplier.find_version(0))
+
+    def test_search(self):
+        """Find Suppliers by trigram similarity of name or address"""
+        if not Supplier.search_enabled:
+            self.skipTest("pg_trgm is not available")
+        Supplier.create_search_indexes()
+        acme = Supplier(name="Acme Corp", email="a@acme.com")
+        acme.create()
+        acme_west = Supplier(name="West Coast Trading", address="1 Acme Road")
+        acme_west.create()
+        Supplier(name="Globex", email="g@globex.com").create()
+        found = Supplier.search("acme")
+        self.assertEqual({s.id for s in found}, {acme.id, acme_west.id})
+        self.assertEqual(Supplier.search("acme", {'email': "a@acme.com"}), [acme])
+        self.assertEqual(Supplier.search("acme", limit=1), found[:1])
+        self.assertEqual(Supplier.search("acme corp")[0], acme)
+        self.assertEqual(Supplier.search("glbex", threshold=0.3)[0].name, "Globex")
+        self.assertEqual(Supplier.search("zzzz"), [])
+
+    def test_workers_create_search_indexes_together(self):
+        """Workers starting together all enable search, or none does"""
+        enabled = Supplier.search_enabled
+        self.assertEqual(start_workers(Supplier.create_search_indexes), [])
+        self.assertEqual(Supplier.search_enabled, enabled)
+        # other errors than an unavailable extension are not hidden
+        error = DBAPIError("CREATE EXTENSION", {}, psycopg2.errors.DeadlockDetected())
+        with mock.patch.object(Supplier, "_lock_schema", side_effect=error):
+            self.assertRaises(DBAPIError, Supplier.create_search_indexes)
+        self.assertEqual(Supplier.search_enabled, enabled)
+
     def test_find_not_found(self):
         """Find or return 404 NOT found"""
         self.assertRaises(NotFound, Supplier.find_first, {'id': 0})
@@ -222,6 +405,31 @@ class TestSupplierModel(unittest.TestCase):
         self.assertEqual(updated_supplier.address, "super ken home")
         self.assertEqual(updated_supplier.email, "Ken@gmail.com")
 
+    def test_update_version_conflict(self):
+        """Refuse an update made against an outdated version"""
+        supplier = Supplier(name="Ken", email="Ken@gmail.com")
+        supplier.create()
+        supplier_id = supplier.id
+        self.assertRaises(VersionConflict, supplier.update, {"name": "Tom"}, 2)
+        db.session.rollback()
+        supplier.update({"name": "Tom"}, 1)
+        self.assertEqual(Supplier.find_version(supplier_id)[0], 2)
+        self.assertEqual(supplier.version, 2)
+        # another worker writes between our read and our write
+        other = Session(bind=db.engine)
+        other.query(Supplier).get(supplier_id).name = "Amy"
+        other.commit()
+        other.close()
+        self.assertRaises(VersionConflict, supplier.update, {"name": "Kim"})
+        self.assertEqual(Supplier.find_first(supplier_id).name, "Amy")
+        self.assertRaises(VersionConflict, Supplier.add_products_by_id,
+                          supplier_id, [1], 2)
+        self.assertEqual(Supplier.add_products_by_id(supplier_id, [1], 3)['version'], 4)
+        self.assertRaises(VersionConflict, Supplier.remove_products_by_id,
+                          supplier_id, [1], 3)
+        supplier, _ = Supplier.remove_products_by_id(supplier_id, [1], 4)
+        self.assertEqual((supplier['products'], supplier['version']), ([], 5))
+
     def test_update_supplier_missing_email(self):
         """
         Update the supplier with missing data should raise exception
@@ -235,6 +443,37 @@ class TestSupplierModel(unittest.TestCase):
         }
         self.assertRaises(MissingInfo, supplier.update, update_json)
 
+    def test_delete_changed_supplier(self):
+        """Delete a Supplier another write changed or deleted since its read"""
+        for name in ("Ken", "Amy"):
+            Supplier(name=name, email="Ken@gmail.com").create()
+        ken, amy = Supplier.find_first(1), Supplier.find_first(2)
+        # another worker writes between our read and our delete
+        other = Session(bind=db.engine)
+        other.query(Supplier).get(ken.id).name = "Kim"
+        other.delete(other.query(Supplier).get(amy.id))
+        other.commit()
+        other.close()
+        self.assertRaises(NotFound, amy.delete)
+        ken.delete()
+        self.assertRaises(NotFound, Supplier.find_first, ken.id)
+
+    def test_update_and_delete_where(self):
+        """Update and delete Suppliers matching a filter"""
+        Supplier(name="Ken", email="Ken@gmail.com", products=[1, 2]).create()
+        Supplier(name="Tom", email="Tom@gmail.com", products=[2, 3]).create()
+        Supplier(name="Amy", email="Amy@gmail.com", products=[4]).create()
+        count = Supplier.update_where({'products_any': [2]},
+                                      {'address': "NY", 'products': [9, 8, 9]})
+        self.assertEqual(count, 2)
+        found = Supplier.find_all({'address': "NY"})
+        self.assertEqual([s.products for s in found], [[8, 9], [8, 9]])
+        self.assertRaises(MissingInfo, Supplier.update_where, {}, {'email': ""})
+        self.assertRaises(WrongArgType, Supplier.update_where, {}, {'products': 1})
+        self.assertRaises(OutOfRange, Supplier.update_where, {}, {'products': [0]})
+        self.assertEqual(Supplier.delete_where({'address': "NY"}), 2)
+        self.assertEqual([s.name for s in Supplier.list()], ["Amy"])
+
     def test_products_added_correctly(self):
         """
         Create a supplier and add to the product list
@@ -271,6 +510,62 @@ class TestSupplierModel(unittest.TestCase):
         updated_supplier = Supplier.find_first(supplier.id)
         self.assertEqual(updated_supplier.products, [1, 3, 4, 6])
 
+    def test_concurrent_add_products(self):
+        """Concurrent adds to one Supplier never drop each other's products"""
+        supplier = Supplier(name="Ken", email="Ken@gmail.com", products=[1])
+        supplier.create()
+        supplier_id = supplier.id
+        errors = []
+
+        def add(first):
+            with app.app_context():
+                try:
+                    for product in range(first, first + 20):
+                        Supplier.add_products_by_id(supplier_id, [product, 1000 + product])
+                except Exception as error:  # pylint: disable=broad-except
+                    errors.append(error)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=add, args=(first,))
+                   for first in (100, 200, 300, 400)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+        supplier = Supplier.find_first({'id': supplier_id})
+        self.assertEqual(len(supplier.products), 161)
+        self.assertEqual(supplier.products, sorted(supplier.products))
+        self.assertEqual(supplier.version, 81)
+        with self.assertRaises(DuplicateProduct) as context:
+            supplier.add_products([5, 100, 1100])
+        self.assertIn("{100, 1100}", str(context.exception))
+        self.assertEqual(Supplier.find_version(supplier_id)[0], 81)
+        self.assertRaises(NotFound, Supplier.add_products_by_id, 0, [5])
+
+    def test_remove_products(self):
+        """Remove products from one Supplier or from all of them"""
+        ken = Supplier(name="Ken", email="Ken@gmail.com", products=[1, 2, 3, 4])
+        ken.create()
+        tom = Supplier(name="Tom", email="Tom@gmail.com", products=[3, 5])
+        tom.create()
+        supplier, missing = Supplier.remove_products_by_id(ken.id, [4, 2, 9])
+        self.assertEqual(supplier['products'], [1, 3])
+        self.assertEqual(supplier['version'], 2)
+        self.assertEqual(missing, [9])
+        supplier, missing = Supplier.remove_products_by_id(ken.id, "7,8")
+        self.assertEqual((supplier['products'], supplier['version']), ([1, 3], 2))
+        self.assertEqual(missing, [7, 8])
+        self.assertRaises(NotFound, Supplier.remove_products_by_id, 0, [1])
+        self.assertRaises(MissingInfo, Supplier.remove_products_by_id, ken.id, [])
+        self.assertRaises(OutOfRange, Supplier.remove_products_from_all, [0])
+        self.assertEqual(Supplier.remove_products_from_all([3, 5, 6]), (2, [6]))
+        db.session.expire_all()
+        self.assertEqual(Supplier.find_first(ken.id).products, [1])
+        self.assertEqual(Supplier.find_first(tom.id).products, [])
+
     def test_add_product_invalid_products(self):
         """
         Create a supplier without any products and add invalid products
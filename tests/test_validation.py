@@ -0,0 +1,78 @@
+"""
+Test cases for the Supplier validation
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import unittest
+from service.validation import (PRODUCT_ID_MAX, parse_product_ids, raise_errors,
+                                validate_supplier)
+from service.supplier_exception \
+    import InvalidFormat, MissingInfo, OutOfRange, WrongArgType, UserDefinedIdError
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidation(unittest.TestCase):
+    """Test Cases for the field checks"""
+
+    def test_parse_product_ids(self):
+        """Sort and deduplicate valid product ids"""
+        self.assertEqual(parse_product_ids([3, 1, 3]), ([1, 3], None))
+        self.assertEqual(parse_product_ids({2, 1}), ([1, 2], None))
+        self.assertEqual(parse_product_ids(" 2,1"), ([1, 2], None))
+        self.assertEqual(parse_product_ids([]), ([], None))
+        self.assertEqual(parse_product_ids(None), ([], None))
+        products = list(range(PRODUCT_ID_MAX - 100000, PRODUCT_ID_MAX))
+        self.assertEqual(parse_product_ids(products[::-1]), (products, None))
+
+    def test_invalid_product_ids(self):
+        """Describe the first invalid product id"""
+        cases = (
+            ([1, 2.0], WrongArgType),
+            ([1, "2"], WrongArgType),
+            ([1, 0], OutOfRange),
+            ([-5], OutOfRange),
+            ([PRODUCT_ID_MAX], OutOfRange),
+            ([2 ** 70], OutOfRange),
+            ((1, 2), WrongArgType),
+            ("1,a", InvalidFormat),
+        )
+        for products, exception in cases:
+            _, error = parse_product_ids(products)
+            self.assertIsInstance(error, exception, products)
+        _, error = parse_product_ids([1, 0])
+        self.assertIn("got 0", str(error))
+        _, error = parse_product_ids("1,2", allow_str=False)
+        self.assertIsInstance(error, WrongArgType)
+
+    def test_collect_every_error(self):
+        """Report every invalid field of a record"""
+        row, errors = validate_supplier({'id': 1, 'name': "", 'email': "abc",
+                                         'products': [1, 0]})
+        self.assertEqual([field for field, _ in errors], ['id', 'name', 'email', 'products'])
+        self.assertEqual([type(error) for _, error in errors],
+                         [UserDefinedIdError, MissingInfo, InvalidFormat, OutOfRange])
+        self.assertEqual(row['products'], [])
+        _, errors = validate_supplier({'name': "Ken"})
+        self.assertEqual([field for field, _ in errors], ['contact'])
+        _, errors = validate_supplier([])
+        self.assertIsInstance(errors[0].error, WrongArgType)
+
+    def test_valid_record(self):
+        """Return the column values of a valid record"""
+        row, errors = validate_supplier({'name': "Ken", 'email': "ken@example.com",
+                                         'products': "3,1", 'extra': 1})
+        self.assertEqual(errors, [])
+        self.assertEqual(row, {'name': "Ken", 'email': "ken@example.com",
+                               'address': None, 'products': [1, 3]})
+
+    def test_raise_errors(self):
+        """Raise the first error carrying all of them"""
+        raise_errors([])
+        _, errors = validate_supplier({'name': 1, 'address': 2})
+        with self.assertRaises(WrongArgType) as context:
+            raise_errors(errors)
+        self.assertEqual([error['field'] for error in context.exception.errors],
+                         ['name', 'address'])